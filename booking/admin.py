@@ -3,83 +3,190 @@ from django.contrib import admin
 from booking.models import *
 
 
-class AccessLevelAdmin(admin.ModelAdmin):
+def parse_permissions(permissions, separator=","):
+    '''Joins prefetched permissions for display, or None if there are
+       none.'''
+    return separator.join(
+        [("%s on %s" % (perm.action, perm.location))
+         for perm in permissions]) or None
+
+
+class ChangelistAdmin(admin.ModelAdmin):
+    '''Keeps changelists to a fixed number of queries on large tables: the
+       related rows shown per row are joined or prefetched in get_queryset,
+       and the unfiltered total is not counted.'''
+    list_per_page = 100
+    show_full_result_count = False
+
+
+class AccessLevelAdmin(ChangelistAdmin):
     list_display = ('name', 'permissions_parsed')
 
+    def get_queryset(self, request):
+        return super(AccessLevelAdmin, self).get_queryset(request)\
+            .prefetch_related('default_permissions')
+
     def permissions_parsed(self, obj):
-        if obj.default_permissions.count() < 1:
-            return None
-        return ",".join(
-            [("%s on %s" %
-             (perm.action, perm.location))
-             for perm in obj.default_permissions.all()])
+        return parse_permissions(obj.default_permissions.all())
     permissions_parsed.short_description = 'Permissions'
     permissions_parsed.empty_value_display = 'No default permissions'
 
 
-class AgentAdmin(admin.ModelAdmin):
+class AgentAdmin(ChangelistAdmin):
     list_display = ('username', 'access_level', 'permissions_parsed',)
+    list_filter = ('access_level',)
     fields = ('user', 'access_level', 'implicit_permissions', 'permissions',)
     readonly_fields = ('implicit_permissions',)
 
+    def get_queryset(self, request):
+        return super(AgentAdmin, self).get_queryset(request)\
+            .select_related('user', 'access_level')\
+            .prefetch_related('permissions',
+                              'access_level__default_permissions')
+
     def implicit_permissions(self, obj):
-        if obj.access_level.default_permissions.count() < 1:
+        if not obj.access_level:
             return None
-        return "\n".join(
-            [("%s on %s" %
-             (perm.action, perm.location)) for
-             perm in obj.access_level.default_permissions.all()])
+        return parse_permissions(
+            obj.access_level.default_permissions.all(), "\n")
     implicit_permissions.short_name = 'implicit_permissions'
     implicit_permissions.empty_value_display = 'No implicit permissions'
 
     def username(self, obj):
         return obj.user.username
+    username.admin_order_field = 'user__username'
 
     def permissions_parsed(self, obj):
-        if obj.permissions.count() < 1:
-            return None
-        return ",".join(
-            [("%s on %s" %
-             (perm.action, perm.location)) for perm in obj.permissions.all()])
+        return parse_permissions(obj.permissions.all())
     permissions_parsed.short_description = 'Permissions'
     permissions_parsed.empty_value_display = 'No explicit permissions'
 
 
-class ContractorAdmin(admin.ModelAdmin):
+class ContractorAdmin(ChangelistAdmin):
     list_display = ('active', 'name', 'categories_parsed', 'credits')
+    list_filter = ('categories',)
+    # The balance follows the ledger and post_ranges_raw the PostRange rows;
+    # both are written through the managers only.
+    readonly_fields = ('balance', 'post_ranges_raw')
+
+    def get_queryset(self, request):
+        return super(ContractorAdmin, self).get_queryset(request)\
+            .prefetch_related('categories')
 
     def categories_parsed(self, obj):
-        if obj.categories.count() < 1:
-            return None
         return ",".join(
-            [("%s" % category.name) for category in obj.categories.all()])
+            [("%s" % category.name) for category in obj.categories.all()]
+        ) or None
     categories_parsed.short_description = 'Categories'
     categories_parsed.empty_value_display = 'No categories set'
 
+    def credits(self, obj):
+        # The stored balance, not a fold over the ledger.
+        return obj.credits
+    credits.admin_order_field = 'balance'
+
+
+class ConsumerAdmin(admin.ModelAdmin):
+    # Running totals maintained by NPSRequest.mark_received.
+    readonly_fields = ('nps_sum', 'nps_count')
+
+
+class AlertAdmin(admin.ModelAdmin):
+    '''Alerts are created and marked read through Alert, which keeps the
+       AlertCounter rows in step, so they cannot be added or deleted here
+       and the fields the counters depend on are read only.'''
+    list_display = ('target', 'target_type', 'is_read')
+    readonly_fields = ('target', 'target_type', 'is_read')
+
+    def get_actions(self, request):
+        _actions = super(AlertAdmin, self).get_actions(request)
+        _actions.pop('delete_selected', None)
+        return _actions
 
-class BookingAdmin(admin.ModelAdmin):
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class TransactionAdmin(ChangelistAdmin):
+    '''The ledger is written through TransactionManager and BiddingManager,
+       which keep Contractor.balance in step, so transactions cannot be
+       added or deleted here and only their comment can be edited.'''
+    list_display = ('timestamp', 'contractor', 'transaction_type', 'amount',
+                    'status')
+    readonly_fields = ('transaction_type', 'amount', 'source_agent',
+                       'contractor', 'source_type', 'target_bid', 'status')
+
+    def get_queryset(self, request):
+        return super(TransactionAdmin, self).get_queryset(request)\
+            .select_related('contractor')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class BidAdmin(ChangelistAdmin):
+    '''Bids hold credits through their transaction, which BiddingManager
+       releases or commits, so bids are read only here.'''
+    list_display = ('created_on', 'booking', 'contractor', 'base_cost',
+                    'status')
+    readonly_fields = ('booking', 'contractor', 'base_cost',
+                       'premium_adjustment', 'status')
+
+    def get_queryset(self, request):
+        return super(BidAdmin, self).get_queryset(request)\
+            .select_related('booking__consumer', 'contractor')
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
+
+
+class PreferredAdmin(admin.ModelAdmin):
+    # post_ranges_raw mirrors the PostRange rows and the range cache, which
+    # Preferred.set_post_ranges keeps in step.
+    readonly_fields = ('post_ranges_raw',)
+
+
+class BookingAdmin(ChangelistAdmin):
     list_display = ('created_on', 'category', 'agent_name', 'consumer_name',
                     'quoted_price', 'base_cost', 'priority_level')
+    # Both are served by the (field, created_on, id) indexes.
+    list_filter = ('status', 'category')
+    ordering = ('-created_on', '-id')
+    raw_id_fields = ('consumer', 'link')
+
+    def get_queryset(self, request):
+        return super(BookingAdmin, self).get_queryset(request)\
+            .select_related('category', 'consumer', 'agent__user')
 
     def consumer_name(self, obj):
         return obj.consumer.name
+    consumer_name.admin_order_field = 'consumer__name'
 
     def agent_name(self, obj):
         return obj.agent.user.username
+    agent_name.admin_order_field = 'agent__user__username'
 # Register your models here.
 
 admin.site.register(Permission)
 admin.site.register(AccessLevel, AccessLevelAdmin)
 admin.site.register(Agent, AgentAdmin)
-# admin.site.register(Contractor, ContractorAdmin)
-admin.site.register(Contractor)
-admin.site.register(Consumer)
+admin.site.register(Contractor, ContractorAdmin)
+admin.site.register(Consumer, ConsumerAdmin)
 admin.site.register(Category)
 admin.site.register(SubType)
 admin.site.register(Booking, BookingAdmin)
-admin.site.register(Bid)
-admin.site.register(Transaction)
-admin.site.register(Preferred)
+admin.site.register(Bid, BidAdmin)
+admin.site.register(Transaction, TransactionAdmin)
+admin.site.register(Preferred, PreferredAdmin)
 ## added by Philipp
 admin.site.register(Suburb)
-admin.site.register(Alert)
+admin.site.register(Alert, AlertAdmin)
@@ -0,0 +1,102 @@
+'''Scheduled closing of auctions. Due auctions are found through the
+   (auction_status, closes_at) index, claimed in batches by moving them to
+   the closing state under a lease, and settled one transaction each with
+   BiddingManager.exec_auction. An auction whose closer dies is claimed
+   again once its lease lapses.'''
+import logging
+import time
+from datetime import timedelta
+
+from django.db import transaction
+from django.utils import timezone
+
+from booking.dashboard import invalidate_categories
+from booking.exceptions import AuctionClosed
+from booking.managers import BiddingManager
+from booking.models import *
+
+logger = logging.getLogger(__name__)
+
+# Claimed auctions are hidden from other closers for this long.
+CLAIM_SECONDS = 300
+
+
+class AuctionCloser(object):
+    '''Settles auctions past their close time. log is called with a summary
+       line per batch.'''
+
+    def __init__(self, batch_size=100, claim_seconds=CLAIM_SECONDS,
+                 log=None):
+        self.batch_size = batch_size
+        self.claim_seconds = claim_seconds
+        self.log = log or (lambda message: None)
+
+    def claim(self):
+        '''Returns the next batch of due bookings, moved to the closing
+           state and leased to this closer.'''
+        _now = timezone.now()
+        with transaction.atomic():
+            # Two queries, as an OR of both would not use the index.
+            _bookings = list(Booking.objects.select_for_update().lapsed(
+                _now)[:self.batch_size])
+            if len(_bookings) < self.batch_size:
+                _bookings.extend(Booking.objects.select_for_update().due(
+                    _now)[:self.batch_size - len(_bookings)])
+            Booking.objects.filter(pk__in=[_b.pk for _b in _bookings]).update(
+                auction_status=AUCTION_STATUS_CLOSING,
+                auction_claimed_until=_now + timedelta(
+                    seconds=self.claim_seconds))
+            invalidate_categories([_b.category_id for _b in _bookings])
+        return _bookings
+
+    def settle(self, bookings):
+        '''Settles each booking. Returns (settled, unsold, failed, max lag
+           past closes_at in seconds).'''
+        _settled = 0
+        _unsold = 0
+        _failed = 0
+        _lag = 0.0
+        for _booking in bookings:
+            try:
+                _winning_bid = BiddingManager.exec_auction(
+                    booking=_booking)[0]
+            except AuctionClosed:
+                # Settled by hand in the meantime.
+                continue
+            except Exception as e:
+                # Left closing; retried once the claim lapses.
+                logger.exception("Closing booking %d failed: %s",
+                                 _booking.pk, e)
+                _failed += 1
+                continue
+            if _winning_bid:
+                _settled += 1
+            else:
+                _unsold += 1
+            _lag = max(_lag, (timezone.now() -
+                              _booking.closes_at).total_seconds())
+        return _settled, _unsold, _failed, _lag
+
+    def run(self):
+        '''Claims and settles batches until no auction is due. Returns
+           (settled, unsold, failed, max lag, elapsed seconds).'''
+        _started = time.time()
+        _totals = [0, 0, 0, 0.0]
+        _batch = 0
+        while True:
+            _batch_started = time.time()
+            _bookings = self.claim()
+            if not _bookings:
+                return tuple(_totals) + (time.time() - _started,)
+            _settled, _unsold, _failed, _lag = self.settle(_bookings)
+            _batch += 1
+            _elapsed = time.time() - _batch_started
+            self.log("Batch %d: %d claimed, %d settled, %d without a winner, "
+                     "%d failed in %.2fs (%.1f/s)." % (
+                         _batch, len(_bookings), _settled, _unsold, _failed,
+                         _elapsed, len(_bookings) / _elapsed
+                         if _elapsed else 0))
+            _totals[0] += _settled
+            _totals[1] += _unsold
+            _totals[2] += _failed
+            _totals[3] = max(_totals[3], _lag)
@@ -0,0 +1,331 @@
+'''Helpers and scenarios shared by the benchmark management commands.'''
+import sys
+import time
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+from django.test import RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from booking import views
+from booking.exceptions import NotEnoughData
+from booking.managers import BiddingManager, BookingManager
+from booking.models import *
+from booking.pricing import STRATEGIES, get_strategy
+from booking.ranking import BidMatrix, cost_in_cents, from_cents
+
+
+def percentile(values, pct):
+    '''Returns the pct-th percentile of values, by nearest rank.'''
+    if not values:
+        return 0.0
+    _sorted = sorted(values)
+    _rank = int(round(pct / 100.0 * (len(_sorted) - 1)))
+    return _sorted[max(0, min(_rank, len(_sorted) - 1))]
+
+
+def time_calls(func, repeat):
+    '''Calls func repeat times and returns the wall times in milliseconds.'''
+    _timings = []
+    for _ in range(repeat):
+        _started = time.time()
+        func()
+        _timings.append((time.time() - _started) * 1000)
+    return _timings
+
+
+def explain(connection, queryset):
+    '''Returns the backend's query plan for queryset as a list of lines.'''
+    _sql, _params = queryset.query.sql_with_params()
+    _prefix = {
+        'sqlite': 'EXPLAIN QUERY PLAN ',
+        'postgresql': 'EXPLAIN ANALYZE ',
+    }.get(connection.vendor, 'EXPLAIN ')
+    with connection.cursor() as _cursor:
+        _cursor.execute(_prefix + _sql, _params)
+        _rows = _cursor.fetchall()
+    if connection.vendor == 'sqlite':
+        return [_row[-1] for _row in _rows]
+    return [" | ".join("%s" % _col for _col in _row) for _row in _rows]
+
+
+def peak_rss_kb():
+    '''Peak resident set size of this process so far, in kilobytes.'''
+    try:
+        import resource
+    except ImportError:
+        return None
+    _rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere.
+    return _rss // 1024 if sys.platform == 'darwin' else _rss
+
+
+def run_scenario(func, iterations, connection):
+    '''Calls func(i) for each iteration and returns its latency
+       percentiles, query counts and peak memory as a dict.'''
+    _timings = []
+    _queries = []
+    _rss_before = peak_rss_kb()
+    for _i in range(iterations):
+        # The query log is capped, so a full one would count nothing.
+        connection.queries_log.clear()
+        with CaptureQueriesContext(connection) as _captured:
+            _started = time.time()
+            func(_i)
+            _timings.append((time.time() - _started) * 1000)
+        _queries.append(len(_captured))
+    _rss_after = peak_rss_kb()
+    return {
+        'iterations': iterations,
+        'latency_ms': {
+            'p50': percentile(_timings, 50),
+            'p90': percentile(_timings, 90),
+            'p99': percentile(_timings, 99),
+            'mean': sum(_timings) / len(_timings) if _timings else 0.0,
+            'max': max(_timings) if _timings else 0.0,
+        },
+        'queries': {
+            'mean': float(sum(_queries)) / len(_queries) if _queries else 0.0,
+            'max': max(_queries) if _queries else 0,
+        },
+        'peak_rss_kb': _rss_after,
+        'rss_growth_kb': _rss_after - _rss_before
+        if _rss_after is not None else None,
+    }
+
+
+class MarketplaceBenchmark(object):
+    '''Fixed end-to-end scenarios run against the rows already in the
+       database, usually produced by seed_marketplace. Every scenario runs
+       in a transaction that is rolled back, so the dataset is unchanged
+       between runs.'''
+
+    SCENARIOS = ['booking_creation', 'bid_placement', 'auction_execution',
+                 'contractor_dashboard', 'list_pages', 'qualified_feed']
+
+    def __init__(self, iterations=50, connection=None):
+        from django.db import connection as default_connection
+        self.iterations = iterations
+        self.connection = connection or default_connection
+        self.factory = RequestFactory()
+
+    def run(self, scenarios=None):
+        '''Returns {scenario: results} for the given scenario names.'''
+        _results = {}
+        for _name in scenarios or self.SCENARIOS:
+            with transaction.atomic():
+                _func, _iterations = getattr(self, 'setup_%s' % _name)()
+                _results[_name] = run_scenario(_func, _iterations,
+                                               self.connection)
+                transaction.set_rollback(True)
+        return _results
+
+    def require(self, rows, missing):
+        '''Returns rows, raising NotEnoughData naming what is missing when
+           they are empty.'''
+        if not rows:
+            raise NotEnoughData(missing)
+        return rows
+
+    def staff_request(self, path):
+        _request = self.factory.get(path)
+        _request.user = self.staff
+        return _request
+
+    def setup_booking_creation(self):
+        _agent = self.require(
+            Agent.objects.filter(access_level__isnull=False).first(),
+            'agent with an access level')
+        _template = self.require(
+            Booking.objects.filter(agent=_agent).first() or
+            Booking.objects.first(), 'booking')
+        _fields = dict(
+            consumer_id=_template.consumer_id, address_1='1 Bench St',
+            suburb_id=_template.suburb_id, post_code=_template.post_code,
+            preferred_schedule=timezone.now(),
+            category_id=_template.category_id, quoted_price=100,
+            base_cost=20, priority_level=1, status=BOOKING_STATUS_ACTIVE,
+            subtypes=list(SubType.objects.all()[:2]))
+
+        def create_booking(_i):
+            BookingManager.create_booking(agent=_agent, **dict(_fields))
+        return create_booking, self.iterations
+
+    def setup_bid_placement(self):
+        _booking = self.require(Booking.objects.open().filter(
+            category__contractor__isnull=False).first(),
+            'open booking with contractors in its category')
+        _contractors = self.require(list(Contractor.objects.filter(
+            categories=_booking.category_id)[:self.iterations]),
+            'contractor in the category of booking %s' % _booking.pk)
+        Contractor.objects.filter(pk__in=[_c.pk for _c in _contractors])\
+            .update(balance=F('balance') + 10 ** 6)
+
+        def place_bid(_i):
+            BiddingManager.place_bid(
+                contractor=_contractors[_i % len(_contractors)],
+                booking=_booking, base_cost=_booking.base_cost)
+        return place_bid, self.iterations
+
+    def setup_auction_execution(self):
+        _bookings = list(BiddingManager.get_settleable_bookings(
+            cutoff=timezone.now() + timedelta(days=3650)
+        )[:self.iterations])
+
+        def exec_auction(_i):
+            BiddingManager.exec_auction(booking=_bookings[_i])
+        return exec_auction, len(_bookings)
+
+    def setup_contractor_dashboard(self):
+        self.staff = User(username='benchmark', is_staff=True)
+        _contractors = self.require(list(Contractor.objects.filter(
+            bids__isnull=False).distinct()[:self.iterations]),
+            'contractor with bids')
+
+        def contractor_dashboard(_i):
+            _contractor = _contractors[_i % len(_contractors)]
+            views.contractor_detail(self.staff_request(
+                _contractor.get_absolute_url()), id=_contractor.pk)
+        return contractor_dashboard, self.iterations
+
+    def setup_list_pages(self):
+        self.staff = User(username='benchmark', is_staff=True)
+        _views = [views.booking_list, views.bid_list, views.transaction_list,
+                  views.consumer_list, views.contractor_list]
+
+        def list_page(_i):
+            _views[_i % len(_views)](self.staff_request('/'))
+        return list_page, self.iterations
+
+    def setup_qualified_feed(self):
+        _contractors = self.require(list(Contractor.objects.exclude(
+            post_ranges_raw='[]')[:self.iterations]),
+            'contractor with post ranges')
+
+        def qualified_feed(_i):
+            _contractor = _contractors[_i % len(_contractors)]
+            _page = Booking.qualified_feed(contractor=_contractor)
+            if _page.next_cursor:
+                Booking.qualified_feed(contractor=_contractor,
+                                       cursor=_page.next_cursor)
+        return qualified_feed, self.iterations
+
+
+class PricingReplay(object):
+    '''Replays settled auctions through pricing strategies without writing
+       anything. Bookings are read in chunks; the bids of a chunk are loaded
+       once with values_list into a BidMatrix per booking, and every
+       strategy is then run, and timed, over the same matrices. list_price,
+       today's billing, is always replayed as the baseline the other
+       strategies' revenue is compared with.'''
+    BASELINE = 'list_price'
+
+    def __init__(self, strategies=None, chunk_size=1000, limit=None,
+                 include_open=False):
+        self.strategies = strategies or [get_strategy(_name)
+                                         for _name in sorted(STRATEGIES)]
+        if self.BASELINE not in [_s.name for _s in self.strategies]:
+            self.strategies.insert(0, get_strategy(self.BASELINE))
+        self.chunk_size = max(chunk_size, 1)
+        self.limit = limit
+        self.include_open = include_open
+
+    def bookings(self):
+        _qs = Booking.objects.exclude(status=BOOKING_STATUS_CANCELLED)
+        if not self.include_open:
+            _qs = _qs.filter(auction_status=AUCTION_STATUS_SETTLED)
+        return _qs.annotate(
+            list_price=cost_in_cents('cost_adjustment')).order_by(
+            'pk').values_list('pk', 'category_id', 'post_code', 'list_price')
+
+    def chunks(self):
+        '''Yields lists of (list price in cents, BidMatrix), one per booking
+           with bids.'''
+        _bid_statuses = [BID_STATUS_ACCEPTED, BID_STATUS_EXPIRED]
+        if self.include_open:
+            _bid_statuses.append(BID_STATUS_ACTIVE)
+        # A contractor with more than one Preferred row for a category is
+        # not preferred, as in BiddingManager.get_preferred_contractors.
+        _preferred = {}
+        for _pref in Preferred.objects.all():
+            _preferred.setdefault(
+                (_pref.contractor_id, _pref.category_id), []).append(_pref)
+        _last = 0
+        _remaining = self.limit
+        while _remaining is None or _remaining > 0:
+            _size = self.chunk_size if _remaining is None \
+                else min(self.chunk_size, _remaining)
+            _bookings = list(self.bookings().filter(pk__gt=_last)[:_size])
+            if not _bookings:
+                return
+            _last = _bookings[-1][0]
+            if _remaining is not None:
+                _remaining -= len(_bookings)
+            # A pk range keeps the query within SQLite's parameter limit.
+            _rows = {}
+            for _row in Bid.objects.filter(
+                    booking_id__gte=_bookings[0][0], booking_id__lte=_last,
+                    status__in=_bid_statuses).annotate(
+                    cost_cents=cost_in_cents()).order_by('pk').values_list(
+                    'booking_id', 'pk', 'contractor_id', 'cost_cents',
+                    'created_on'):
+                _rows.setdefault(_row[0], []).append(_row[1:])
+            _chunk = []
+            for _pk, _category_id, _post_code, _list_price in _bookings:
+                if _pk not in _rows:
+                    continue
+                _preferred_bidders = set(
+                    _row[1] for _row in _rows[_pk] if self.is_preferred(
+                        _preferred.get((_row[1], _category_id)), _post_code))
+                _chunk.append((int(_list_price),
+                               BidMatrix.from_rows(_rows[_pk],
+                                                   _preferred_bidders)))
+            yield _chunk
+
+    def is_preferred(self, preferred, post_code):
+        return bool(preferred) and len(preferred) == 1 and \
+            preferred[0].in_post_range(post_code)
+
+    def run(self):
+        '''Returns {strategy name: results} with the auctions sold, the
+           revenue, its change from the baseline's and the strategy's
+           throughput, and the time spent loading bids under 'load'.'''
+        _totals = dict((_s.name, {'auctions': 0, 'sold': 0, 'revenue': 0,
+                                  'seconds': 0.0}) for _s in self.strategies)
+        _bids = 0
+        _load = 0.0
+        _started = time.time()
+        for _chunk in self.chunks():
+            _load += time.time() - _started
+            _bids += sum(len(_matrix) for _list_price, _matrix in _chunk)
+            for _strategy in self.strategies:
+                _total = _totals[_strategy.name]
+                _run_started = time.time()
+                _outcomes = [_strategy.run(_matrix, _list_price)
+                             for _list_price, _matrix in _chunk]
+                _total['seconds'] += time.time() - _run_started
+                _total['auctions'] += len(_outcomes)
+                for _outcome in _outcomes:
+                    if _outcome.sold:
+                        _total['sold'] += 1
+                        _total['revenue'] += _outcome.price
+            _started = time.time()
+        _results = {'load': {'bids': _bids, 'seconds': _load}}
+        for _name, _total in _totals.items():
+            _results[_name] = {
+                'auctions': _total['auctions'],
+                'sold': _total['sold'],
+                'revenue': "%s" % from_cents(_total['revenue']),
+                'revenue_vs_baseline': "%s" % from_cents(
+                    _total['revenue'] - _totals[self.BASELINE]['revenue']),
+                'mean_price': "%s" % from_cents(
+                    _total['revenue'] // _total['sold']
+                    if _total['sold'] else 0),
+                'seconds': _total['seconds'],
+                'auctions_per_second': _total['auctions'] /
+                _total['seconds'] if _total['seconds'] else 0.0,
+            }
+        return _results
@@ -0,0 +1,13 @@
+from django.utils.functional import SimpleLazyObject
+
+from booking.models import Alert
+
+
+def alerts(request):
+    '''Adds unread_alerts, the signed-in user's unread alert count. It is
+       only queried if a template uses it.'''
+    _user = getattr(request, 'user', None)
+    if _user is None or not _user.is_authenticated():
+        return {}
+    return {'unread_alerts': SimpleLazyObject(
+        lambda: Alert.unread_count_for_user(_user))}
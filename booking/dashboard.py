@@ -0,0 +1,138 @@
+'''Cached contractor dashboard snapshots. A snapshot holds everything
+   contractor_detail renders and is stored in Django's cache together with
+   the versions of the contractor and of its categories it was built from.
+   Signals and the managers bump those versions when a bid, transaction,
+   booking or Preferred row changes, which retires every snapshot depending
+   on them; anything else (e.g. a consumer's name) is at most
+   BOOKING_DASHBOARD_CACHE_TIMEOUT seconds stale.'''
+import random
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+from booking.metrics import TIME_BUCKETS, registry
+from booking.models import *
+
+DASHBOARD_TIMEOUT = getattr(settings, 'BOOKING_DASHBOARD_CACHE_TIMEOUT', 30)
+# Only the latest transactions are cached; transaction_list has the rest.
+DASHBOARD_TRANSACTIONS = getattr(settings, 'BOOKING_DASHBOARD_TRANSACTIONS',
+                                 20)
+
+registry.register('booking_dashboard_cache_total', 'counter',
+                  'Contractor dashboard snapshot lookups, by result.')
+registry.register('booking_dashboard_rebuild_seconds', 'histogram',
+                  'Time spent rebuilding contractor dashboard snapshots.',
+                  TIME_BUCKETS)
+
+
+def snapshot_key(contractor_pk):
+    return 'booking:dashboard:%d' % contractor_pk
+
+
+def contractor_version_key(contractor_pk):
+    return 'booking:dashboard-version:contractor:%d' % contractor_pk
+
+
+def category_version_key(category_pk):
+    return 'booking:dashboard-version:category:%d' % category_pk
+
+
+def get_versions(keys):
+    '''Returns {key: version}, starting missing versions at a random value
+       so that a version lost to eviction never matches an old snapshot.'''
+    _versions = cache.get_many(keys)
+    _missing = dict((_key, random.randint(1, 2 ** 30)) for _key in keys
+                    if _key not in _versions)
+    if _missing:
+        cache.set_many(_missing, timeout=None)
+        _versions.update(_missing)
+    return _versions
+
+
+def bump_versions(keys):
+    '''Bumps the versions now, and again once the current transaction
+       commits, so a snapshot rebuilt from uncommitted data in between is
+       retired as well.'''
+    def _bump():
+        for _key in keys:
+            try:
+                cache.incr(_key)
+            except ValueError:
+                # No version means no snapshot depends on it.
+                pass
+    if not keys:
+        return
+    _bump()
+    transaction.on_commit(_bump)
+
+
+def invalidate_contractors(pks):
+    bump_versions([contractor_version_key(_pk) for _pk in set(pks) if _pk])
+
+
+def invalidate_categories(pks):
+    bump_versions([category_version_key(_pk) for _pk in set(pks) if _pk])
+
+
+def build_snapshot(contractor):
+    '''Loads the dashboard of a contractor, whose categories should be
+       prefetched, from the database. Only the latest DASHBOARD_TRANSACTIONS
+       transactions are kept, so the snapshot's size stays bounded;
+       more_transactions tells whether there are older ones.'''
+    _category_ids = [_c.pk for _c in contractor.categories.all()]
+    _bids_by_status = {}
+    for _bid in Bid.objects.filter(contractor=contractor, status__in=[
+            BID_STATUS_ACTIVE, BID_STATUS_ACCEPTED, BID_STATUS_EXPIRED
+            ]).select_related('booking__consumer'):
+        _bids_by_status.setdefault(_bid.status, []).append(_bid)
+    # Newest first along the (contractor, timestamp, id) index.
+    _transactions = list(Transaction.objects.filter(
+        contractor=contractor).order_by('-timestamp', '-id')[
+        :DASHBOARD_TRANSACTIONS + 1])
+    return {
+        'contractor': contractor,
+        'category_ids': _category_ids,
+        'credits': contractor.credits,
+        'active_bids': _bids_by_status.get(BID_STATUS_ACTIVE, []),
+        'winning_bids': _bids_by_status.get(BID_STATUS_ACCEPTED, []),
+        'losing_bids': _bids_by_status.get(BID_STATUS_EXPIRED, []),
+        'bookings': Booking.qualified_feed(contractor=contractor),
+        'preferred': list(Preferred.objects.filter(
+            category_id__in=_category_ids).select_related('category')),
+        'transactions': _transactions[:DASHBOARD_TRANSACTIONS],
+        'more_transactions': len(_transactions) > DASHBOARD_TRANSACTIONS,
+    }
+
+
+def get_dashboard(contractor_pk):
+    '''Returns the contractor's dashboard snapshot, from the cache when its
+       versions are current. Raises Contractor.DoesNotExist.'''
+    _key = snapshot_key(contractor_pk)
+    _contractor_key = contractor_version_key(contractor_pk)
+    _cached = cache.get_many([_key, _contractor_key])
+    _entry = _cached.get(_key)
+    if _entry is not None and _contractor_key in _cached:
+        _versions, _snapshot = _entry
+        _current = get_versions([_k for _k in _versions
+                                 if _k != _contractor_key])
+        _current[_contractor_key] = _cached[_contractor_key]
+        if _current == _versions:
+            registry.inc('booking_dashboard_cache_total', {'result': 'hit'})
+            return _snapshot
+
+    registry.inc('booking_dashboard_cache_total', {'result': 'miss'})
+    _started = time.time()
+    # Versions are read before the rows they cover, so that a change made
+    # during the rebuild leaves this snapshot already out of date.
+    _versions = get_versions([_contractor_key])
+    _contractor = Contractor.objects.prefetch_related('categories').get(
+        pk=contractor_pk)
+    _versions.update(get_versions([category_version_key(_c.pk)
+                                   for _c in _contractor.categories.all()]))
+    _snapshot = build_snapshot(_contractor)
+    cache.set(_key, (_versions, _snapshot), DASHBOARD_TIMEOUT)
+    registry.observe('booking_dashboard_rebuild_seconds', {},
+                     time.time() - _started)
+    return _snapshot
@@ -13,3 +13,13 @@ class ContractorNotEligible(Exception):
             self,
             'Contractor not eligible to place bid. Reason: %s' % (reason)
         )
+
+
+class AuctionClosed(Exception):
+    def __init__(self, reason='Auction closed.'):
+        Exception.__init__(self, reason)
+
+
+class NotEnoughData(Exception):
+    def __init__(self, missing):
+        Exception.__init__(self, 'Not enough data: no %s.' % missing)
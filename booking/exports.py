@@ -0,0 +1,149 @@
+'''CSV exports of the ledger, bid history and bookings. Rows are fetched as
+   tuples in keyset chunks ordered by (date, pk), which the date and
+   contractor/category indexes serve directly, so an export runs in constant
+   memory however many rows it covers.'''
+import csv
+from datetime import datetime, time as datetime_time
+
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.encoding import force_bytes
+
+from booking.models import *
+
+CHUNK_SIZE = 2000
+
+EXPORTS = {
+    'transactions': {
+        'model': Transaction,
+        'date_field': 'timestamp',
+        'filters': {'contractor': 'contractor_id'},
+        'columns': [
+            ('id', 'pk'), ('timestamp', 'timestamp'),
+            ('contractor_id', 'contractor_id'),
+            ('contractor', 'contractor__name'),
+            ('type', 'transaction_type'), ('amount', 'amount'),
+            ('status', 'status'), ('source', 'source_type'),
+            ('source_agent_id', 'source_agent_id'),
+            ('bid_id', 'target_bid_id'), ('comment', 'comment'),
+        ],
+    },
+    'bids': {
+        'model': Bid,
+        'date_field': 'created_on',
+        'filters': {'contractor': 'contractor_id'},
+        'columns': [
+            ('id', 'pk'), ('created_on', 'created_on'),
+            ('booking_id', 'booking_id'), ('contractor_id', 'contractor_id'),
+            ('contractor', 'contractor__name'), ('base_cost', 'base_cost'),
+            ('premium_adjustment', 'premium_adjustment'),
+            ('status', 'status'),
+        ],
+    },
+    'bookings': {
+        'model': Booking,
+        'date_field': 'created_on',
+        'filters': {'category': 'category_id'},
+        'columns': [
+            ('id', 'pk'), ('created_on', 'created_on'),
+            ('consumer_id', 'consumer_id'), ('agent_id', 'agent_id'),
+            ('category', 'category__name'), ('suburb', 'suburb__name'),
+            ('post_code', 'post_code'),
+            ('preferred_schedule', 'preferred_schedule'),
+            ('quoted_price', 'quoted_price'), ('base_cost', 'base_cost'),
+            ('cost_adjustment', 'cost_adjustment'),
+            ('priority_level', 'priority_level'), ('status', 'status'),
+            ('completed', 'completed'),
+        ],
+    },
+}
+
+
+class Echo(object):
+    '''File-like object whose write returns the value, so csv.writer rows
+       can be yielded straight into a StreamingHttpResponse.'''
+
+    def write(self, value):
+        return value
+
+
+def parse_bound(value, end=False):
+    '''Parses a date or datetime filter value. A bare end date includes the
+       whole day. Raises ValueError on bad input.'''
+    if not value:
+        return None
+    _parsed = parse_datetime(value)
+    if _parsed is None:
+        _date = parse_date(value)
+        if _date is None:
+            raise ValueError("Invalid date: %s" % value)
+        _parsed = datetime.combine(_date, datetime_time.max if end else
+                                   datetime_time.min)
+    if timezone.is_naive(_parsed):
+        _parsed = timezone.make_aware(_parsed)
+    return _parsed
+
+
+def export_queryset(kind, start=None, end=None, **filters):
+    '''Returns the filtered queryset for an export. start and end are
+       inclusive date or datetime strings; filters are the export's id
+       filters, e.g. contractor=12.'''
+    _export = EXPORTS[kind]
+    _qs = _export['model'].objects.all()
+    _start = parse_bound(start)
+    _end = parse_bound(end, end=True)
+    if _start:
+        _qs = _qs.filter(**{_export['date_field'] + '__gte': _start})
+    if _end:
+        _qs = _qs.filter(**{_export['date_field'] + '__lte': _end})
+    for _name, _value in filters.items():
+        if _value in (None, ''):
+            continue
+        if _name not in _export['filters']:
+            raise ValueError("Unknown filter: %s" % _name)
+        try:
+            _value = int(_value)
+        except (TypeError, ValueError):
+            raise ValueError("Invalid %s: %s" % (_name, _value))
+        _qs = _qs.filter(**{_export['filters'][_name]: _value})
+    return _qs
+
+
+def iter_rows(queryset, date_field, fields, chunk_size=CHUNK_SIZE):
+    '''Yields values_list tuples of fields, in (date_field, pk) order, one
+       keyset chunk at a time.'''
+    _qs = queryset.order_by(date_field, 'pk')
+    _last = None
+    while True:
+        _chunk = _qs
+        if _last is not None:
+            _chunk = _chunk.filter(
+                Q(**{date_field + '__gt': _last[0]}) |
+                Q(**{date_field: _last[0], 'pk__gt': _last[1]}))
+        _count = 0
+        for _row in _chunk.values_list(date_field, 'pk', *fields)[
+                :chunk_size].iterator():
+            _count += 1
+            _last = _row[:2]
+            yield _row[2:]
+        if _count < chunk_size:
+            return
+
+
+def _cell(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return force_bytes(value)
+
+
+def csv_lines(kind, queryset, chunk_size=CHUNK_SIZE):
+    '''Yields the export as CSV lines, header first.'''
+    _export = EXPORTS[kind]
+    _writer = csv.writer(Echo())
+    yield _writer.writerow([_label for _label, _field in _export['columns']])
+    for _row in iter_rows(queryset, _export['date_field'],
+                          [_field for _label, _field in _export['columns']],
+                          chunk_size):
+        yield _writer.writerow([_cell(_value) for _value in _row])
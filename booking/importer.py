@@ -0,0 +1,326 @@
+'''Bulk import of consumers, contractors and bookings from CSV or JSON-lines
+   files. Rows are read, validated and written one chunk at a time, so
+   memory use does not grow with the file. Rows are validated with the
+   existing ModelForms; foreign keys are resolved through lookup maps
+   instead of one query per row.'''
+import csv
+import json
+import time
+from itertools import islice
+
+from django.db import transaction
+from django.db.models import Max
+from django.forms.models import modelform_factory
+from django.utils.encoding import force_text
+
+from booking.dashboard import invalidate_categories, invalidate_contractors
+from booking.exceptions import AgentNotAuthorized
+from booking.forms import BookingForm, ConsumerForm, ContractorForm
+from booking.models import *
+
+
+class RowError(Exception):
+    '''A row that cannot be imported. errors maps a field to messages.'''
+
+    def __init__(self, errors):
+        super(RowError, self).__init__("%s" % errors)
+        self.errors = errors
+
+
+def read_rows(fileobj, format='csv'):
+    '''Yields (line number, row dict) from a CSV file with a header row, or
+       from a file of JSON objects, one per line.'''
+    if format == 'csv':
+        _reader = csv.DictReader(fileobj)
+        for _row in _reader:
+            yield _reader.line_num, dict(
+                (force_text(_key), force_text(_value))
+                for _key, _value in _row.items()
+                if _key is not None and _value is not None)
+        return
+    for _line, _text in enumerate(fileobj, 1):
+        if _text.strip():
+            yield _line, json.loads(_text)
+
+
+def _split(value):
+    '''Many-to-many cells hold a JSON list, or names separated by "|".'''
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return [_v.strip() for _v in (value or '').split('|') if _v.strip()]
+
+
+class Importer(object):
+    '''Imports rows of one model. Subclasses declare the form, the form
+       fields validated per row, and how the relations are resolved.'''
+    form_class = None
+    fields = []
+
+    def __init__(self, user=None, batch_size=1000, log=None):
+        self.user = user
+        self.batch_size = max(batch_size, 1)
+        self.log = log or (lambda message: None)
+        self.form = modelform_factory(self.form_class._meta.model,
+                                      form=self.form_class, fields=self.fields)
+        # Uniqueness is checked once per chunk rather than once per row.
+        self.form.validate_unique = lambda form: None
+
+    def run(self, fileobj, format='csv', rejects=None):
+        '''Imports every row. Rejected rows are written to rejects as JSON
+           lines. Returns (imported, rejected, elapsed seconds).'''
+        _started = time.time()
+        _imported = 0
+        _rejected = 0
+        _rows = read_rows(fileobj, format)
+        while True:
+            _chunk = list(islice(_rows, self.batch_size))
+            if not _chunk:
+                break
+            _chunk_started = time.time()
+            _ok, _errors = self.import_chunk(_chunk)
+            _imported += _ok
+            _rejected += len(_errors)
+            for _line, _row, _error in _errors:
+                if rejects is not None:
+                    rejects.write(json.dumps({'line': _line, 'row': _row,
+                                              'errors': _error}) + '\n')
+            _elapsed = time.time() - _chunk_started
+            self.log("%d imported, %d rejected (%.0f rows/s)." % (
+                _imported, _rejected,
+                len(_chunk) / _elapsed if _elapsed else 0))
+        return _imported, _rejected, time.time() - _started
+
+    def import_chunk(self, chunk):
+        '''Validates and writes a chunk in one transaction. Returns
+           (imported, [(line, row, errors)]).'''
+        self.prepare(chunk)
+        _valid = []
+        _errors = []
+        for _line, _row in chunk:
+            try:
+                _valid.append((_line, _row, self.build(_row)))
+            except RowError as e:
+                _errors.append((_line, _row, e.errors))
+        for _line, _row, _error in self.check_unique(_valid):
+            _errors.append((_line, _row, _error))
+        _rejected = set(_line for _line, _row, _error in _errors)
+        _valid = [_v for _v in _valid if _v[0] not in _rejected]
+        try:
+            with transaction.atomic():
+                self.write([_built for _line, _row, _built in _valid])
+        except Exception as e:
+            return 0, _errors + [(_line, _row, {'__all__': ["%s" % e]})
+                                 for _line, _row, _built in _valid]
+        return len(_valid), _errors
+
+    def prepare(self, chunk):
+        '''Loads the lookup maps needed by the chunk.'''
+
+    def validate(self, row):
+        '''Runs the row through the model form and returns the unsaved
+           instance. Missing columns take the model field's default.'''
+        _data = dict(row)
+        for _name in self.fields:
+            _field = self.form._meta.model._meta.get_field(_name)
+            if _name not in _data and _field.has_default():
+                _data[_name] = _field.get_default()
+        _form = self.form(data=_data)
+        if not _form.is_valid():
+            raise RowError(dict((_field, [force_text(_m) for _m in _msgs])
+                                for _field, _msgs in _form.errors.items()))
+        return _form.save(commit=False)
+
+    def lookup(self, mapping, row, column, required=True):
+        _value = row.get(column)
+        if _value in (None, ''):
+            if required:
+                raise RowError({column: ['This field is required.']})
+            return None
+        try:
+            return mapping[force_text(_value)]
+        except KeyError:
+            raise RowError({column: ['Unknown value "%s".' % _value]})
+
+    def build(self, row):
+        '''Returns whatever write() needs for a valid row, or raises
+           RowError.'''
+        return self.validate(row)
+
+    def check_unique(self, valid):
+        '''Yields (line, row, errors) for rows that would break a unique
+           constraint.'''
+        return []
+
+    def write(self, built):
+        self.form_class._meta.model.objects.bulk_create(built)
+
+
+class ConsumerImporter(Importer):
+    form_class = ConsumerForm
+    fields = ['name', 'phone_number', 'email_address']
+
+
+class ContractorImporter(Importer):
+    '''Contractors have categories (names) and optional post_ranges (a JSON
+       list of [lower, upper] pairs). The user is taken from the username
+       column, defaulting to the importing user.'''
+    form_class = ContractorForm
+    fields = ['name', 'phone_number', 'active']
+
+    def __init__(self, *args, **kwargs):
+        super(ContractorImporter, self).__init__(*args, **kwargs)
+        self.categories = dict(Category.objects.values_list('name', 'pk'))
+
+    def prepare(self, chunk):
+        _usernames = set(_row.get('username') for _line, _row in chunk
+                         if _row.get('username'))
+        self.users = dict(User.objects.filter(username__in=_usernames)
+                          .values_list('username', 'pk'))
+
+    def build(self, row):
+        _contractor = self.validate(row)
+        if row.get('username'):
+            _contractor.user_id = self.lookup(self.users, row, 'username')
+        elif self.user:
+            _contractor.user_id = self.user.pk
+        else:
+            raise RowError({'username': ['This field is required.']})
+        _categories = [self.lookup(self.categories, {'categories': _name},
+                                   'categories')
+                       for _name in _split(row.get('categories'))]
+        _post_ranges = row.get('post_ranges') or []
+        try:
+            if not isinstance(_post_ranges, list):
+                _post_ranges = json.loads(_post_ranges)
+            _post_ranges = [[int(_pr[0]), int(_pr[1])]
+                            for _pr in _post_ranges]
+        except (ValueError, TypeError, IndexError):
+            raise RowError({'post_ranges': [
+                'Expected a list of [lower, upper] pairs.']})
+        _contractor.post_ranges_raw = json.dumps(_post_ranges)
+        if len(_contractor.post_ranges_raw) > 128:
+            raise RowError({'post_ranges': ['Too many post ranges.']})
+        return _contractor, _categories, _post_ranges
+
+    def check_unique(self, valid):
+        _names = [_built[0].name for _line, _row, _built in valid]
+        _taken = set(Contractor.objects.filter(name__in=_names)
+                     .values_list('name', flat=True))
+        for _line, _row, _built in valid:
+            if _built[0].name in _taken:
+                yield _line, _row, {'name': [
+                    'Contractor with this Name already exists.']}
+            _taken.add(_built[0].name)
+
+    def write(self, built):
+        # bulk_create does not set the pks here, so they are looked up by
+        # name, which check_unique keeps unique, for the categories and post
+        # ranges.
+        Contractor.objects.bulk_create([_built[0] for _built in built])
+        _pks = dict(Contractor.objects.filter(
+            name__in=[_built[0].name for _built in built]).values_list(
+            'name', 'pk'))
+        _memberships = []
+        _ranges = []
+        _through = Contractor.categories.through
+        for _contractor, _categories, _post_ranges in built:
+            _contractor.pk = _pks[_contractor.name]
+            _memberships.extend(
+                _through(contractor_id=_contractor.pk, category_id=_pk)
+                for _pk in set(_categories))
+            _ranges.extend(PostRange(contractor=_contractor, lower=_pr[0],
+                                     upper=_pr[1]) for _pr in _post_ranges)
+        _through.objects.bulk_create(_memberships)
+        PostRange.objects.bulk_create(_ranges)
+        invalidate_contractors(_pks.values())
+
+
+class BookingImporter(Importer):
+    '''Bookings are created for the agent of the importing user, who needs
+       the permission to create bookings. consumer is a consumer pk; suburb,
+       category and subtypes are names.'''
+    form_class = BookingForm
+    fields = ['address_1', 'address_2', 'access_instructions',
+              'phone_number_2', 'post_code', 'preferred_schedule',
+              'quoted_price', 'cost_adjustment', 'base_cost',
+              'priority_level', 'completed', 'status', 'comment_private',
+              'comment_public']
+
+    def __init__(self, *args, **kwargs):
+        super(BookingImporter, self).__init__(*args, **kwargs)
+        self.agent = Agent.objects.filter(user=self.user).first()
+        if not self.agent:
+            raise Exception("The importing user must be an agent.")
+        if not self.agent.has_perms(PERM_ACTION_CREATE,
+                                    PERM_LOCATION_BOOKINGS):
+            raise AgentNotAuthorized('CREATE', 'BOOKINGS')
+        self.suburbs = {}
+        for _pk, _name in Suburb.objects.order_by('-pk').values_list(
+                'pk', 'name'):
+            self.suburbs[_name] = _pk
+        self.categories = dict(Category.objects.values_list('name', 'pk'))
+        self.subtypes = dict(SubType.objects.values_list('name', 'pk'))
+
+    def prepare(self, chunk):
+        _pks = set()
+        for _line, _row in chunk:
+            try:
+                _pks.add(int(_row.get('consumer')))
+            except (TypeError, ValueError):
+                pass
+        self.consumers = dict(
+            ("%s" % _pk, _pk) for _pk in Consumer.objects.filter(
+                pk__in=_pks).values_list('pk', flat=True))
+
+    def build(self, row):
+        _booking = self.validate(row)
+        _booking.agent_id = self.agent.pk
+        _booking.consumer_id = self.lookup(self.consumers, row, 'consumer')
+        _booking.suburb_id = self.lookup(self.suburbs, row, 'suburb')
+        _booking.category_id = self.lookup(self.categories, row, 'category')
+        # bulk_create skips Booking.save, which defaults closes_at.
+        _booking.closes_at = _booking.preferred_schedule
+        _subtypes = [self.lookup(self.subtypes, {'subtypes': _name},
+                                 'subtypes')
+                     for _name in _split(row.get('subtypes'))]
+        return _booking, _subtypes
+
+    def natural_key(self, booking):
+        return (booking.consumer_id, booking.preferred_schedule,
+                booking.address_1, booking.category_id)
+
+    def write(self, built):
+        # bulk_create does not set the pks here. They are looked up by
+        # natural key among the agent's bookings above the previous last
+        # pk; bookings sharing a key get theirs in insertion order. The
+        # agent row is locked so that imports for the agent run one at a
+        # time, and the chunk is rolled back if any other booking for the
+        # agent turns up among them.
+        list(Agent.objects.select_for_update().filter(pk=self.agent.pk))
+        _last = Booking.objects.aggregate(_last=Max('pk'))['_last'] or 0
+        Booking.objects.bulk_create([_built[0] for _built in built])
+        _pks = {}
+        for _row in Booking.objects.filter(
+                agent=self.agent, pk__gt=_last).order_by('pk').values_list(
+                'pk', 'consumer_id', 'preferred_schedule', 'address_1',
+                'category_id'):
+            _pks.setdefault(_row[1:], []).append(_row[0])
+        if sum(len(_found) for _found in _pks.values()) != len(built):
+            raise Exception("Bookings were created for the agent during the "
+                            "import; import these rows again.")
+        _through = Booking.subtypes.through
+        _links = []
+        for _booking, _subtypes in built:
+            _booking.pk = _pks[self.natural_key(_booking)].pop(0)
+            _links.extend(_through(booking_id=_booking.pk, subtype_id=_pk)
+                          for _pk in set(_subtypes))
+        _through.objects.bulk_create(_links)
+        invalidate_categories([_booking.category_id
+                               for _booking, _subtypes in built])
+
+
+IMPORTERS = {
+    'consumer': ConsumerImporter,
+    'contractor': ContractorImporter,
+    'booking': BookingImporter,
+}
@@ -0,0 +1,52 @@
+'''Partial indexes for the hottest filters. Django cannot declare partial
+   indexes on a model, so they are created with raw SQL on the backends
+   that support them (PostgreSQL and SQLite); elsewhere the composite
+   index_together indexes on the models cover the same filters. SQLite
+   drops them whenever a migration rebuilds their table, so a migration
+   that alters one of these tables must recreate them afterwards, as
+   0013_recreate_partial_indexes does; missing_partial_indexes is checked
+   by the tests.'''
+
+PARTIAL_INDEXES = [
+    ('booking_booking_open_category', 'booking_booking',
+     'category_id, priority_level',
+     "status = 'booking_status_active' AND NOT completed"),
+    ('booking_bid_active_contractor', 'booking_bid', 'contractor_id',
+     "status = 'bid_status_active'"),
+    ('booking_alert_unread_target', 'booking_alert', 'target, target_type',
+     'NOT is_read'),
+    ('booking_npsrequest_received_consumer', 'booking_npsrequest',
+     'consumer_id', 'is_received'),
+]
+
+
+def supports_partial_indexes(connection):
+    return connection.vendor in ['postgresql', 'sqlite']
+
+
+def create_partial_indexes(schema_editor):
+    if not supports_partial_indexes(schema_editor.connection):
+        return
+    for _name, _table, _columns, _condition in PARTIAL_INDEXES:
+        schema_editor.execute('CREATE INDEX %s ON %s (%s) WHERE %s' % (
+            _name, _table, _columns, _condition))
+
+
+def drop_partial_indexes(schema_editor):
+    if not supports_partial_indexes(schema_editor.connection):
+        return
+    for _name, _table, _columns, _condition in PARTIAL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % _name)
+
+
+def missing_partial_indexes(connection):
+    '''Returns the names of the partial indexes the database lacks.'''
+    if not supports_partial_indexes(connection):
+        return []
+    _missing = []
+    with connection.cursor() as _cursor:
+        for _name, _table, _columns, _condition in PARTIAL_INDEXES:
+            if _name not in connection.introspection.get_constraints(
+                    _cursor, _table):
+                _missing.append(_name)
+    return _missing
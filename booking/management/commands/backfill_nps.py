@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Case, IntegerField, When
+
+from booking.models import Consumer
+
+
+class Command(BaseCommand):
+    help = ('Recomputes the consumers\' running NPS totals from the received '
+            'NPS requests, in batches of consumers.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        _size = max(options['batch_size'], 1)
+        _last = 0
+        _checked = 0
+        _updated = 0
+        while True:
+            _rows = list(Consumer.objects.filter(pk__gt=_last).order_by('pk')
+                         .with_received_nps().values_list(
+                             'pk', 'nps_sum', 'nps_count',
+                             'received_nps_sum', 'received_nps_count')
+                         [:_size])
+            if not _rows:
+                break
+            _last = _rows[-1][0]
+            _checked += len(_rows)
+            _stale = dict((_pk, (_received_sum or 0, _received_count or 0))
+                          for _pk, _sum, _count, _received_sum,
+                          _received_count in _rows
+                          if (_sum, _count) != (_received_sum or 0,
+                                                _received_count or 0))
+            if not _stale:
+                continue
+            with transaction.atomic():
+                Consumer.objects.filter(pk__in=_stale.keys()).update(
+                    nps_sum=Case(
+                        *[When(pk=_pk, then=_sum)
+                          for _pk, (_sum, _count) in _stale.items()],
+                        output_field=Consumer._meta.get_field('nps_sum')),
+                    nps_count=Case(
+                        *[When(pk=_pk, then=_count)
+                          for _pk, (_sum, _count) in _stale.items()],
+                        output_field=IntegerField()))
+            _updated += len(_stale)
+        self.stdout.write("%d/%d consumer(s) updated." % (_updated, _checked))
@@ -0,0 +1,57 @@
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.utils import timezone
+
+from booking.benchmarks import MarketplaceBenchmark
+from booking.exceptions import NotEnoughData
+from booking.seed import MarketplaceSeeder
+
+
+class Command(BaseCommand):
+    help = ('Runs the end-to-end benchmark scenarios and records latency '
+            'percentiles, query counts and peak memory as JSON.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--scenario', action='append',
+                            choices=MarketplaceBenchmark.SCENARIOS,
+                            help='Scenario to run; repeatable. Default: all.')
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--seed-bookings', type=int, default=0,
+                            help='Seed this many synthetic bookings first.')
+        parser.add_argument('--label', default='',
+                            help='Free-form run label, e.g. a release.')
+        parser.add_argument('--output', default=None,
+                            help='Write the JSON results to this file '
+                                 'instead of stdout.')
+
+    def handle(self, *args, **options):
+        if options['seed_bookings']:
+            MarketplaceSeeder(bookings=options['seed_bookings']).run()
+
+        try:
+            _scenarios = MarketplaceBenchmark(
+                iterations=options['iterations']).run(options['scenario'])
+        except NotEnoughData as e:
+            raise CommandError("%s Run seed_marketplace first." % e)
+
+        _report = json.dumps({
+            'label': options['label'],
+            'recorded_at': timezone.now().isoformat(),
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'scenarios': _scenarios,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as _output:
+                _output.write(_report)
+            for _name, _result in sorted(_scenarios.items()):
+                self.stdout.write("%s: p50 %.2fms, p99 %.2fms, %.1f queries" % (
+                    _name, _result['latency_ms']['p50'],
+                    _result['latency_ms']['p99'], _result['queries']['mean']))
+        else:
+            self.stdout.write(_report)
@@ -0,0 +1,38 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from booking.outbox import OutboxWorker
+
+
+class Command(BaseCommand):
+    help = ('Delivers queued alert emails and AskNicely triggers, retrying '
+            'failures with exponential backoff.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=4,
+                            help='Concurrent HTTP calls per batch.')
+        parser.add_argument('--max-attempts', type=int, default=5)
+        parser.add_argument('--backoff', type=float, default=30,
+                            help='Seconds before the first retry; doubles '
+                                 'on every further attempt.')
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep polling instead of exiting once the '
+                                 'outbox is drained.')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between polls with --loop.')
+
+    def handle(self, *args, **options):
+        _worker = OutboxWorker(batch_size=max(options['batch_size'], 1),
+                               workers=options['workers'],
+                               max_attempts=options['max_attempts'],
+                               backoff_seconds=options['backoff'])
+        while True:
+            _sent, _retried, _failed = _worker.drain()
+            if _sent or _retried or _failed or not options['loop']:
+                self.stdout.write("%d sent, %d to retry, %d failed." %
+                                  (_sent, _retried, _failed))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
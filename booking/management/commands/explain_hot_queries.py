@@ -0,0 +1,104 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from booking.benchmarks import explain, percentile, time_calls
+from booking.indexes import create_partial_indexes, drop_partial_indexes
+from booking.models import *
+from booking.pagination import DEFAULT_PAGE_SIZE
+from booking.seed import MarketplaceSeeder
+
+# The composite indexes added for the hot filters, per model.
+HOT_INDEXES = [
+    (Bid, ('contractor', 'status')),
+    (Booking, ('category', 'completed', 'status', 'post_code')),
+    (Booking, ('auction_status', 'closes_at')),
+    (Transaction, ('contractor', 'status')),
+    (Alert, ('target', 'target_type', 'is_read')),
+    (NPSRequest, ('consumer', 'is_received')),
+]
+
+
+def hot_queries():
+    '''The filters the views and managers run most, with parameters taken
+       from existing rows.'''
+    _contractor = Bid.objects.values_list('contractor_id', flat=True)[:1]
+    _category = Booking.objects.values_list('category_id', flat=True)[:1]
+    _consumer = NPSRequest.objects.values_list('consumer_id', flat=True)[:1]
+    _target = Alert.objects.values_list('target', flat=True)[:1]
+    _serving = Contractor.objects.exclude(post_ranges_raw='[]').first()
+    _contractor = _contractor[0] if _contractor else 0
+    _queries = [
+        ('Bid(contractor, status)', Bid.objects.filter(
+            contractor_id=_contractor, status=BID_STATUS_ACTIVE)),
+        ('Booking(category, completed, status)', Booking.objects.filter(
+            category_id=_category[0] if _category else 0, completed=False,
+            status=BOOKING_STATUS_ACTIVE)),
+        ('Transaction(contractor, status)', Transaction.objects.filter(
+            contractor_id=_contractor, status__in=TRANS_LEDGER_STATUSES)),
+        ('Alert(target, target_type, is_read)', Alert.objects.filter(
+            target=_target[0] if _target else 0,
+            target_type=ALERT_TARGET_CONT, is_read=False)),
+        ('NPSRequest(consumer, is_received)', NPSRequest.objects.filter(
+            consumer_id=_consumer[0] if _consumer else 0, is_received=True)),
+        ('Booking(auction_status, closes_at)',
+         Booking.objects.due()[:100]),
+    ]
+    if _serving:
+        _queries.append((
+            'Booking(category, completed, status, post_code)',
+            Booking.objects.qualified_for(_serving).order_by(
+                *Booking.FEED_ORDERING)[:DEFAULT_PAGE_SIZE + 1]))
+    return _queries
+
+
+class Command(BaseCommand):
+    help = ('Prints the query plan and timings of the hot filters. With '
+            '--compare the hot-filter indexes are dropped for a first run '
+            'and recreated for a second one; only use that on a benchmark '
+            'database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seed-bookings', type=int, default=0,
+                            help='Seed this many synthetic bookings first.')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--compare', action='store_true', default=False)
+
+    def handle(self, *args, **options):
+        if options['seed_bookings']:
+            _counts = MarketplaceSeeder(
+                bookings=options['seed_bookings'],
+                log=self.stdout.write).run()
+            self.stdout.write("Seeded %d rows." % sum(_counts.values()))
+
+        if options['compare']:
+            self.set_hot_indexes(False)
+            try:
+                self.run_queries('Without hot-filter indexes',
+                                 options['repeat'])
+            finally:
+                self.set_hot_indexes(True)
+        self.run_queries('With hot-filter indexes', options['repeat'])
+
+    def set_hot_indexes(self, enabled):
+        with connection.schema_editor() as _editor:
+            for _model, _fields in HOT_INDEXES:
+                _current = set(tuple(_f) for _f in
+                               _model._meta.index_together)
+                _without = _current - set([_fields])
+                if enabled:
+                    _editor.alter_index_together(_model, _without, _current)
+                else:
+                    _editor.alter_index_together(_model, _current, _without)
+            if enabled:
+                create_partial_indexes(_editor)
+            else:
+                drop_partial_indexes(_editor)
+
+    def run_queries(self, title, repeat):
+        self.stdout.write("== %s" % title)
+        for _name, _queryset in hot_queries():
+            _timings = time_calls(lambda: list(_queryset.all()), repeat)
+            self.stdout.write("%s: p50 %.2fms, p95 %.2fms" % (
+                _name, percentile(_timings, 50), percentile(_timings, 95)))
+            for _line in explain(connection, _queryset):
+                self.stdout.write("    %s" % _line)
@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from booking.exports import CHUNK_SIZE, EXPORTS, csv_lines, export_queryset
+
+
+class Command(BaseCommand):
+    help = ('Exports transactions, bids or bookings as CSV, in constant '
+            'memory.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=sorted(EXPORTS))
+        parser.add_argument('--output', help='File to write; default stdout.')
+        parser.add_argument('--start', help='Earliest date or datetime.')
+        parser.add_argument('--end', help='Latest date or datetime.')
+        parser.add_argument('--contractor', type=int,
+                            help='Contractor id (transactions and bids).')
+        parser.add_argument('--category', type=int,
+                            help='Category id (bookings).')
+        parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        _filters = dict((_name, options[_name])
+                        for _name in ['contractor', 'category']
+                        if options[_name] is not None)
+        try:
+            _queryset = export_queryset(options['kind'], options['start'],
+                                        options['end'], **_filters)
+        except ValueError as e:
+            raise CommandError("%s" % e)
+
+        _lines = csv_lines(options['kind'], _queryset,
+                           max(options['chunk_size'], 1))
+        if not options['output']:
+            for _line in _lines:
+                self.stdout.write(_line, ending='')
+            return
+        with open(options['output'], 'wb') as _output:
+            for _line in _lines:
+                _output.write(_line)
@@ -0,0 +1,56 @@
+import os
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from booking.importer import IMPORTERS
+
+
+class Command(BaseCommand):
+    help = ('Imports consumers, contractors or bookings from a CSV file '
+            '(with a header row) or a JSON-lines file, in chunks. Rejected '
+            'rows are written to a side file with their errors.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('model', choices=sorted(IMPORTERS))
+        parser.add_argument('path')
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help='Defaults to the file extension.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--user', dest='username',
+                            help='Importing user. Bookings are created by '
+                                 'this user\'s agent; contractors without '
+                                 'a username column belong to this user.')
+        parser.add_argument('--rejects',
+                            help='Where to write rejected rows. Defaults to '
+                                 '<path>.rejects.jsonl.')
+
+    def handle(self, *args, **options):
+        _format = options['format'] or (
+            'csv' if options['path'].lower().endswith('.csv') else 'jsonl')
+        _user = None
+        if options['username']:
+            try:
+                _user = User.objects.get(username=options['username'])
+            except User.DoesNotExist:
+                raise CommandError("Unknown user %s." % options['username'])
+        try:
+            _importer = IMPORTERS[options['model']](
+                user=_user, batch_size=options['batch_size'],
+                log=self.stdout.write)
+        except Exception as e:
+            raise CommandError("%s" % e)
+
+        _rejects_path = options['rejects'] or \
+            options['path'] + '.rejects.jsonl'
+        with open(options['path'], 'rb' if _format == 'csv' else 'r') as \
+                _input, open(_rejects_path, 'w') as _rejects:
+            _imported, _rejected, _elapsed = _importer.run(
+                _input, _format, _rejects)
+        if not _rejected:
+            os.remove(_rejects_path)
+        self.stdout.write(
+            "Imported %d %s row(s) in %.2fs (%.0f rows/s), rejected %d%s." % (
+                _imported, options['model'], _elapsed,
+                (_imported + _rejected) / _elapsed if _elapsed else 0,
+                _rejected, " (see %s)" % _rejects_path if _rejected else ""))
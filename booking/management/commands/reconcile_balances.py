@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from booking.models import Contractor
+
+
+class Command(BaseCommand):
+    help = ('Recomputes contractor balances from the transaction ledger '
+            'and reports any drift from the stored balance.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--fix', action='store_true', default=False,
+                            help='Overwrite drifted balances with the '
+                                 'ledger value.')
+
+    def handle(self, *args, **options):
+        _rows = Contractor.objects.with_ledger_balance().values_list(
+            'pk', 'name', 'balance', 'ledger_balance')
+        _drifted = 0
+        with transaction.atomic():
+            for _pk, _name, _balance, _ledger_balance in _rows:
+                _ledger_balance = _ledger_balance or 0
+                if _balance == _ledger_balance:
+                    continue
+                _drifted += 1
+                self.stdout.write("%s (#%d): stored %.2f, ledger %.2f" %
+                                  (_name, _pk, _balance, _ledger_balance))
+                if options['fix']:
+                    Contractor.objects.filter(pk=_pk).update(
+                        balance=_ledger_balance)
+        self.stdout.write("%d contractor(s) drifted%s." %
+                          (_drifted, ", fixed" if options['fix'] and _drifted
+                           else ""))
@@ -0,0 +1,79 @@
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from booking.benchmarks import PricingReplay
+from booking.pricing import STRATEGIES, ReservePriceStrategy, get_strategy
+
+
+class Command(BaseCommand):
+    help = ('Replays settled auctions through the pricing strategies and '
+            'records each one\'s throughput and revenue, against the '
+            'list_price baseline, as JSON. Nothing is written to the '
+            'database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--strategy', action='append',
+                            choices=sorted(STRATEGIES),
+                            help='Strategy to replay; repeatable. Default: '
+                                 'all. list_price is always replayed as '
+                                 'the baseline.')
+        parser.add_argument('--reserve-ratio', default=None,
+                            help='Reserve as a multiple of the list price, '
+                                 'for reserve_price.')
+        parser.add_argument('--limit', type=int, default=None,
+                            help='Replay at most this many bookings.')
+        parser.add_argument('--chunk-size', type=int, default=1000)
+        parser.add_argument('--include-open', action='store_true',
+                            default=False,
+                            help='Replay open auctions with their active '
+                                 'bids too.')
+        parser.add_argument('--label', default='',
+                            help='Free-form run label, e.g. a release.')
+        parser.add_argument('--output', default=None,
+                            help='Write the JSON results to this file '
+                                 'instead of stdout.')
+
+    def handle(self, *args, **options):
+        _strategies = []
+        for _name in options['strategy'] or sorted(STRATEGIES):
+            if _name == ReservePriceStrategy.name:
+                _strategies.append(ReservePriceStrategy(
+                    options['reserve_ratio']))
+            else:
+                _strategies.append(get_strategy(_name))
+        _results = PricingReplay(
+            strategies=_strategies, chunk_size=options['chunk_size'],
+            limit=options['limit'],
+            include_open=options['include_open']).run()
+        _load = _results.pop('load')
+
+        _report = json.dumps({
+            'label': options['label'],
+            'recorded_at': timezone.now().isoformat(),
+            'django': django.get_version(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'load': _load,
+            'baseline': PricingReplay.BASELINE,
+            'strategies': _results,
+        }, indent=2, sort_keys=True)
+        if options['output']:
+            with open(options['output'], 'w') as _output:
+                _output.write(_report)
+            self.stdout.write("Loaded %d bids in %.2fs." % (
+                _load['bids'], _load['seconds']))
+            for _name, _result in sorted(_results.items()):
+                self.stdout.write(
+                    "%s: %d/%d sold, revenue %s (%s vs %s), %.0f "
+                    "auctions/s" % (
+                        _name, _result['sold'], _result['auctions'],
+                        _result['revenue'], _result['revenue_vs_baseline'],
+                        PricingReplay.BASELINE,
+                        _result['auctions_per_second']))
+        else:
+            self.stdout.write(_report)
@@ -0,0 +1,40 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from booking.seed import MarketplaceSeeder
+
+
+class Command(BaseCommand):
+    help = ('Seeds synthetic agents, consumers, contractors, bookings, bids, '
+            'transactions and Preferred rows for benchmarking.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--bookings', type=int, default=10000)
+        parser.add_argument('--contractors', type=int, default=None,
+                            help='Defaults to bookings / 20.')
+        parser.add_argument('--consumers', type=int, default=None,
+                            help='Defaults to bookings / 4.')
+        parser.add_argument('--categories', type=int, default=8)
+        parser.add_argument('--bids-per-booking', type=int, default=3,
+                            help='Average number of bids per booking.')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--seed', type=int, default=0,
+                            help='Random seed, for reproducible datasets.')
+
+    def handle(self, *args, **options):
+        _started = time.time()
+        _counts = MarketplaceSeeder(
+            bookings=options['bookings'],
+            contractors=options['contractors'],
+            consumers=options['consumers'],
+            categories=options['categories'],
+            bids_per_booking=options['bids_per_booking'],
+            batch_size=options['batch_size'],
+            seed=options['seed'],
+            log=self.stdout.write
+        ).run()
+        for _model, _rows in sorted(_counts.items()):
+            self.stdout.write("%s: %d" % (_model, _rows))
+        self.stdout.write("Seeded %d rows in %.1fs." % (
+            sum(_counts.values()), time.time() - _started))
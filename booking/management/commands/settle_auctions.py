@@ -0,0 +1,97 @@
+import sys
+import time
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+
+from django.core.management.base import BaseCommand
+from django.db import connection, connections
+
+from booking.auctions import AuctionCloser
+
+
+def write_line(message):
+    '''Batch log of process pool workers, which cannot be handed the
+       command's stdout.'''
+    sys.stdout.write(message + '\n')
+    sys.stdout.flush()
+
+
+def close_auctions(kwargs, close_connection=True):
+    '''Runs a closer until no auction is due. Pool workers each use their
+       own database connection, which is closed once they are done.'''
+    try:
+        return AuctionCloser(**kwargs).run()
+    finally:
+        if close_connection:
+            connection.close()
+
+
+class Command(BaseCommand):
+    help = ('Settles every auction past its close time. Workers claim due '
+            'auctions in batches, so several can run at once, here or in '
+            'other processes.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100)
+        parser.add_argument('--workers', type=int, default=None,
+                            help='Pool size, 4 by default. 1 settles '
+                                 'inline, the default on SQLite as it '
+                                 'serializes writers.')
+        parser.add_argument('--pool', choices=['thread', 'process'],
+                            default='thread')
+        parser.add_argument('--claim-seconds', type=int, default=300,
+                            help='How long a claimed auction is hidden from '
+                                 'other workers before it is retried.')
+        parser.add_argument('--loop', action='store_true', default=False,
+                            help='Keep polling instead of exiting once no '
+                                 'auction is due.')
+        parser.add_argument('--interval', type=float, default=5,
+                            help='Seconds between polls with --loop; bounds '
+                                 'how long an auction stays open past its '
+                                 'close time.')
+
+    def handle(self, *args, **options):
+        if options['workers'] is None:
+            options['workers'] = 1 if connection.vendor == 'sqlite' else 4
+        while True:
+            _settled, _unsold, _failed, _lag, _elapsed = self.run_workers(
+                options)
+            if _settled or _unsold or _failed or not options['loop']:
+                self.stdout.write(
+                    "Settled %d auction(s), %d without a winner, %d failed in "
+                    "%.2fs (%.1f/s, at most %.1fs past close)." % (
+                        _settled, _unsold, _failed, _elapsed,
+                        (_settled + _unsold) / _elapsed if _elapsed else 0,
+                        _lag))
+            if not options['loop']:
+                return
+            time.sleep(options['interval'])
+
+    def run_workers(self, options):
+        '''Returns the workers' summed (settled, unsold, failed), their
+           largest lag, and the wall time.'''
+        _started = time.time()
+        _kwargs = dict(batch_size=max(options['batch_size'], 1),
+                       claim_seconds=options['claim_seconds'],
+                       log=self.stdout.write)
+        if options['workers'] <= 1:
+            _results = [close_auctions(_kwargs, close_connection=False)]
+        else:
+            if options['pool'] == 'process':
+                # Forked workers must not inherit the parent's connection.
+                connections.close_all()
+                _kwargs['log'] = write_line
+                _pool = Pool(options['workers'])
+            else:
+                _pool = ThreadPool(options['workers'])
+            try:
+                _results = _pool.map(close_auctions,
+                                     [_kwargs] * options['workers'])
+            finally:
+                _pool.close()
+                _pool.join()
+        return (sum(_r[0] for _r in _results),
+                sum(_r[1] for _r in _results),
+                sum(_r[2] for _r in _results),
+                max(_r[3] for _r in _results),
+                time.time() - _started)
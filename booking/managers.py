@@ -1,12 +1,19 @@
-#import requests
-
+import json
+import logging
 from datetime import datetime
 from django.conf import settings
-from django.core.mail import send_mail
+from django.db import transaction
+from django.db.models import Case, DateTimeField, F, Q, Value, When
+from django.utils import timezone
 
-from booking.exceptions import AgentNotAuthorized, ContractorNotEligible
+from booking.dashboard import invalidate_categories, invalidate_contractors
+from booking.exceptions import AgentNotAuthorized, AuctionClosed, \
+    ContractorNotEligible
 from booking.models import *
+from booking.pricing import get_strategy
+from booking.ranking import BidMatrix, from_cents, to_cents
 
+logger = logging.getLogger(__name__)
 
 class BookingManager(object):
     '''Manages CRUD operations for Bookings, performed by Agents.
@@ -19,22 +26,21 @@ class BookingManager(object):
             raise Exception('First parameter agent is required.')
         if not agent.has_perms(PERM_ACTION_CREATE, PERM_LOCATION_BOOKINGS):
             raise AgentNotAuthorized('CREATE', 'BOOKINGS')
-        _subtypes = []
-        if 'subtypes' in kwargs:
-            _subtypes = kwargs.get('subtypes', [])
-            del kwargs['subtypes']
-        _booking = Booking(agent=agent, *args, **kwargs)
-        _booking.save()
-        if len(_subtypes) > 0:
-            for _subtype in _subtypes:
-                _booking.subtypes.add(_subtype)
-        _booking.save()
+        _subtypes = kwargs.pop('subtypes', None) or []
+        with transaction.atomic():
+            _booking = Booking(agent=agent, *args, **kwargs)
+            _booking.save()
+            if _subtypes:
+                _booking.subtypes.add(*_subtypes)
         return _booking
 
     @classmethod
     def update_booking(cls, agent=None, booking=None, *args, **kwargs):
         '''Updates a booking's details. Returns the result of
-           QuerySet.update().'''
+           QuerySet.update(). subtypes, when passed, replaces the booking's
+           subtypes; an empty list clears them. A new preferred_schedule
+           moves closes_at with it unless closes_at was set apart from the
+           schedule or is passed too.'''
 
         if not agent:
             raise Exception('First parameter agent is required.')
@@ -42,30 +48,55 @@ class BookingManager(object):
             raise Exception('Second parameter booking is required.')
         if not agent.has_perms(PERM_ACTION_UPDATE, PERM_LOCATION_BOOKINGS):
             raise AgentNotAuthorized('UPDATE', 'BOOKINGS')
-        _subtypes = []
-        if 'subtypes' in kwargs:
-            _subtypes = kwargs.get('subtypes', [])
-            del kwargs['subtypes']
-        if len(_subtypes) >= 0:
-                #changed from >0 to >=0, otherwise changing to "no subtype" skipped
-            _booking = Booking.objects.get(pk=booking.pk)
-            for _subtype in _booking.subtypes.all():
-                if _subtype not in _subtypes:
-                    _booking.subtypes.remove(_subtype)
-                else:
-                    _subtypes.remove(_subtype)
-            for _subtype in _subtypes:
-                _booking.subtypes.add(_subtype)
-            _booking.save()
-        return Booking.objects.filter(pk=booking.pk).update(*args, **kwargs)
+        _subtypes = kwargs.pop('subtypes', None)
+        if 'preferred_schedule' in kwargs and 'closes_at' not in kwargs:
+            # update() skips Booking.save, which defaults closes_at; the
+            # right-hand side sees the row before the update.
+            kwargs['closes_at'] = Case(
+                When(closes_at=F('preferred_schedule'),
+                     then=Value(kwargs['preferred_schedule'])),
+                default=F('closes_at'), output_field=DateTimeField())
+        with transaction.atomic():
+            if _subtypes is not None:
+                cls.replace_subtypes(booking, _subtypes)
+            _result = Booking.objects.filter(pk=booking.pk).update(
+                *args, **kwargs)
+            # update() bypasses the signals that retire contractor
+            # dashboards.
+            _category = kwargs.get('category')
+            invalidate_categories([booking.category_id,
+                                   _category.pk if _category else None])
+            invalidate_contractors(booking.bids.values_list(
+                'contractor_id', flat=True))
+        return _result
+
+    @classmethod
+    def replace_subtypes(cls, booking=None, subtypes=None):
+        '''Makes subtypes (SubTypes or pks) the booking's only subtypes,
+           diffing pk sets and writing the through table in bulk.'''
+        _through = Booking.subtypes.through
+        _wanted = set(getattr(_subtype, 'pk', _subtype)
+                      for _subtype in subtypes or [])
+        _current = set(_through.objects.filter(booking_id=booking.pk)
+                       .values_list('subtype_id', flat=True))
+        if _current - _wanted:
+            _through.objects.filter(booking_id=booking.pk,
+                                    subtype_id__in=_current - _wanted).delete()
+        if _wanted - _current:
+            _through.objects.bulk_create([
+                _through(booking_id=booking.pk, subtype_id=_pk)
+                for _pk in _wanted - _current])
 
 class BidSummary(object):
     bid = None
     total_cost = 0
     preferred = False
+    price = None
     created_on = datetime.now()
 
-    def __init__(self, booking=None, bid=None):
+    def __init__(self, booking=None, bid=None, preferred=None):
+        '''preferred may be passed in when it has already been resolved for
+           the whole bid set, which skips the Preferred lookup.'''
         if not booking:
             raise Exception('First parameter booking is required.')
         if not bid:
@@ -75,6 +106,10 @@ class BidSummary(object):
         self.total_cost = bid.total_cost
         self.created_on = bid.created_on
 
+        if preferred is not None:
+            self.preferred = preferred
+            return
+
         pref = None
         try:
             pref = Preferred.objects.get(contractor=bid.contractor,
@@ -112,24 +147,38 @@ class BiddingManager(object):
 
         # try:
         #     booking = kwargs['booking']
-        if booking.total_cost > contractor.credits:
-            raise ContractorNotEligible('Insufficient credits.')
         if booking.category not in contractor.categories.all():
             raise ContractorNotEligible('Category mismatched.')
         # except KeyError:
         #         raise Exception('Required parameter booking not found.')
 
-        _bid = Bid(contractor=contractor, booking=booking, *args, **kwargs)
-        _bid.save()
-
-        _transaction = Transaction(
-            transaction_type=TRANS_TYPE_REDEEM,
-            amount=booking.total_cost,
-            contractor=contractor,
-            source_type=TRANS_SOURCE_CONT,
-            target_bid=_bid
-        )
-        _transaction.save()
+        with transaction.atomic():
+            # Locking the open booking keeps the bid from racing the closer:
+            # it either commits before the auction is claimed or is refused.
+            if not Booking.objects.select_for_update().filter(
+                    Q(closes_at__isnull=True) |
+                    Q(closes_at__gt=timezone.now()),
+                    pk=booking.pk, auction_status=AUCTION_STATUS_OPEN
+            ).values_list('pk', flat=True):
+                raise AuctionClosed()
+            _bid = Bid(contractor=contractor, booking=booking, *args, **kwargs)
+            # The hold covers the most the pricing strategy can charge; the
+            # winner is refunded what its price leaves over.
+            _hold = get_strategy().hold(booking.total_cost, _bid.total_cost)
+            # Reserving takes the contractor's row lock until commit, so
+            # concurrent bids cannot spend the same credits twice.
+            if not contractor.reserve_balance(_hold):
+                raise ContractorNotEligible('Insufficient credits.')
+            _bid.save()
+
+            _transaction = Transaction(
+                transaction_type=TRANS_TYPE_REDEEM,
+                amount=_hold,
+                contractor=contractor,
+                source_type=TRANS_SOURCE_CONT,
+                target_bid=_bid
+            )
+            _transaction.save()
         return (_bid, _transaction)
 
     @classmethod
@@ -141,18 +190,22 @@ class BiddingManager(object):
         if status not in [BID_STATUS_ACCEPTED,
                           BID_STATUS_EXPIRED, BID_STATUS_REVOKED]:
             raise ValueError('Invalid status.')
-        bid.status = status
-        bid.save()
-
-        _transaction = Transaction.objects.get(target_bid=bid)
-        if status in [BID_STATUS_EXPIRED, BID_STATUS_REVOKED]:
-            _transaction = Transaction.objects.get(
-                target_bid=bid)
-            _transaction.status = TRANS_STATUS_CANCELLED
-            _transaction.comment = 'Bid closed/expired and lost.'
-        elif status == BID_STATUS_ACCEPTED:
-            _transaction.status = TRANS_STATUS_COMMITTED
-        _transaction.save()
+        with transaction.atomic():
+            bid.status = status
+            bid.save()
+
+            _transaction = Transaction.objects.select_for_update().get(
+                target_bid=bid, transaction_type=TRANS_TYPE_REDEEM)
+            _previous_amount = _transaction.ledger_amount
+            if status in [BID_STATUS_EXPIRED, BID_STATUS_REVOKED]:
+                _transaction.status = TRANS_STATUS_CANCELLED
+                _transaction.comment = 'Bid closed/expired and lost.'
+            elif status == BID_STATUS_ACCEPTED:
+                _transaction.status = TRANS_STATUS_COMMITTED
+            _transaction.save()
+            if _transaction.ledger_amount != _previous_amount:
+                bid.contractor.adjust_balance(
+                    _transaction.ledger_amount - _previous_amount)
 
         return (bid, _transaction)
 
@@ -185,60 +238,283 @@ class BiddingManager(object):
             if len(_p) > 0 else eval_bid_from_group(_np)
 
     @classmethod
-    def exec_auction(cls, booking=None):
-        '''Performs a Vickrey auction on the given booking.
-           Returns a 3-ple, winning_bid, second_bid, losing_bids.'''
+    def get_preferred_contractors(cls, booking=None, bid_list=None):
+        '''Resolves which bidders are preferred for the booking's category
+           and postcode with a single query. Returns a set of contractor
+           pks. A contractor with more than one Preferred row for the
+           category is not preferred, matching BidSummary.'''
+        if not booking:
+            raise Exception('First parameter booking is required.')
+        if not bid_list:
+            return set()
+
+        _prefs = {}
+        for _pref in Preferred.objects.filter(
+                category_id=booking.category_id,
+                contractor_id__in=set(_b.contractor_id for _b in bid_list)):
+            _prefs.setdefault(_pref.contractor_id, []).append(_pref)
+        return set(_contractor_id for _contractor_id, _rows in _prefs.items()
+                   if len(_rows) == 1
+                   and _rows[0].in_post_range(booking.post_code))
+
+    @classmethod
+    def settle_auction(cls, winning_bid=None, losing_bids=None, price=None):
+        '''Closes the winning bid as accepted and every losing bid as
+           expired in one atomic block, using bulk updates for the bids,
+           their transactions and the affected balances. The number of
+           queries does not depend on the number of bids. winning_bid may
+           be None when every bid is to expire. If price is given and the
+           winning bid holds more, the difference is refunded with a
+           committed TRANS_SOURCE_AUCTION Transaction on the winning bid.'''
+        if not winning_bid and not losing_bids:
+            raise Exception('First parameter winning_bid is required.')
+        losing_bids = losing_bids or []
+        _winner_pks = [winning_bid.pk] if winning_bid else []
+        _loser_pks = [_bid.pk for _bid in losing_bids]
+
+        with transaction.atomic():
+            _transactions = list(Transaction.objects.select_for_update()
+                                 .filter(target_bid_id__in=_winner_pks +
+                                         _loser_pks))
+
+            if winning_bid:
+                Bid.objects.filter(pk=winning_bid.pk).update(
+                    status=BID_STATUS_ACCEPTED)
+                Transaction.objects.filter(target_bid_id=winning_bid.pk)\
+                    .update(status=TRANS_STATUS_COMMITTED)
+            if _loser_pks:
+                Bid.objects.filter(pk__in=_loser_pks).update(
+                    status=BID_STATUS_EXPIRED)
+                Transaction.objects.filter(target_bid_id__in=_loser_pks)\
+                    .update(status=TRANS_STATUS_CANCELLED,
+                            comment='Bid closed/expired and lost.')
+
+            _adjustments = {}
+            _refunds = []
+            for _transaction in _transactions:
+                _previous_amount = _transaction.ledger_amount
+                _transaction.status = TRANS_STATUS_COMMITTED\
+                    if _transaction.target_bid_id in _winner_pks\
+                    else TRANS_STATUS_CANCELLED
+                _delta = _transaction.ledger_amount - _previous_amount
+                if _transaction.target_bid_id in _winner_pks and \
+                        price is not None and _transaction.amount > price:
+                    _refunds.append(Transaction(
+                        transaction_type=TRANS_TYPE_BUY,
+                        amount=_transaction.amount - price,
+                        contractor_id=_transaction.contractor_id,
+                        source_type=TRANS_SOURCE_AUCTION,
+                        target_bid_id=_transaction.target_bid_id,
+                        status=TRANS_STATUS_COMMITTED,
+                        comment='Refund of the hold above the price of %s '
+                                'in the auction of booking %s.' % (
+                                    price, winning_bid.booking_id)))
+                    _delta += _transaction.amount - price
+                if _delta and _transaction.contractor_id:
+                    _adjustments[_transaction.contractor_id] = \
+                        _adjustments.get(_transaction.contractor_id, 0) + \
+                        _delta
+            Transaction.objects.bulk_create(_refunds)
+            Contractor.objects.adjust_balances(_adjustments)
+            invalidate_contractors(
+                [_bid.contractor_id for _bid in losing_bids] +
+                ([winning_bid.contractor_id] if winning_bid else []))
+
+        if winning_bid:
+            winning_bid.status = BID_STATUS_ACCEPTED
+        for _bid in losing_bids:
+            _bid.status = BID_STATUS_EXPIRED
+        return (winning_bid, losing_bids)
+
+    @classmethod
+    def exec_auction(cls, booking=None, strategy=None):
+        '''Runs the auction of the given booking's active bids with a
+           pricing strategy, by default the one named by
+           BOOKING_AUCTION_PRICING, and marks it settled. The winner pays
+           the strategy's price, set on its summary. Bids, Preferred rows
+           and transactions are loaded and settled in a fixed number of
+           queries. A booking without bids just closes, and a cancelled or
+           completed one, or one without a bid meeting the strategy's
+           reserve, expires its bids. Raises AuctionClosed if the auction is
+           already settled.
+           Returns a 3-ple, winning_bid, second_bid, losing_bids; the bids
+           that are missing are None.'''
 
         if not booking:
             raise Exception('First parameter booking is required.')
 
-        _bids = [BidSummary(booking, _bid) for _bid in booking.bids.all()]
-        _winning_bid = cls.get_winning_bid(_bids)
-        #Philipp: close winning-bid, Alerts?:
-        cls.close_bid(bid=_winning_bid.bid, status=BID_STATUS_ACCEPTED)
-        _bids.remove(_winning_bid)
-        #Philipp: close non-winning-bids, Alerts?:
-        for _bid in _bids:
-            cls.close_bid(bid=_bid.bid, status=BID_STATUS_EXPIRED)
-        _second_bid = cls.get_winning_bid(_bids)
-        _bids.remove(_second_bid)
-        print "Winner: %s" % (_winning_bid.__unicode__())
-        print "2nd: %s" % (_second_bid.__unicode__())
-        print "Lost: %s" % (", ".join([_b.__unicode__() for _b in _bids]))
+        with transaction.atomic():
+            # Settling first takes the booking's row lock, so bids placed
+            # concurrently are either seen below or refused.
+            if not Booking.objects.filter(pk=booking.pk).exclude(
+                    auction_status=AUCTION_STATUS_SETTLED).update(
+                    auction_status=AUCTION_STATUS_SETTLED,
+                    auction_claimed_until=None):
+                raise AuctionClosed('Auction already settled.')
+            booking.auction_status = AUCTION_STATUS_SETTLED
+            booking.auction_claimed_until = None
+            # The booking leaves its categories' feeds.
+            invalidate_categories([booking.category_id])
+
+            _active = list(booking.bids.filter(status=BID_STATUS_ACTIVE)
+                           .select_related('contractor__user')
+                           .order_by('pk'))
+            if not _active:
+                logger.info("Booking %d closed without bids.", booking.pk)
+                return (None, None, [])
+            if booking.status != BOOKING_STATUS_ACTIVE or booking.completed:
+                # Nothing left to award; every bidder gets a refund.
+                cls.settle_auction(losing_bids=_active)
+                AlertsManager.send_alerts([
+                    (_bid.contractor, "Booking #%d was withdrawn and your "
+                     "bid has expired." % booking.pk) for _bid in _active])
+                logger.info("Booking %d closed as withdrawn.", booking.pk)
+                return (None, None, [])
+            _preferred = cls.get_preferred_contractors(booking, _active)
+            _bids = [BidSummary(booking, _bid,
+                                preferred=_bid.contractor_id in _preferred)
+                     for _bid in _active]
+            _outcome = (strategy or get_strategy()).run(
+                BidMatrix.from_summaries(_bids), to_cents(booking.total_cost))
+            if not _outcome.sold:
+                cls.settle_auction(losing_bids=_active)
+                AlertsManager.send_alerts([
+                    (_bid.contractor, "No bid on booking #%d met its reserve "
+                     "price and your bid has expired." % booking.pk)
+                    for _bid in _active])
+                logger.info("Booking %d closed below its reserve.",
+                            booking.pk)
+                return (None, None, [])
+            _winning_bid = _bids[_outcome.winner]
+            _winning_bid.price = from_cents(_outcome.price)
+            _second_bid = _bids[_outcome.second] \
+                if _outcome.second is not None else None
+            cls.settle_auction(winning_bid=_winning_bid.bid,
+                               losing_bids=[_b.bid for _b in _bids
+                                            if _b is not _winning_bid],
+                               price=_winning_bid.price)
+            _bids = [_b for _i, _b in enumerate(_bids)
+                     if _i not in (_outcome.winner, _outcome.second)]
+            cls.notify_bidders(booking, _winning_bid, _second_bid, _bids)
+        logger.info("Booking %d winner: %s at %s", booking.pk,
+                    _winning_bid.__unicode__(), _winning_bid.price)
+        if _second_bid:
+            logger.info("Booking %d 2nd: %s", booking.pk,
+                        _second_bid.__unicode__())
+        logger.info("Booking %d lost: %s", booking.pk,
+                    ", ".join([_b.__unicode__() for _b in _bids]))
         return (_winning_bid, _second_bid, _bids)
 
+    @classmethod
+    def notify_bidders(cls, booking, winning_bid, second_bid, losing_bids):
+        '''Alerts every bidder of a closed auction in one bulk write.
+           Emails are queued too if BOOKING_AUCTION_EMAILS is set.'''
+        _alerts = [(winning_bid.bid.contractor,
+                    "You won the auction for booking #%d." % booking.pk)]
+        if second_bid:
+            _alerts.append((second_bid.bid.contractor,
+                            "Your bid on booking #%d came second and has "
+                            "expired." % booking.pk))
+        _alerts.extend((_b.bid.contractor,
+                        "Your bid on booking #%d was not successful and has "
+                        "expired." % booking.pk) for _b in losing_bids)
+        return AlertsManager.send_alerts(_alerts, send_email=getattr(
+            settings, 'BOOKING_AUCTION_EMAILS', False))
+
+    @classmethod
+    def get_settleable_bookings(cls, cutoff=None):
+        '''Returns the active, uncompleted bookings whose auction is still
+           open and closes before cutoff (defaults to now), soonest first.'''
+        return Booking.objects.due(cutoff).filter(
+            status=BOOKING_STATUS_ACTIVE, completed=False)
+
 
 class AlertsManager(object):
     '''Manages creation and sending of alerts.'''
 
     @classmethod
     def send_alert(cls, target=None, body=None, _send_email=False):
-        Alert.create(target=target, body=body)
-        if _send_email:
-            send_mail('Notifcation from Conos',
-                      body, settings.DEFAULT_FROM_EMAIL, [target.user.email])
+        '''Creates the alert. The email, if any, is queued in the same
+           transaction and sent by the drain_outbox command.'''
+        return cls.send_alerts([(target, body)], send_email=_send_email)[0]
+
+    @classmethod
+    def broadcast(cls, targets=None, body=None, send_email=False):
+        '''Sends the same alert to every Agent or Contractor in targets.'''
+        return cls.send_alerts([(_target, body) for _target in targets or []],
+                               send_email=send_email)
+
+    @classmethod
+    def send_alerts(cls, alerts=None, send_email=False):
+        '''Creates an alert for each (target, body) pair with a single
+           bulk_create, bumps the targets' unread counters, and queues the
+           emails, if any, with another. Targets' users should be loaded up
+           front when emailing; users without an email address only get the
+           alert.'''
+        _alerts = []
+        _counts = {}
+        _emails = []
+        for _target, _body in alerts or []:
+            _ttype = Alert.target_type_of(_target)
+            if not _body:
+                raise Exception("Missing body.")
+            _alerts.append(Alert(target=_target.pk, target_type=_ttype,
+                                 body=_body))
+            _key = (_target.pk, _ttype)
+            _counts[_key] = (_target.user_id,
+                             _counts.get(_key, (None, 0))[1] + 1)
+            if send_email and _target.user.email:
+                _emails.append(OutboxMessage(
+                    kind=OUTBOX_KIND_EMAIL, payload=json.dumps({
+                        'subject': 'Notifcation from Conos',
+                        'body': _body,
+                        'from_email': settings.DEFAULT_FROM_EMAIL,
+                        'recipients': [_target.user.email],
+                    })))
+        if not _alerts:
+            return []
+        with transaction.atomic():
+            Alert.objects.bulk_create(_alerts)
+            AlertCounter.increment(_counts)
+            if _emails:
+                OutboxMessage.objects.bulk_create(_emails)
+        return _alerts
 
     @classmethod
     def send_asknicely(cls, consumer=None):
+        '''Queues an AskNicely survey trigger for the consumer.'''
         if not consumer:
             raise Exception("First parameter consumer required.")
         if not isinstance(consumer, Consumer):
             raise Exception("Invalid consumer type.")
 
-        r = requests.post("https://conos.asknice.ly/api/v1/person/trigger",
-                data={
-                    "email": consumer.email_address,
-                    "name": consumer.name,
-                    "addperson": False,
-                    "delayminutes": 0
-                }, headers={
-                    "X-apikey":
-                    "sqDNYMtYQwu6JeDHQnNl4FXvq6k2hP3auB0QNRAWoxC"
-                });
-
-        res = r.json()
-        if not res["success"]:
-            raise Exception("Failed: %s" % (res["msg"]))
+        return OutboxMessage.enqueue(kind=OUTBOX_KIND_ASKNICELY, payload={
+            "email": consumer.email_address,
+            "name": consumer.name,
+            "addperson": False,
+            "delayminutes": 0
+        })
+
+
+class NPSManager(object):
+    '''Records the responses to AskNicely NPS surveys.'''
+
+    @classmethod
+    def record_response(cls, consumer=None, nps_id=None, nps=None):
+        '''Records the consumer's score for the survey response nps_id
+           through NPSRequest.mark_received, which keeps the consumer's
+           running totals. Returns False if the response was already
+           recorded.'''
+        if not consumer:
+            raise Exception('First parameter consumer is required.')
+        if nps_id is None:
+            raise Exception('Second parameter nps_id is required.')
+        if nps is None or not 0 <= nps <= 10:
+            raise ValueError('Invalid score.')
+        with transaction.atomic():
+            _request, _ = NPSRequest.objects.get_or_create(
+                consumer=consumer, nps_id=nps_id)
+            return _request.mark_received(nps)
 
 #Philipp:
 class TransactionManager(object):
@@ -252,13 +528,16 @@ class TransactionManager(object):
             raise AgentNotAuthorized('CREATE', 'TOPUPS')
 
 
-        _transaction = Transaction(
-            transaction_type=TRANS_TYPE_BUY,
-            source_agent=source_agent,
-            contractor=contractor,
-            source_type=TRANS_SOURCE_AGENT,
-            *args,
-            **kwargs
-        )
-        _transaction.save()
+        with transaction.atomic():
+            _transaction = Transaction(
+                transaction_type=TRANS_TYPE_BUY,
+                source_agent=source_agent,
+                contractor=contractor,
+                source_type=TRANS_SOURCE_AGENT,
+                *args,
+                **kwargs
+            )
+            _transaction.save()
+            if contractor and _transaction.ledger_amount:
+                contractor.adjust_balance(_transaction.ledger_amount)
         return (_transaction)
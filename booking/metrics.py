@@ -0,0 +1,158 @@
+'''In-process request metrics. Histograms and counters are kept in memory
+   per worker process and rendered in the Prometheus text format by the
+   metrics view.'''
+import threading
+import time
+from bisect import bisect_left
+
+from django.template.backends.django import DjangoTemplates, Template
+
+# Seconds; the Prometheus client's default buckets.
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1.0,
+                2.5, 5.0, 7.5, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (_name, ("%s" % _value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for _name, _value in labels)
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else "%s" % value
+
+
+class Histogram(object):
+    '''Cumulative bucket counts plus the sum and count of observations.'''
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        _i = bisect_left(self.buckets, value)
+        if _i < len(self.buckets):
+            self.counts[_i] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self):
+        '''Yields (suffix, extra labels, value) in exposition order.'''
+        _cumulative = 0
+        for _bound, _count in zip(self.buckets, self.counts):
+            _cumulative += _count
+            yield '_bucket', [('le', _format_value(_bound))], _cumulative
+        yield '_bucket', [('le', '+Inf')], self.count
+        yield '_sum', [], self.sum
+        yield '_count', [], self.count
+
+
+class MetricsRegistry(object):
+    '''Thread-safe registry of labelled counters and histograms.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+
+    def register(self, name, kind, help_text, buckets=None):
+        with self._lock:
+            self._metrics.setdefault(name, (kind, help_text, buckets, {}))
+
+    def inc(self, name, labels, amount=1):
+        _kind, _help, _buckets, _series = self._metrics[name]
+        _key = tuple(sorted(labels.items()))
+        with self._lock:
+            _series[_key] = _series.get(_key, 0) + amount
+
+    def observe(self, name, labels, value):
+        _kind, _help, _buckets, _series = self._metrics[name]
+        _key = tuple(sorted(labels.items()))
+        with self._lock:
+            if _key not in _series:
+                _series[_key] = Histogram(_buckets)
+            _series[_key].observe(value)
+
+    def reset(self):
+        with self._lock:
+            for _kind, _help, _buckets, _series in self._metrics.values():
+                _series.clear()
+
+    def render(self):
+        '''Returns every metric in the Prometheus text exposition format.'''
+        _lines = []
+        with self._lock:
+            for _name in sorted(self._metrics):
+                _kind, _help, _buckets, _series = self._metrics[_name]
+                _lines.append('# HELP %s %s' % (_name, _help))
+                _lines.append('# TYPE %s %s' % (_name, _kind))
+                for _key in sorted(_series):
+                    if _kind == 'counter':
+                        _lines.append('%s%s %s' % (
+                            _name, _format_labels(_key),
+                            _format_value(_series[_key])))
+                        continue
+                    for _suffix, _extra, _value in _series[_key].samples():
+                        _lines.append('%s%s%s %s' % (
+                            _name, _suffix,
+                            _format_labels(list(_key) + _extra),
+                            _format_value(_value)))
+        return '\n'.join(_lines) + '\n'
+
+
+registry = MetricsRegistry()
+registry.register('booking_requests_total', 'counter',
+                  'Requests served, by view and status code.')
+registry.register('booking_slow_requests_total', 'counter',
+                  'Requests slower than BOOKING_SLOW_REQUEST_MS, by view.')
+registry.register('booking_request_duration_seconds', 'histogram',
+                  'Wall time spent in the view and middleware, by view.',
+                  TIME_BUCKETS)
+registry.register('booking_request_queries', 'histogram',
+                  'Database queries run per request, by view.', QUERY_BUCKETS)
+registry.register('booking_request_db_seconds', 'histogram',
+                  'Time spent in database queries per request, by view.',
+                  TIME_BUCKETS)
+registry.register('booking_request_template_seconds', 'histogram',
+                  'Time spent rendering templates per request, by view.',
+                  TIME_BUCKETS)
+
+
+class _RequestState(threading.local):
+    template_time = None
+
+
+request_state = _RequestState()
+
+
+class InstrumentedTemplate(Template):
+    '''Adds its render time to the current request's template time while
+       RequestMetricsMiddleware is measuring the request.'''
+
+    def render(self, context=None, request=None):
+        if request_state.template_time is None:
+            return super(InstrumentedTemplate, self).render(context, request)
+        _started = time.time()
+        try:
+            return super(InstrumentedTemplate, self).render(context, request)
+        finally:
+            request_state.template_time += time.time() - _started
+
+
+class InstrumentedDjangoTemplates(DjangoTemplates):
+    '''DjangoTemplates backend whose templates report their render time.'''
+
+    def from_string(self, template_code):
+        return InstrumentedTemplate(self.engine.from_string(template_code),
+                                    self)
+
+    def get_template(self, template_name, *args, **kwargs):
+        _template = super(InstrumentedDjangoTemplates, self).get_template(
+            template_name, *args, **kwargs)
+        return InstrumentedTemplate(_template.template, self)
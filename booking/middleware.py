@@ -0,0 +1,136 @@
+import logging
+import random
+import time
+
+from django.conf import settings
+from django.db import connections
+
+from booking.metrics import registry, request_state
+
+logger = logging.getLogger('booking.slow_requests')
+
+SLOW_REQUEST_MS = getattr(settings, 'BOOKING_SLOW_REQUEST_MS', 500)
+SLOW_REQUEST_SAMPLE_RATE = getattr(settings,
+                                   'BOOKING_SLOW_REQUEST_SAMPLE_RATE', 0.1)
+
+
+class QueryTally(object):
+    '''Query count and time of the current request on one connection, and
+       the statements themselves while statements is a list.'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, keep_statements=False):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = [] if keep_statements else None
+
+    def add(self, sql, seconds):
+        self.count += 1
+        self.seconds += seconds
+        if self.statements is not None:
+            self.statements.append((sql, seconds))
+
+
+class CountingCursor(object):
+    '''Wraps a connection's cursor to add each statement to a QueryTally.
+       Unlike Django's debug cursor it neither formats nor logs the SQL.'''
+
+    def __init__(self, cursor, tally):
+        self.cursor = cursor
+        self.tally = tally
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.cursor.close()
+
+    def execute(self, sql, params=None):
+        _started = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.tally.add(sql, time.time() - _started)
+
+    def executemany(self, sql, param_list):
+        _started = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.tally.add(sql, time.time() - _started)
+
+
+def get_tally(connection):
+    '''Returns the connection's QueryTally, wrapping its cursor() the first
+       time. Connections are per thread and outlive requests.'''
+    _tally = getattr(connection, '_metrics_tally', None)
+    if _tally is None:
+        _tally = connection._metrics_tally = QueryTally()
+        _cursor = connection.cursor
+        connection.cursor = lambda: CountingCursor(_cursor(), _tally)
+    return _tally
+
+
+class RequestMetricsMiddleware(object):
+    '''Records the wall time, query count, query time and template render
+       time of each request, per view, in booking.metrics.registry. Queries
+       are counted by a thin cursor wrapper; their SQL is kept only for the
+       sample of requests that would be logged if slow, and slow ones among
+       those are logged to the booking.slow_requests logger.
+
+       Should come first in MIDDLEWARE_CLASSES so that it times the rest.'''
+
+    def process_request(self, request):
+        request._metrics_started = time.time()
+        request._metrics_sampled = random.random() < SLOW_REQUEST_SAMPLE_RATE
+        for _connection in connections.all():
+            get_tally(_connection).reset(request._metrics_sampled)
+        request_state.template_time = 0.0
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_metrics_started'):
+            return response
+        _elapsed = time.time() - request._metrics_started
+        _count = 0
+        _db_time = 0.0
+        _statements = []
+        for _connection in connections.all():
+            _tally = get_tally(_connection)
+            _count += _tally.count
+            _db_time += _tally.seconds
+            _statements.extend(_tally.statements or [])
+            _tally.reset()
+        _template_time = request_state.template_time or 0.0
+        request_state.template_time = None
+
+        _match = getattr(request, 'resolver_match', None)
+        _view = _match.view_name if _match else '<unresolved>'
+        _labels = {'view': _view}
+        registry.inc('booking_requests_total',
+                     {'view': _view, 'status': response.status_code})
+        registry.observe('booking_request_duration_seconds', _labels,
+                         _elapsed)
+        registry.observe('booking_request_queries', _labels, _count)
+        registry.observe('booking_request_db_seconds', _labels, _db_time)
+        registry.observe('booking_request_template_seconds', _labels,
+                         _template_time)
+
+        if _elapsed * 1000 >= SLOW_REQUEST_MS:
+            registry.inc('booking_slow_requests_total', _labels)
+            if request._metrics_sampled:
+                logger.warning(
+                    "Slow request %s %s (%s): %.0fms, %d queries in %.0fms, "
+                    "templates %.0fms.\n%s", request.method, request.path,
+                    _view, _elapsed * 1000, _count, _db_time * 1000,
+                    _template_time * 1000, '\n'.join(
+                        "[%.3fs] %s" % (_seconds, _sql)
+                        for _sql, _seconds in _statements))
+        return response
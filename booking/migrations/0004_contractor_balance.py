@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 07:05
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Case, F, Sum, Value, When
+
+
+def backfill_balances(apps, schema_editor):
+    Contractor = apps.get_model('booking', 'Contractor')
+    _ledger = dict(transactions__status__in=['trans_status_pending',
+                                             'trans_status_committed'])
+    _balances = Contractor.objects.annotate(ledger_balance=Sum(Case(
+        When(transactions__transaction_type='trans_type_buy',
+             then=F('transactions__amount'), **_ledger),
+        When(transactions__transaction_type='trans_type_redeem',
+             then=Value(0) - F('transactions__amount'), **_ledger),
+        default=Value(0),
+        output_field=models.DecimalField(decimal_places=2, max_digits=10)
+    ))).values_list('pk', 'ledger_balance')
+    for _pk, _balance in _balances:
+        Contractor.objects.filter(pk=_pk).update(balance=_balance or 0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0003_auto_20170219_1151'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contractor',
+            name='balance',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=10),
+        ),
+        migrations.RunPython(backfill_balances, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 07:07
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def copy_post_ranges(apps, schema_editor):
+    PostRange = apps.get_model('booking', 'PostRange')
+    _ranges = []
+    for _model, _owner_field in [('Contractor', 'contractor_id'),
+                                 ('Preferred', 'preferred_id')]:
+        _rows = apps.get_model('booking', _model).objects.values_list(
+            'pk', 'post_ranges_raw')
+        for _pk, _raw in _rows.iterator():
+            try:
+                _post_ranges = json.loads(_raw)
+            except ValueError:
+                continue
+            for _pr in _post_ranges:
+                _ranges.append(PostRange(lower=_pr[0], upper=_pr[1],
+                                         **{_owner_field: _pk}))
+    PostRange.objects.bulk_create(_ranges, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0004_contractor_balance'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PostRange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('lower', models.IntegerField()),
+                ('upper', models.IntegerField()),
+                ('contractor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='post_range_set', to='booking.Contractor')),
+                ('preferred', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='post_range_set', to='booking.Preferred')),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='postrange',
+            index_together=set([('lower', 'upper')]),
+        ),
+        migrations.RunPython(copy_post_ranges, migrations.RunPython.noop),
+    ]
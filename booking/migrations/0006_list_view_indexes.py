@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 07:15
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0005_postrange'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='bid',
+            index_together=set([('created_on', 'id'), ('status', 'created_on', 'id'), ('contractor', 'created_on', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='booking',
+            index_together=set([('created_on', 'id'), ('status', 'created_on', 'id'), ('category', 'created_on', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='transaction',
+            index_together=set([('timestamp', 'id'), ('contractor', 'timestamp', 'id'), ('status', 'timestamp', 'id')]),
+        ),
+    ]
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 07:18
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Inlined rather than imported from booking.indexes, so that this migration
+# keeps creating the indexes as they were at this point in history.
+PARTIAL_INDEXES = [
+    ('booking_booking_open_category', 'booking_booking',
+     'category_id, priority_level',
+     "status = 'booking_status_active' AND NOT completed"),
+    ('booking_bid_active_contractor', 'booking_bid', 'contractor_id',
+     "status = 'bid_status_active'"),
+    ('booking_alert_unread_target', 'booking_alert', 'target, target_type',
+     'NOT is_read'),
+    ('booking_npsrequest_received_consumer', 'booking_npsrequest',
+     'consumer_id', 'is_received'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ['postgresql', 'sqlite']:
+        return
+    for _name, _table, _columns, _condition in PARTIAL_INDEXES:
+        schema_editor.execute('CREATE INDEX %s ON %s (%s) WHERE %s' % (
+            _name, _table, _columns, _condition))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ['postgresql', 'sqlite']:
+        return
+    for _name, _table, _columns, _condition in PARTIAL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % _name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0006_list_view_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='alert',
+            index_together=set([('target', 'target_type', 'is_read')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='bid',
+            index_together=set([('created_on', 'id'), ('contractor', 'status'), ('status', 'created_on', 'id'), ('contractor', 'created_on', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='booking',
+            index_together=set([('category', 'completed', 'status'), ('created_on', 'id'), ('status', 'created_on', 'id'), ('category', 'created_on', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='npsrequest',
+            index_together=set([('consumer', 'is_received')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='transaction',
+            index_together=set([('timestamp', 'id'), ('contractor', 'timestamp', 'id'), ('status', 'timestamp', 'id'), ('contractor', 'status')]),
+        ),
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
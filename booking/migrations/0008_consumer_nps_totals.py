@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 07:23
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def backfill_nps(apps, schema_editor):
+    Consumer = apps.get_model('booking', 'Consumer')
+    NPSRequest = apps.get_model('booking', 'NPSRequest')
+    _totals = NPSRequest.objects.filter(is_received=True).values_list(
+        'consumer').annotate(Sum('nps'), Count('pk')).order_by()
+    for _pk, _sum, _count in _totals:
+        Consumer.objects.filter(pk=_pk).update(nps_sum=_sum,
+                                               nps_count=_count)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0007_hot_filter_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='consumer',
+            name='nps_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='consumer',
+            name='nps_sum',
+            field=models.DecimalField(decimal_places=2, default=0.0, max_digits=12),
+        ),
+        migrations.RunPython(backfill_nps, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 07:27
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+import django.db.models.deletion
+
+
+def backfill_counters(apps, schema_editor):
+    Alert = apps.get_model('booking', 'Alert')
+    AlertCounter = apps.get_model('booking', 'AlertCounter')
+    _users = {
+        'alert_target_agent': dict(apps.get_model('booking', 'Agent')
+                                   .objects.values_list('pk', 'user_id')),
+        'alert_target_cont': dict(apps.get_model('booking', 'Contractor')
+                                  .objects.values_list('pk', 'user_id')),
+    }
+    _unread = Alert.objects.filter(is_read=False).values_list(
+        'target', 'target_type').annotate(Count('pk')).order_by()
+    AlertCounter.objects.bulk_create([
+        AlertCounter(target=_target, target_type=_ttype, unread=_count,
+                     user_id=_users.get(_ttype, {}).get(_target))
+        for _target, _ttype, _count in _unread], batch_size=100)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('booking', '0009_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AlertCounter',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('target', models.IntegerField()),
+                ('target_type', models.CharField(choices=[('alert_target_agent', 'Agent'), ('alert_target_cont', 'Contractor')], max_length=32)),
+                ('unread', models.IntegerField(default=0)),
+                ('user', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AlterIndexTogether(
+            name='alert',
+            index_together=set([('target', 'target_type', 'is_read'), ('target', 'target_type', 'id')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='alertcounter',
+            unique_together=set([('target', 'target_type')]),
+        ),
+        migrations.RunPython(backfill_counters, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 07:35
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0010_alert_counters'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='booking',
+            index_together=set([('category', 'completed', 'status', 'post_code'), ('status', 'created_on', 'id'), ('created_on', 'id'), ('category', 'created_on', 'id')]),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 07:55
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def backfill_auctions(apps, schema_editor):
+    Booking = apps.get_model('booking', 'Booking')
+    Bid = apps.get_model('booking', 'Bid')
+    Booking.objects.update(closes_at=F('preferred_schedule'))
+    # Auctions that already have a winner were settled by exec_auction.
+    Booking.objects.filter(pk__in=Bid.objects.filter(
+        status='bid_status_accepted').values('booking_id')).update(
+        auction_status='auction_status_settled')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0011_qualified_feed_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='booking',
+            name='auction_claimed_until',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='auction_status',
+            field=models.CharField(choices=[('auction_status_open', 'Open'), ('auction_status_closing', 'Closing'), ('auction_status_settled', 'Settled')], default='auction_status_open', max_length=30),
+        ),
+        migrations.AddField(
+            model_name='booking',
+            name='closes_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterIndexTogether(
+            name='booking',
+            index_together=set([('category', 'completed', 'status', 'post_code'), ('status', 'created_on', 'id'), ('created_on', 'id'), ('category', 'created_on', 'id'), ('auction_status', 'closes_at')]),
+        ),
+        migrations.RunPython(backfill_auctions, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# SQLite rebuilds a table to alter it, which drops the partial indexes
+# created by 0007 on booking_alert (0010) and booking_booking (0012). They
+# are recreated here, after every rebuild; the SQL is inlined so that this
+# migration does not change with booking.indexes.
+PARTIAL_INDEXES = [
+    ('booking_booking_open_category', 'booking_booking',
+     'category_id, priority_level',
+     "status = 'booking_status_active' AND NOT completed"),
+    ('booking_bid_active_contractor', 'booking_bid', 'contractor_id',
+     "status = 'bid_status_active'"),
+    ('booking_alert_unread_target', 'booking_alert', 'target, target_type',
+     'NOT is_read'),
+    ('booking_npsrequest_received_consumer', 'booking_npsrequest',
+     'consumer_id', 'is_received'),
+]
+
+
+def recreate_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor not in ['postgresql', 'sqlite']:
+        return
+    for _name, _table, _columns, _condition in PARTIAL_INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % _name)
+        schema_editor.execute('CREATE INDEX %s ON %s (%s) WHERE %s' % (
+            _name, _table, _columns, _condition))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0012_booking_auction_lifecycle'),
+    ]
+
+    operations = [
+        migrations.RunPython(recreate_indexes, migrations.RunPython.noop),
+    ]
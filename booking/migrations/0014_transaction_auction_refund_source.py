@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.13 on 2026-10-18 08:50
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Refunds written by settle_auction before they had their own source type.
+OLD_REFUND = dict(transaction_type='trans_type_buy',
+                  source_type='trans_source_contractor',
+                  target_bid__isnull=False,
+                  comment__startswith='Refund of the hold above the auction')
+
+
+def mark_refunds(apps, schema_editor):
+    Transaction = apps.get_model('booking', 'Transaction')
+    Transaction.objects.filter(**OLD_REFUND).update(
+        source_type='trans_source_auction')
+
+
+def unmark_refunds(apps, schema_editor):
+    Transaction = apps.get_model('booking', 'Transaction')
+    Transaction.objects.filter(source_type='trans_source_auction').update(
+        source_type='trans_source_contractor')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0013_recreate_partial_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='transaction',
+            name='source_type',
+            field=models.CharField(choices=[('trans_source_agent', 'Agent'), ('trans_source_contractor', 'Contractor'), ('trans_source_auction', 'Auction refund')], max_length=30),
+        ),
+        migrations.RunPython(mark_refunds, unmark_refunds),
+    ]
@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+from django.db.models import Count, Min
+
+# SQLite rebuilds booking_npsrequest to add the constraint, which drops its
+# partial index from 0007; it is recreated afterwards, as in 0013.
+PARTIAL_INDEX = ('booking_npsrequest_received_consumer', 'booking_npsrequest',
+                 'consumer_id', 'is_received')
+
+
+def drop_duplicate_requests(apps, schema_editor):
+    '''Keeps one request per (consumer, nps_id): the received one if any,
+       otherwise the oldest.'''
+    NPSRequest = apps.get_model('booking', 'NPSRequest')
+    _duplicates = NPSRequest.objects.values('consumer_id', 'nps_id') \
+        .annotate(_count=Count('pk')).filter(_count__gt=1)
+    for _duplicate in _duplicates:
+        _requests = NPSRequest.objects.filter(
+            consumer_id=_duplicate['consumer_id'],
+            nps_id=_duplicate['nps_id'])
+        _keep = _requests.filter(is_received=True).aggregate(
+            _pk=Min('pk'))['_pk'] or _requests.aggregate(_pk=Min('pk'))['_pk']
+        _requests.exclude(pk=_keep).delete()
+
+
+def recreate_index(apps, schema_editor):
+    if schema_editor.connection.vendor not in ['postgresql', 'sqlite']:
+        return
+    _name, _table, _columns, _condition = PARTIAL_INDEX
+    schema_editor.execute('DROP INDEX IF EXISTS %s' % _name)
+    schema_editor.execute('CREATE INDEX %s ON %s (%s) WHERE %s' % (
+        _name, _table, _columns, _condition))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('booking', '0014_transaction_auction_refund_source'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_duplicate_requests,
+                             migrations.RunPython.noop),
+        migrations.AlterUniqueTogether(
+            name='npsrequest',
+            unique_together=set([('consumer', 'nps_id')]),
+        ),
+        migrations.RunPython(recreate_index, migrations.RunPython.noop),
+    ]
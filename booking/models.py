@@ -2,12 +2,20 @@ from __future__ import unicode_literals
 #Added by Philipp
 from django.conf import settings
 
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import (Case, DecimalField, F, IntegerField, Q, Sum,
+                              Value, When)
+from django.utils import timezone
 from django.contrib.auth.models import User
 from types import ListType, IntType
 
 import json
+from decimal import Decimal
+
+from booking.pagination import DEFAULT_PAGE_SIZE, KeysetPaginator
+from booking.postranges import range_cache
 
 
 
@@ -41,9 +49,11 @@ TRANS_TYPES = (
 )
 TRANS_SOURCE_AGENT = 'trans_source_agent'
 TRANS_SOURCE_CONT = 'trans_source_contractor'
+TRANS_SOURCE_AUCTION = 'trans_source_auction'
 TRANS_SOURCE_TYPES = (
     (TRANS_SOURCE_AGENT, 'Agent'),
-    (TRANS_SOURCE_CONT, 'Contractor')
+    (TRANS_SOURCE_CONT, 'Contractor'),
+    (TRANS_SOURCE_AUCTION, 'Auction refund')
 )
 BOOKING_STATUS_ACTIVE = 'booking_status_active'
 BOOKING_STATUS_RESCHEDULED = 'booking_status_rescheduled'
@@ -53,6 +63,14 @@ BOOKING_STATUSES = (
     (BOOKING_STATUS_RESCHEDULED, 'Rescheduled'),
     (BOOKING_STATUS_CANCELLED, 'Cancelled')
 )
+AUCTION_STATUS_OPEN = 'auction_status_open'
+AUCTION_STATUS_CLOSING = 'auction_status_closing'
+AUCTION_STATUS_SETTLED = 'auction_status_settled'
+AUCTION_STATUSES = (
+    (AUCTION_STATUS_OPEN, 'Open'),
+    (AUCTION_STATUS_CLOSING, 'Closing'),
+    (AUCTION_STATUS_SETTLED, 'Settled')
+)
 BID_STATUS_ACTIVE = 'bid_status_active'
 BID_STATUS_ACCEPTED = 'bid_status_accepted'
 BID_STATUS_EXPIRED = 'bid_status_expired'
@@ -70,12 +88,27 @@ TRANS_STATUSES = (
     (TRANS_STATUS_COMMITTED, 'Committed'),
     (TRANS_STATUS_CANCELLED, 'Cancelled')
 )
+TRANS_LEDGER_STATUSES = [TRANS_STATUS_PENDING, TRANS_STATUS_COMMITTED]
 ALERT_TARGET_AGENT = 'alert_target_agent'
 ALERT_TARGET_CONT = 'alert_target_cont'
 ALERT_TARGET_TYPES = (
     (ALERT_TARGET_AGENT, 'Agent'),
     (ALERT_TARGET_CONT, 'Contractor')
 )
+OUTBOX_KIND_EMAIL = 'outbox_kind_email'
+OUTBOX_KIND_ASKNICELY = 'outbox_kind_asknicely'
+OUTBOX_KINDS = (
+    (OUTBOX_KIND_EMAIL, 'Email'),
+    (OUTBOX_KIND_ASKNICELY, 'AskNicely trigger')
+)
+OUTBOX_STATUS_PENDING = 'outbox_status_pending'
+OUTBOX_STATUS_SENT = 'outbox_status_sent'
+OUTBOX_STATUS_FAILED = 'outbox_status_failed'
+OUTBOX_STATUSES = (
+    (OUTBOX_STATUS_PENDING, 'Pending'),
+    (OUTBOX_STATUS_SENT, 'Sent'),
+    (OUTBOX_STATUS_FAILED, 'Failed')
+)
 
 # Model Definitions
 
@@ -107,34 +140,85 @@ class Agent(models.Model):
     access_level = models.ForeignKey(AccessLevel, null=True, blank=True)
     user = models.ForeignKey(User, related_name="agent")
 
+    @classmethod
+    def permission_cache_key(cls, pk):
+        return 'booking:agent-perms:%d' % pk
+
+    @classmethod
+    def invalidate_permissions(cls, pks):
+        '''Drops the cached effective permissions of the given agent pks.'''
+        cache.delete_many([cls.permission_cache_key(_pk) for _pk in pks])
+
+    @property
+    def effective_permissions(self):
+        '''Returns a frozenset of (action, location) pairs granted to this
+           agent explicitly or through its access level. Loaded with one
+           query and cached on the instance and in Django's cache.'''
+        _perms = getattr(self, '_effective_permissions', None)
+        if _perms is not None:
+            return _perms
+        _key = self.permission_cache_key(self.pk)
+        _perms = cache.get(_key)
+        if _perms is None:
+            _perms = frozenset(Permission.objects.filter(
+                Q(agent=self) | Q(accesslevel__agent=self)
+            ).values_list('action', 'location').distinct())
+            cache.set(_key, _perms, getattr(
+                settings, 'BOOKING_PERMISSION_CACHE_TIMEOUT', 3600))
+        self._effective_permissions = _perms
+        return _perms
+
     def has_perms(self, action, location):
         '''Checks if this agent has the proper access permissions for a given
            action and location.'''
-        for perm_ in self.permissions.all():
-            if (perm_.action == action and perm_.location == location):
-                return True
-        for al_perm_ in self.access_level.default_permissions.all():
-            if (al_perm_.action == action and al_perm_.location == location):
-                return True
-        return False
+        return (action, location) in self.effective_permissions
 
     def __unicode__(self):
         return "%s (%s)" % (self.user.username, self.access_level)
 
 
+class ConsumerQuerySet(models.QuerySet):
+
+    def with_nps(self):
+        '''Annotates nps_total, the sum of the received scores that
+           Consumer.nps returns, from the stored running total without
+           touching NPSRequest.'''
+        return self.annotate(nps_total=F('nps_sum'))
+
+    def with_received_nps(self):
+        '''Annotates received_nps_sum and received_nps_count recomputed from
+           the received NPSRequest rows, using a single aggregate query.'''
+        _received = dict(npsrequest__is_received=True)
+        return self.annotate(
+            received_nps_sum=Sum(Case(
+                When(then=F('npsrequest__nps'), **_received),
+                default=Value(0),
+                output_field=DecimalField(decimal_places=2, max_digits=12))),
+            received_nps_count=Sum(Case(
+                When(then=Value(1), **_received),
+                default=Value(0), output_field=models.IntegerField())))
+
+
 class Consumer(models.Model):
     '''Consumers (end clients).'''
     name = models.CharField(max_length=64)
     phone_number = models.CharField(max_length=32)
     email_address = models.EmailField()
+    # Running totals over the received NPSRequests, maintained by
+    # NPSRequest.mark_received.
+    nps_sum = models.DecimalField(default=0.00, decimal_places=2,
+                                  max_digits=12)
+    nps_count = models.PositiveIntegerField(default=0)
+
+    objects = ConsumerQuerySet.as_manager()
 
     def __unicode__(self):
         return "%s - (%s)" % (self.name, self.phone_number)
 
     @property
     def nps(self):
-        nps_reqs = NPSRequest.objects.filter(consumer=self, is_received=True)
-        return reduce(lambda x, y: x + y.nps, nps_reqs, 0.00)
+        '''Sum of the received NPS scores, kept as a running total.'''
+        return self.nps_sum
 
     #Added by Philipp
 
@@ -157,15 +241,57 @@ class SubType(models.Model):
     def __unicode__(self):
         return self.name
 
+class ContractorQuerySet(models.QuerySet):
+
+    def with_ledger_balance(self):
+        '''Annotates ledger_balance, the balance derived from the pending and
+           committed transactions, using a single aggregate query.'''
+        _ledger = dict(transactions__status__in=TRANS_LEDGER_STATUSES)
+        return self.annotate(ledger_balance=Sum(Case(
+            When(transactions__transaction_type=TRANS_TYPE_BUY,
+                 then=F('transactions__amount'), **_ledger),
+            When(transactions__transaction_type=TRANS_TYPE_REDEEM,
+                 then=Value(0) - F('transactions__amount'), **_ledger),
+            default=Value(0),
+            output_field=DecimalField(decimal_places=2, max_digits=10)
+        )))
+
+    def adjust_balances(self, amounts):
+        '''Applies a {contractor_pk: amount} mapping of balance adjustments
+           in a single UPDATE.'''
+        if not amounts:
+            return 0
+        return self.filter(pk__in=amounts.keys()).update(balance=Case(
+            *[When(pk=_pk, then=F('balance') + _amount)
+              for _pk, _amount in amounts.items()],
+            output_field=DecimalField(decimal_places=2, max_digits=10)
+        ))
+
+    def serving(self, post_code, category=None):
+        '''Contractors whose post ranges contain post_code, optionally
+           limited to a category. Resolved in SQL via PostRange.'''
+        _qs = self.filter(post_range_set__lower__lte=post_code,
+                          post_range_set__upper__gte=post_code)
+        if category:
+            _qs = _qs.filter(categories=category)
+        return _qs.distinct()
+
+
 class Contractor(models.Model):        
     '''Contractors. Authenticates via built-in Django
-       user class. Uses a Json-serialized list to store post_ranges.'''
+       user class. Uses a Json-serialized list to store post_ranges.
+       The balance is materialized from the transaction ledger and kept
+       in sync by the managers.'''
     name = models.CharField(max_length=128, unique=True)
     categories = models.ManyToManyField(Category, blank=True)
     phone_number = models.CharField(max_length=32)
     post_ranges_raw = models.CharField(max_length=128, default="[]")
     active = models.BooleanField(default=True)
     user = models.ForeignKey(User, related_name="contractor")
+    balance = models.DecimalField(default=0.00, decimal_places=2,
+                                  max_digits=10)
+
+    objects = ContractorQuerySet.as_manager()
 
     def __unicode__(self):
         return self.name
@@ -173,16 +299,25 @@ class Contractor(models.Model):
     @property
     def credits(self):
         '''Returns contractor's outstanding balance.'''
-        def evaluate_transactions(collector, next_transaction):
-            if (next_transaction.transaction_type == TRANS_TYPE_BUY):
-                return collector + float(next_transaction.amount)
-            elif (next_transaction.transaction_type == TRANS_TYPE_REDEEM):
-                return collector - float(next_transaction.amount)
-        _transactions = self.transactions.filter(
-            status__in=[TRANS_STATUS_PENDING, TRANS_STATUS_COMMITTED]
-        )
-
-        return reduce(evaluate_transactions, _transactions, 0.00)
+        return self.balance
+
+    def adjust_balance(self, amount):
+        '''Adds amount (negative to deduct) to the stored balance with a
+           single UPDATE. Callers are expected to be inside the same
+           transaction as the ledger write.'''
+        Contractor.objects.filter(pk=self.pk).update(
+            balance=F('balance') + amount)
+        self.refresh_from_db(fields=['balance'])
+
+    def reserve_balance(self, amount):
+        '''Deducts amount from the stored balance only if the balance covers
+           it, using one conditional UPDATE so the check and the write are
+           atomic under concurrent callers. Returns True on success.'''
+        _reserved = Contractor.objects.filter(
+            pk=self.pk, balance__gte=amount
+        ).update(balance=F('balance') - amount)
+        self.refresh_from_db(fields=['balance'])
+        return _reserved == 1
 
     @property
     def post_ranges(self):
@@ -208,16 +343,16 @@ class Contractor(models.Model):
                 raise Exception(
                     "post_ranges must contain lists of 2 Integers.")
         self.post_ranges_raw = json.dumps(post_ranges)
-        return self.save()
+        with transaction.atomic():
+            _result = self.save()
+            PostRange.replace_ranges(self, post_ranges)
+        range_cache.invalidate(self)
+        return _result
 
     def in_post_range(self, post_code):
-        '''Returns a Boolean value if post_code is within post_ranges.'''
-        post_ranges = self.post_ranges
-        for _pr in post_ranges:
-            #Philipp: _pr[1]->_pr[1]+1, otherwise unintuitive
-            if post_code in range(_pr[0], _pr[1]+1):
-                return True
-        return False
+        '''Returns a Boolean value if post_code is within post_ranges.
+           Ranges are inclusive and looked up in the compiled range cache.'''
+        return post_code in range_cache.get(self)
 
     #Added by Philipp
     def get_absolute_url(self):
@@ -231,6 +366,49 @@ class Suburb(models.Model):
         return self.name
 
 
+class BookingQuerySet(models.QuerySet):
+
+    def open(self):
+        '''Bookings still taking bids, by the rule of
+           Booking.accepting_bids.'''
+        return self.filter(
+            Q(closes_at__isnull=True) | Q(closes_at__gt=timezone.now()),
+            status=BOOKING_STATUS_ACTIVE, completed=False,
+            auction_status=AUCTION_STATUS_OPEN)
+
+    def due(self, now=None):
+        '''Bookings with an open auction past closes_at, soonest first,
+           which the (auction_status, closes_at) index serves in order.
+           Cancelled and completed bookings are included so that their
+           auctions are closed too.'''
+        return self.filter(
+            auction_status=AUCTION_STATUS_OPEN,
+            closes_at__lte=now or timezone.now()
+        ).order_by('closes_at', 'pk')
+
+    def lapsed(self, now=None):
+        '''Bookings left closing by a closer whose claim has run out.'''
+        return self.filter(
+            auction_status=AUCTION_STATUS_CLOSING,
+            auction_claimed_until__lte=now or timezone.now()
+        ).order_by('closes_at', 'pk')
+
+    def qualified_for(self, contractor):
+        '''Open bookings in one of contractor's categories whose post_code
+           lies in its post ranges. The categories are a subquery and the
+           merged ranges become post_code BETWEEN terms, so this is a single
+           query over the (category, completed, status, post_code) index.'''
+        _ranges = range_cache.get(contractor)
+        if not len(_ranges):
+            return self.none()
+        _post_codes = Q()
+        for _lower, _upper in zip(_ranges.lowers, _ranges.uppers):
+            _post_codes |= Q(post_code__range=(_lower, _upper))
+        return self.open().filter(
+            _post_codes, category__in=Contractor.categories.through.objects
+            .filter(contractor_id=contractor.pk).values('category_id'))
+
+
 class Booking(models.Model):
     '''Core booking model. Contains all info about bookings.'''
     consumer = models.ForeignKey(Consumer)
@@ -246,8 +424,8 @@ class Booking(models.Model):
     subtypes = models.ManyToManyField(SubType, blank=True) #null added by Philipp (otherwise remove from queryset not possible)
     created_on = models.DateTimeField(auto_now_add=True)
     quoted_price = models.DecimalField(decimal_places=2, max_digits=6)
-    cost_adjustment = models.DecimalField(default=0.00, decimal_places=2,
-                                          max_digits=6)
+    cost_adjustment = models.DecimalField(default=Decimal('0.00'),
+                                          decimal_places=2, max_digits=6)
     base_cost = models.DecimalField(decimal_places=2, max_digits=6)
     priority_level = models.IntegerField()
     completed = models.BooleanField(default=False)
@@ -255,15 +433,62 @@ class Booking(models.Model):
     comment_private = models.TextField(max_length=1000, null=True, blank=True)
     comment_public = models.TextField(max_length=1000, null=True, blank=True)
     link = models.ForeignKey('booking', null=True, blank=True)
+    auction_status = models.CharField(choices=AUCTION_STATUSES, max_length=30,
+                                      default=AUCTION_STATUS_OPEN)
+    # Bids are taken until closes_at, which defaults to preferred_schedule.
+    closes_at = models.DateTimeField(null=True, blank=True)
+    # Set while a closer holds the auction, so a crashed one is retried.
+    auction_claimed_until = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        # Keyset pagination of the list views, optionally filtered.
+        index_together = [
+            ('created_on', 'id'),
+            ('status', 'created_on', 'id'),
+            ('category', 'created_on', 'id'),
+            # Open bookings per category, and per postcode within it for
+            # the qualified bookings feed.
+            ('category', 'completed', 'status', 'post_code'),
+            # Due auctions.
+            ('auction_status', 'closes_at'),
+        ]
+
+    objects = BookingQuerySet.as_manager()
+
+    # Most urgent first, then soonest.
+    FEED_ORDERING = ('-priority_level', 'preferred_schedule', 'pk')
 
     def __unicode__(self):
         return "%s: %s (%.2f)" % (self.created_on, self.consumer.name,
                                   self.quoted_price)
 
+    def save(self, *args, **kwargs):
+        if self.closes_at is None:
+            self.closes_at = self.preferred_schedule
+        super(Booking, self).save(*args, **kwargs)
+
     @property
     def total_cost(self):
         return self.base_cost + self.cost_adjustment
 
+    @property
+    def accepting_bids(self):
+        return self.auction_status == AUCTION_STATUS_OPEN and (
+            self.closes_at is None or self.closes_at > timezone.now())
+
+    @classmethod
+    def qualified_feed(cls, contractor=None, cursor=None,
+                       page_size=DEFAULT_PAGE_SIZE):
+        '''Returns a KeysetPage of the open bookings contractor qualifies
+           for, in FEED_ORDERING. Pass the page's next_cursor back in to
+           fetch the following page.'''
+        if not contractor:
+            raise Exception('Parameter contractor is required.')
+        _bookings = cls.objects.qualified_for(contractor).select_related(
+            'consumer', 'category', 'suburb')
+        return KeysetPaginator(_bookings, cls.FEED_ORDERING,
+                               page_size).page(cursor)
+
     #Added by Philipp
     def get_absolute_url(self):
         return reverse('booking:booking-detail', kwargs = {"pk": self.pk})
@@ -275,12 +500,21 @@ class Bid(models.Model):
     booking = models.ForeignKey(Booking, related_name="bids")
     contractor = models.ForeignKey(Contractor, related_name="bids")
     base_cost = models.DecimalField(decimal_places=2, max_digits=6)
-    premium_adjustment = models.DecimalField(default=0.00, decimal_places=2,
-                                             max_digits=6)
+    premium_adjustment = models.DecimalField(default=Decimal('0.00'),
+                                             decimal_places=2, max_digits=6)
     created_on = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=30, default=BID_STATUS_ACTIVE,
                               choices=BID_STATUSES)
 
+    class Meta:
+        # Keyset pagination of the list views, optionally filtered.
+        index_together = [
+            ('created_on', 'id'),
+            ('status', 'created_on', 'id'),
+            ('contractor', 'created_on', 'id'),
+            ('contractor', 'status'),
+        ]
+
     def __unicode__(self):
         return "[%s] %s -- [%s (%.2f)]" % (self.created_on, self.booking,
                                            self.contractor, self.base_cost)
@@ -310,21 +544,55 @@ class Transaction(models.Model):
                               choices=TRANS_STATUSES)
     comment = models.TextField(max_length=1000, blank=True, null=True)
 
+    class Meta:
+        # Keyset pagination of the list views, optionally filtered.
+        index_together = [
+            ('timestamp', 'id'),
+            ('status', 'timestamp', 'id'),
+            ('contractor', 'timestamp', 'id'),
+            # Ledger and balance aggregates.
+            ('contractor', 'status'),
+        ]
+
     def __unicode__(self):
         return "%s %s (%.2f)" % (self.timestamp, self.transaction_type,
                                  self.amount)
 
+    @property
+    def ledger_amount(self):
+        '''Returns the signed amount this transaction contributes to the
+           contractor's balance in its current status.'''
+        if self.status not in TRANS_LEDGER_STATUSES:
+            return 0
+        if self.transaction_type == TRANS_TYPE_REDEEM:
+            return -self.amount
+        return self.amount
+
     #Added by Philipp
     def get_absolute_url(self):
         return reverse('booking:transaction-detail', kwargs = {"id": self.id})
 
 
+class PreferredQuerySet(models.QuerySet):
+
+    def serving(self, post_code, category=None):
+        '''Preferred entries whose post ranges contain post_code, optionally
+           limited to a category. Resolved in SQL via PostRange.'''
+        _qs = self.filter(post_range_set__lower__lte=post_code,
+                          post_range_set__upper__gte=post_code)
+        if category:
+            _qs = _qs.filter(category=category)
+        return _qs.distinct()
+
+
 class Preferred(models.Model):
     '''Preferred contractors per category per postcode range.'''
     contractor = models.ForeignKey(Contractor)
     category = models.ForeignKey(Category)
     post_ranges_raw = models.CharField(max_length=128, default="[]")
 
+    objects = PreferredQuerySet.as_manager()
+
     @property
     def post_ranges(self):
         '''Retrieves and de-serializes json from post_ranges_raw.'''
@@ -349,16 +617,46 @@ class Preferred(models.Model):
                 raise Exception(
                     "post_ranges must contain lists of 2 Integers.")
         self.post_ranges_raw = json.dumps(post_ranges)
-        return self.save()
+        with transaction.atomic():
+            _result = self.save()
+            PostRange.replace_ranges(self, post_ranges)
+        range_cache.invalidate(self)
+        return _result
 
     def in_post_range(self, post_code):
-        '''Returns a Boolean value if post_code is within post_ranges.'''
-        post_ranges = self.post_ranges
-        for _pr in post_ranges:
-            #Philipp: _pr[1]->_pr[1]+1, otherwise unintuitive
-            if post_code in range(_pr[0], _pr[1]+1):
-                return True
-        return False
+        '''Returns a Boolean value if post_code is within post_ranges.
+           Ranges are inclusive and looked up in the compiled range cache.'''
+        return post_code in range_cache.get(self)
+
+
+class PostRange(models.Model):
+    '''Relational copy of a Contractor's or Preferred's post_ranges, so
+       postcode matching can use an index. Written by set_post_ranges.'''
+    contractor = models.ForeignKey(Contractor, null=True, blank=True,
+                                   related_name='post_range_set')
+    preferred = models.ForeignKey(Preferred, null=True, blank=True,
+                                  related_name='post_range_set')
+    lower = models.IntegerField()
+    upper = models.IntegerField()
+
+    class Meta:
+        index_together = [('lower', 'upper')]
+
+    def __unicode__(self):
+        return "%d-%d" % (self.lower, self.upper)
+
+    @classmethod
+    def replace_ranges(cls, owner=None, post_ranges=None):
+        '''Replaces the ranges stored for owner (a Contractor or Preferred)
+           with post_ranges.'''
+        if not owner:
+            raise Exception("Missing owner.")
+        _owner_field = 'contractor' if isinstance(owner, Contractor)\
+            else 'preferred'
+        owner.post_range_set.all().delete()
+        cls.objects.bulk_create([
+            cls(lower=_pr[0], upper=_pr[1], **{_owner_field: owner})
+            for _pr in post_ranges or []])
 
 
 class Alert(models.Model):
@@ -369,35 +667,136 @@ class Alert(models.Model):
     body = models.TextField(max_length=5000)
     is_read = models.BooleanField(default=False)
 
+    class Meta:
+        index_together = [('target', 'target_type', 'is_read'),
+                          ('target', 'target_type', 'id')]
+
     @classmethod
-    def create(cls, target=None, body=None):
+    def target_type_of(cls, target):
+        '''Validates an alert target and returns its target_type.'''
         if not target:
             raise Exception("Missing target.")
         if (not isinstance(target, Agent)
                 and not isinstance(target, Contractor)):
             raise Exception("Invalid target type.")
+        return ALERT_TARGET_AGENT if isinstance(target, Agent) else\
+            ALERT_TARGET_CONT
+
+    @classmethod
+    def create(cls, target=None, body=None):
+        _ttype = cls.target_type_of(target)
         if not body:
             raise Exception("Missing body.")
 
-        _ttype = ALERT_TARGET_AGENT if isinstance(target, Agent) else\
-                 ALERT_TARGET_CONT
-
-        _alert = cls(target=target.pk, target_type=_ttype, body=body)
-        _alert.save()
+        with transaction.atomic():
+            _alert = cls(target=target.pk, target_type=_ttype, body=body)
+            _alert.save()
+            AlertCounter.increment({(target.pk, _ttype): (target.user_id, 1)})
         return _alert
 
     @classmethod
     def get_alerts(cls, target=None):
-        if not target:
-            raise Exception("Missing target.")
-        if (not isinstance(target, Agent)
-                and not isinstance(target, Contractor)):
-            raise Exception("Invalid target type.")
+        _ttype = cls.target_type_of(target)
+        return cls.objects.filter(target=target.pk, target_type=_ttype)
 
-        _ttype = ALERT_TARGET_AGENT if isinstance(target, Agent) else\
-                 ALERT_TARGET_CONT
+    @classmethod
+    def inbox(cls, target=None, cursor=None, page_size=DEFAULT_PAGE_SIZE,
+              unread_only=False):
+        '''Returns a KeysetPage of the target's alerts, newest first. Pass
+           the page's next_cursor back in to fetch the following page.'''
+        _alerts = cls.get_alerts(target)
+        if unread_only:
+            _alerts = _alerts.filter(is_read=False)
+        return KeysetPaginator(_alerts, ('-pk',), page_size).page(cursor)
 
-        return cls.objects.filter(target=target.pk, target_type=_ttype)
+    @classmethod
+    def mark_read(cls, target=None, ids=None):
+        '''Marks the target's alerts in ids as read with a single UPDATE and
+           decrements its unread counter. Returns the number of alerts that
+           were unread.'''
+        _ttype = cls.target_type_of(target)
+        if not ids:
+            return 0
+        with transaction.atomic():
+            _updated = cls.objects.filter(
+                target=target.pk, target_type=_ttype, pk__in=ids,
+                is_read=False).update(is_read=True)
+            if _updated:
+                AlertCounter.objects.filter(
+                    target=target.pk, target_type=_ttype).update(
+                    unread=F('unread') - _updated)
+        return _updated
+
+    @classmethod
+    def unread_count(cls, target=None):
+        _ttype = cls.target_type_of(target)
+        _unread = AlertCounter.objects.filter(
+            target=target.pk, target_type=_ttype).values_list(
+            'unread', flat=True)[:1]
+        return _unread[0] if _unread else 0
+
+    @classmethod
+    def unread_count_for_user(cls, user):
+        '''Unread alerts across the user's agent and contractor accounts.'''
+        return AlertCounter.objects.filter(user=user).aggregate(
+            unread=Sum('unread'))['unread'] or 0
+
+
+class AlertCounter(models.Model):
+    '''Unread alerts per alert target, maintained when alerts are created
+       and marked read so that badges need not count alerts. user is the
+       target's user, copied here so a user's total is one indexed read,
+       and follows it when the Agent or Contractor is saved with another.'''
+    target = models.IntegerField()
+    target_type = models.CharField(max_length=32, choices=ALERT_TARGET_TYPES)
+    user = models.ForeignKey(User, null=True, blank=True, related_name='+')
+    unread = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('target', 'target_type')
+
+    @classmethod
+    def increment(cls, counts):
+        '''Adds to the unread counters given as a {(target, target_type):
+           (user_id, count)} mapping, creating missing counters, in a fixed
+           number of queries. Must run inside the transaction that creates
+           the alerts.'''
+        if not counts:
+            return
+        _by_type = {}
+        for _target, _ttype in counts:
+            _by_type.setdefault(_ttype, []).append(_target)
+        _query = Q()
+        for _ttype, _targets in _by_type.items():
+            _query |= Q(target_type=_ttype, target__in=_targets)
+
+        _existing = dict(
+            ((_target, _ttype), _pk) for _pk, _target, _ttype in
+            cls.objects.filter(_query).values_list(
+                'pk', 'target', 'target_type'))
+        if _existing:
+            cls.objects.filter(pk__in=_existing.values()).update(
+                unread=Case(*[When(pk=_pk, then=F('unread') +
+                                   counts[_key][1])
+                              for _key, _pk in _existing.items()],
+                            output_field=IntegerField()))
+        _missing = [cls(target=_key[0], target_type=_key[1],
+                        user_id=_user_id, unread=_count)
+                    for _key, (_user_id, _count) in counts.items()
+                    if _key not in _existing]
+        if not _missing:
+            return
+        try:
+            with transaction.atomic():
+                cls.objects.bulk_create(_missing)
+        except IntegrityError:
+            # Another writer created some of the counters meanwhile.
+            for _counter in _missing:
+                if not cls.objects.filter(
+                        target=_counter.target,
+                        target_type=_counter.target_type).update(
+                        unread=F('unread') + _counter.unread):
+                    _counter.save()
 
 
 class NPSRequest(models.Model):
@@ -406,3 +805,55 @@ class NPSRequest(models.Model):
     is_received = models.BooleanField(default=False)
     nps = models.DecimalField(default=0.00, max_digits=5,
                               decimal_places=2)
+
+    def mark_received(self, nps):
+        '''Records the consumer's score and adds it to the consumer's running
+           totals. Returns False if the request was already received.'''
+        # Rounded once, as the nps column stores it, so that the running
+        # total matches a sum over the rows.
+        nps = Decimal("%s" % nps).quantize(Decimal('0.01'))
+        with transaction.atomic():
+            _updated = NPSRequest.objects.filter(
+                pk=self.pk, is_received=False).update(is_received=True,
+                                                      nps=nps)
+            if not _updated:
+                return False
+            Consumer.objects.filter(pk=self.consumer_id).update(
+                nps_sum=F('nps_sum') + nps, nps_count=F('nps_count') + 1)
+        self.is_received = True
+        self.nps = nps
+        return True
+
+    class Meta:
+        index_together = [('consumer', 'is_received')]
+        unique_together = ('consumer', 'nps_id')
+
+
+class OutboxMessage(models.Model):
+    '''Outgoing emails and external API calls, written in the transaction
+       that caused them and delivered later by the drain_outbox command.'''
+    kind = models.CharField(max_length=32, choices=OUTBOX_KINDS)
+    payload = models.TextField()                # JSON
+    status = models.CharField(max_length=32, choices=OUTBOX_STATUSES,
+                              default=OUTBOX_STATUS_PENDING)
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+    sent_on = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = [('status', 'next_attempt_at')]
+
+    def __unicode__(self):
+        return "%s #%s (%s)" % (self.kind, self.pk, self.status)
+
+    @classmethod
+    def enqueue(cls, kind=None, payload=None):
+        if kind not in dict(OUTBOX_KINDS):
+            raise Exception("Invalid outbox message kind.")
+        return cls.objects.create(kind=kind, payload=json.dumps(payload))
+
+    @property
+    def data(self):
+        return json.loads(self.payload)
@@ -0,0 +1,151 @@
+'''Delivery of OutboxMessages. Messages are claimed in batches; emails in a
+   batch share one mail connection and HTTP calls run on a thread pool.
+   Failed messages are retried with exponential backoff until max_attempts,
+   after which they are marked failed.'''
+import json
+import logging
+from datetime import timedelta
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from django.utils.six.moves.urllib.parse import urlencode
+from django.utils.six.moves.urllib.request import Request, urlopen
+
+from booking.models import *
+
+logger = logging.getLogger(__name__)
+
+# Claimed messages are hidden from other workers for this long, so that a
+# crashed worker's batch is picked up again.
+CLAIM_SECONDS = 300
+
+
+def post_asknicely(data, timeout=10):
+    '''Triggers an AskNicely survey. Raises on transport errors and on an
+       unsuccessful API response.'''
+    _request = Request(settings.ASKNICELY_URL, data=urlencode(data),
+                       headers={'X-apikey': settings.ASKNICELY_API_KEY})
+    _response = json.loads(urlopen(_request, timeout=timeout).read())
+    if not _response.get('success'):
+        raise Exception("Failed: %s" % _response.get('msg'))
+
+
+class OutboxWorker(object):
+    '''Drains pending OutboxMessages.'''
+
+    def __init__(self, batch_size=100, workers=4, max_attempts=5,
+                 backoff_seconds=30, max_backoff_seconds=3600):
+        self.batch_size = batch_size
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+
+    def backoff(self, attempts):
+        return timedelta(seconds=min(
+            self.backoff_seconds * 2 ** (attempts - 1),
+            self.max_backoff_seconds))
+
+    def claim(self):
+        '''Returns the next batch of due messages, leased to this worker.'''
+        _now = timezone.now()
+        with transaction.atomic():
+            _messages = list(OutboxMessage.objects.select_for_update().filter(
+                status=OUTBOX_STATUS_PENDING, next_attempt_at__lte=_now
+            ).order_by('next_attempt_at', 'pk')[:self.batch_size])
+            OutboxMessage.objects.filter(
+                pk__in=[_m.pk for _m in _messages]).update(
+                next_attempt_at=_now + timedelta(seconds=CLAIM_SECONDS))
+        return _messages
+
+    def drain(self):
+        '''Delivers batches until no message is due. Returns
+           (sent, retried, failed) counts.'''
+        _totals = [0, 0, 0]
+        while True:
+            _messages = self.claim()
+            if not _messages:
+                return tuple(_totals)
+            for _i, _count in enumerate(self.deliver(_messages)):
+                _totals[_i] += _count
+
+    def deliver(self, messages):
+        '''Delivers a batch and records the outcome of each message.'''
+        _errors = {}
+        _emails = [_m for _m in messages if _m.kind == OUTBOX_KIND_EMAIL]
+        _calls = [_m for _m in messages if _m.kind == OUTBOX_KIND_ASKNICELY]
+        if _emails:
+            _errors.update(self.send_emails(_emails))
+        if _calls:
+            _errors.update(self.send_calls(_calls))
+        return self.record(messages, _errors)
+
+    def send_emails(self, messages):
+        '''Sends the emails over a single connection. Returns
+           {message pk: error}.'''
+        _errors = {}
+        try:
+            _connection = get_connection()
+            _connection.open()
+        except Exception as e:
+            return dict((_m.pk, e) for _m in messages)
+        try:
+            for _message in messages:
+                _data = _message.data
+                try:
+                    EmailMessage(_data['subject'], _data['body'],
+                                 _data.get('from_email'), _data['recipients'],
+                                 connection=_connection).send()
+                except Exception as e:
+                    _errors[_message.pk] = e
+        finally:
+            _connection.close()
+        return _errors
+
+    def send_calls(self, messages):
+        '''Runs the HTTP calls concurrently. Returns {message pk: error}.'''
+        def _call(message):
+            try:
+                post_asknicely(message.data)
+            except Exception as e:
+                return message.pk, e
+            return message.pk, None
+
+        _pool = ThreadPool(max(1, min(self.workers, len(messages))))
+        try:
+            _results = _pool.map(_call, messages)
+        finally:
+            _pool.close()
+            _pool.join()
+        return dict((_pk, _e) for _pk, _e in _results if _e is not None)
+
+    def record(self, messages, errors):
+        _now = timezone.now()
+        _sent = [_m.pk for _m in messages if _m.pk not in errors]
+        _retried = 0
+        _failed = 0
+        with transaction.atomic():
+            OutboxMessage.objects.filter(pk__in=_sent).update(
+                status=OUTBOX_STATUS_SENT, sent_on=_now,
+                attempts=F('attempts') + 1, last_error='')
+            for _message in messages:
+                if _message.pk not in errors:
+                    continue
+                _attempts = _message.attempts + 1
+                _fields = dict(attempts=_attempts,
+                               last_error="%s" % errors[_message.pk])
+                if _attempts >= self.max_attempts:
+                    _fields['status'] = OUTBOX_STATUS_FAILED
+                    _failed += 1
+                else:
+                    _fields['next_attempt_at'] = _now + self.backoff(
+                        _attempts)
+                    _retried += 1
+                logger.warning("Outbox message %d attempt %d failed: %s",
+                               _message.pk, _attempts, errors[_message.pk])
+                OutboxMessage.objects.filter(pk=_message.pk).update(**_fields)
+        return len(_sent), _retried, _failed
@@ -0,0 +1,124 @@
+'''Keyset (seek) pagination for the list views. Pages are addressed by an
+   opaque cursor holding the sort key of the last row shown, so fetching a
+   page costs one indexed range query however deep into the table it is.'''
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils.http import urlencode
+
+DEFAULT_PAGE_SIZE = getattr(settings, 'BOOKING_PAGE_SIZE', 50)
+MAX_PAGE_SIZE = getattr(settings, 'BOOKING_MAX_PAGE_SIZE', 500)
+
+
+class KeysetPage(object):
+    '''A page of rows plus the cursor and query string that fetch the next
+       one.'''
+
+    def __init__(self, object_list, page_size, next_query=None,
+                 next_cursor=None):
+        self.object_list = object_list
+        self.page_size = page_size
+        self.next_query = next_query
+        self.next_cursor = next_cursor
+
+    @property
+    def has_next(self):
+        return self.next_query is not None
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+
+class KeysetPaginator(object):
+    '''Paginates a queryset over ordering, a sequence of field names with an
+       optional '-' prefix for descending order. The last field must be
+       unique (normally 'pk') so that the order is total.'''
+
+    def __init__(self, queryset, ordering, page_size=DEFAULT_PAGE_SIZE):
+        if not ordering or ordering[-1].lstrip('-') not in ['pk', 'id']:
+            raise Exception("ordering must end with the primary key.")
+        self.queryset = queryset
+        self.ordering = list(ordering)
+        self.page_size = max(1, min(page_size, MAX_PAGE_SIZE))
+        self._fields = [
+            queryset.model._meta.pk if _name.lstrip('-') == 'pk' else
+            queryset.model._meta.get_field(_name.lstrip('-'))
+            for _name in self.ordering]
+
+    def encode_cursor(self, obj):
+        _values = [_field.value_to_string(obj) for _field in self._fields]
+        return base64.urlsafe_b64encode(json.dumps(_values))
+
+    def decode_cursor(self, cursor):
+        '''Returns the sort key encoded in cursor, or None if the cursor is
+           malformed.'''
+        try:
+            _values = json.loads(base64.urlsafe_b64decode(str(cursor)))
+            if len(_values) != len(self._fields):
+                return None
+            return [_field.to_python(_value)
+                    for _field, _value in zip(self._fields, _values)]
+        except Exception:
+            return None
+
+    def seek(self, queryset, key):
+        '''Filters queryset to the rows strictly after key in ordering.'''
+        _condition = Q()
+        for _i, _name in enumerate(self.ordering):
+            _lookup = '%s__%s' % (_name.lstrip('-'),
+                                  'lt' if _name.startswith('-') else 'gt')
+            _term = Q(**{_lookup: key[_i]})
+            for _j in range(_i):
+                _term &= Q(**{self.ordering[_j].lstrip('-'): key[_j]})
+            _condition |= _term
+        return queryset.filter(_condition)
+
+    def page(self, cursor=None, params=None):
+        '''Returns the KeysetPage after cursor. params holds the query
+           parameters to carry over into the next page's query string.'''
+        _qs = self.queryset.order_by(*self.ordering)
+        _key = self.decode_cursor(cursor) if cursor else None
+        if _key is not None:
+            _qs = self.seek(_qs, _key)
+        _rows = list(_qs[:self.page_size + 1])
+
+        _next_query = None
+        _next_cursor = None
+        if len(_rows) > self.page_size:
+            _rows = _rows[:self.page_size]
+            _next_cursor = self.encode_cursor(_rows[-1])
+            _params = dict(params or {})
+            _params['cursor'] = _next_cursor
+            _params['page_size'] = self.page_size
+            _next_query = urlencode(sorted(_params.items()))
+        return KeysetPage(_rows, self.page_size, _next_query, _next_cursor)
+
+
+def paginate_request(request, queryset, ordering, filters=None):
+    '''Applies the whitelisted filters found in request.GET and returns the
+       requested KeysetPage. filters maps a query parameter to the lookup it
+       filters on; ids are coerced to int and unusable values are ignored.'''
+    _params = {}
+    for _param, _lookup in (filters or {}).items():
+        _value = request.GET.get(_param)
+        if not _value:
+            continue
+        if _lookup.endswith('_id'):
+            try:
+                _value = int(_value)
+            except ValueError:
+                continue
+        queryset = queryset.filter(**{_lookup: _value})
+        _params[_param] = _value
+
+    try:
+        _page_size = int(request.GET.get('page_size', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        _page_size = DEFAULT_PAGE_SIZE
+    return KeysetPaginator(queryset, ordering, _page_size).page(
+        request.GET.get('cursor'), _params)
@@ -0,0 +1,87 @@
+'''Compiled post_ranges for postcode lookups done in Python, such as the
+   auction hot path. Compiled sets are memoized per owner in an LRU cache.'''
+import threading
+from bisect import bisect_right
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+class CompiledRanges(object):
+    '''Merged, sorted inclusive post ranges stored as parallel lower and
+       upper bound lists, so a lookup is a single bisect.'''
+    __slots__ = ('lowers', 'uppers')
+
+    def __init__(self, post_ranges):
+        _merged = []
+        for _lower, _upper in sorted((_pr[0], _pr[1]) for _pr in post_ranges):
+            if _merged and _lower <= _merged[-1][1] + 1:
+                _merged[-1][1] = max(_merged[-1][1], _upper)
+            else:
+                _merged.append([_lower, _upper])
+        self.lowers = [_pr[0] for _pr in _merged]
+        self.uppers = [_pr[1] for _pr in _merged]
+
+    def __contains__(self, post_code):
+        _i = bisect_right(self.lowers, post_code) - 1
+        return _i >= 0 and post_code <= self.uppers[_i]
+
+    def __len__(self):
+        return len(self.lowers)
+
+
+class RangeCache(object):
+    '''Thread-safe LRU cache of CompiledRanges keyed on the owner's model
+       and pk. The owner's post_ranges_raw serves as the entry's version, and
+       set_post_ranges drops the entry explicitly.'''
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, owner):
+        '''Returns the CompiledRanges for a Contractor or Preferred.'''
+        if owner.pk is None:
+            return CompiledRanges(owner.post_ranges)
+        _key = (owner._meta.label_lower, owner.pk)
+        _version = owner.post_ranges_raw
+        with self._lock:
+            _entry = self._entries.pop(_key, None)
+            if _entry is not None and _entry[0] == _version:
+                self.hits += 1
+                self._entries[_key] = _entry
+                return _entry[1]
+            self.misses += 1
+
+        _compiled = CompiledRanges(owner.post_ranges)
+        with self._lock:
+            self._entries[_key] = (_version, _compiled)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return _compiled
+
+    def invalidate(self, owner):
+        with self._lock:
+            self._entries.pop((owner._meta.label_lower, owner.pk), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+            }
+
+
+range_cache = RangeCache(
+    getattr(settings, 'BOOKING_POST_RANGE_CACHE_SIZE', 1024))
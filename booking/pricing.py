@@ -0,0 +1,128 @@
+'''Auction pricing strategies. A strategy is run over the BidMatrix of an
+   auction's bids and the booking's list price, both in cents, and decides
+   which bid wins and what it pays; BiddingManager.exec_auction settles the
+   outcome. Every strategy ranks bids as BidMatrix.top does, preferred
+   first. A bid holds what its strategy's hold() says, the most the strategy
+   can charge it, so settling only ever refunds the difference; switching
+   strategies while auctions are open charges their winners at most their
+   holds. The strategy used is named by BOOKING_AUCTION_PRICING, by default
+   list_price, which bills as before strategies existed.'''
+from fractions import Fraction
+
+from django.conf import settings
+
+DEFAULT_STRATEGY = getattr(settings, 'BOOKING_AUCTION_PRICING',
+                           'list_price')
+RESERVE_RATIO = getattr(settings, 'BOOKING_AUCTION_RESERVE_RATIO', '1.0')
+
+
+class Outcome(object):
+    '''The matrix rows of the winning and runner-up bids, either of which
+       may be None, and the price the winner pays in cents.'''
+
+    def __init__(self, winner=None, second=None, price=0):
+        self.winner = winner
+        self.second = second
+        self.price = price
+
+    @property
+    def sold(self):
+        return self.winner is not None
+
+
+class PricingStrategy(object):
+    '''Base class. Subclasses set name and implement run.'''
+    name = None
+
+    def run(self, matrix, list_price):
+        '''Returns the Outcome of the auction of matrix's bids.'''
+        raise NotImplementedError
+
+    def hold(self, list_price, cost):
+        '''The credits a bid costing cost holds, in the units given.'''
+        return max(list_price, cost)
+
+    def second_price(self, matrix, top, floor):
+        '''The winner of top pays the runner-up's cost, at most its own and
+           at least floor, or floor when unopposed. The runner-up can cost
+           more than the winner when only the winner is preferred.'''
+        if not top:
+            return Outcome()
+        _winner = top[0]
+        _second = top[1] if len(top) > 1 else None
+        if _second is None:
+            return Outcome(_winner, None, floor)
+        return Outcome(_winner, _second, max(floor, min(
+            matrix.costs[_second], matrix.costs[_winner])))
+
+
+class ListPriceStrategy(PricingStrategy):
+    '''The best bid pays the list price, whatever it bid. Bids hold only
+       the list price.'''
+    name = 'list_price'
+
+    def run(self, matrix, list_price):
+        _top = matrix.top(2)
+        if not _top:
+            return Outcome()
+        return Outcome(_top[0], _top[1] if len(_top) > 1 else None,
+                       list_price)
+
+    def hold(self, list_price, cost):
+        return list_price
+
+
+class FirstPriceStrategy(PricingStrategy):
+    '''The best bid pays what it bid, and at least the list price.'''
+    name = 'first_price'
+
+    def run(self, matrix, list_price):
+        _top = matrix.top(2)
+        if not _top:
+            return Outcome()
+        return Outcome(_top[0], _top[1] if len(_top) > 1 else None,
+                       max(list_price, matrix.costs[_top[0]]))
+
+
+class SecondPriceStrategy(PricingStrategy):
+    '''A Vickrey auction: the best bid pays the runner-up's price, and at
+       least the list price.'''
+    name = 'second_price'
+
+    def run(self, matrix, list_price):
+        return self.second_price(matrix, matrix.top(2), list_price)
+
+
+class ReservePriceStrategy(PricingStrategy):
+    '''A second-price auction among the bids costing at least the reserve,
+       ratio times the list price, which is also the least the winner pays.
+       The booking goes unsold if no bid meets the reserve.'''
+    name = 'reserve_price'
+
+    def __init__(self, ratio=None):
+        self.ratio = Fraction("%s" % (RESERVE_RATIO if ratio is None
+                                      else ratio))
+
+    def reserve(self, list_price):
+        '''The reserve in cents, rounded up, in integer arithmetic.'''
+        return -(-list_price * self.ratio.numerator //
+                 self.ratio.denominator)
+
+    def run(self, matrix, list_price):
+        _reserve = self.reserve(list_price)
+        return self.second_price(matrix, matrix.top(2, min_cost=_reserve),
+                                 _reserve)
+
+
+STRATEGIES = dict((_strategy.name, _strategy) for _strategy in [
+    ListPriceStrategy, FirstPriceStrategy, SecondPriceStrategy,
+    ReservePriceStrategy])
+
+
+def get_strategy(name=None):
+    '''Returns an instance of the named strategy, by default the one named
+       by BOOKING_AUCTION_PRICING.'''
+    _name = name or DEFAULT_STRATEGY
+    if _name not in STRATEGIES:
+        raise Exception('Unknown pricing strategy "%s".' % _name)
+    return STRATEGIES[_name]()
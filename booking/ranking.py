@@ -0,0 +1,142 @@
+'''Ranking of a booking's bids. Bids are held as parallel columns (bid pk,
+   preferred flag, total cost in cents, created_on in microseconds) and
+   ordered preferred first, then highest total cost, then earliest, then
+   lowest pk, which is the order BiddingManager.get_winning_bid applies.
+   Large bid sets are ranked with NumPy when it is installed: a partition
+   picks the candidates and a lexsort orders them. Otherwise, and for small
+   sets where building arrays costs more than it saves, a heap selection in
+   pure Python is used.'''
+import heapq
+from datetime import datetime
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import F, Func, IntegerField
+from django.utils import timezone
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMPY_MIN_BIDS = getattr(settings, 'BOOKING_RANKING_NUMPY_MIN_BIDS', 512)
+
+_EPOCH = datetime(1970, 1, 1)
+
+
+def to_cents(amount):
+    return int((amount * 100).to_integral_value())
+
+
+def from_cents(cents):
+    return (Decimal(cents) / 100).quantize(Decimal('0.01'))
+
+
+def cost_in_cents(adjustment='premium_adjustment'):
+    '''A total cost in cents as a query expression, by default a bid's;
+       pass 'cost_adjustment' for a booking's. Loading it is much cheaper
+       than converting two DecimalFields per row.'''
+    return Func((F('base_cost') + F(adjustment)) * 100,
+                function='ROUND', output_field=IntegerField())
+
+
+def to_microseconds(value):
+    if timezone.is_aware(value):
+        value = timezone.make_naive(value, timezone.utc)
+    _delta = value - _EPOCH
+    return (_delta.days * 86400 + _delta.seconds) * 10 ** 6 + \
+        _delta.microseconds
+
+
+class BidMatrix(object):
+    '''The ranking columns of a set of bids. Row i describes the i-th bid
+       the matrix was built from.'''
+
+    def __init__(self, ids, preferred, costs, created):
+        self.ids = list(ids)
+        self.preferred = list(preferred)
+        self.costs = list(costs)
+        self.created = list(created)
+        self._arrays = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def from_summaries(cls, summaries):
+        '''Builds the matrix of a list of BidSummary.'''
+        return cls([_s.bid.pk for _s in summaries],
+                   [bool(_s.preferred) for _s in summaries],
+                   [to_cents(_s.total_cost) for _s in summaries],
+                   [to_microseconds(_s.created_on) for _s in summaries])
+
+    @classmethod
+    def from_rows(cls, rows, preferred_contractors):
+        '''Builds the matrix of (pk, contractor_id, cost in cents,
+           created_on) rows, as loaded with values_list and cost_in_cents,
+           without creating model instances.'''
+        _ids = []
+        _preferred = []
+        _costs = []
+        _created = []
+        for _pk, _contractor_id, _cents, _created_on in rows:
+            _ids.append(_pk)
+            _preferred.append(_contractor_id in preferred_contractors)
+            # Some backends round to a float.
+            _costs.append(int(_cents))
+            _created.append(to_microseconds(_created_on))
+        return cls(_ids, _preferred, _costs, _created)
+
+    def key(self, i):
+        return (not self.preferred[i], -self.costs[i], self.created[i],
+                self.ids[i])
+
+    def top(self, count=2, engine=None, min_cost=None):
+        '''Returns the row indexes of the count best bids, best first,
+           among those costing at least min_cost cents if it is given.
+           engine forces 'numpy' or 'python'.'''
+        if engine is None:
+            engine = 'numpy' if numpy is not None and \
+                len(self) >= NUMPY_MIN_BIDS else 'python'
+        if engine == 'numpy':
+            return self.top_numpy(count, min_cost)
+        _rows = range(len(self))
+        if min_cost is not None:
+            _rows = [_i for _i in _rows if self.costs[_i] >= min_cost]
+        return heapq.nsmallest(count, _rows, key=self.key)
+
+    def arrays(self):
+        '''Returns the columns as NumPy arrays, built once.'''
+        if self._arrays is None:
+            self._arrays = (numpy.array(self.ids, dtype=numpy.int64),
+                            numpy.array(self.preferred, dtype=bool),
+                            numpy.array(self.costs, dtype=numpy.int64),
+                            numpy.array(self.created, dtype=numpy.int64))
+        return self._arrays
+
+    def top_numpy(self, count=2, min_cost=None):
+        if numpy is None:
+            raise Exception("NumPy is not installed.")
+        if not len(self) or count < 1:
+            return []
+        _ids, _preferred, _costs, _created = self.arrays()
+        # Preferred and cost folded into one key, smallest best; costs are
+        # far below 2 ** 40 cents.
+        _primary = (~_preferred).astype(numpy.int64) * 2 ** 40 - _costs
+        _eligible = _primary
+        if min_cost is not None:
+            _rows = numpy.flatnonzero(_costs >= min_cost)
+            if not len(_rows):
+                return []
+            _eligible = _primary[_rows]
+        # An O(n) partition finds the count-th best key; only the bids up to
+        # it, ties included, need the full lexsort, which sorts by its last
+        # key first.
+        _count = min(count, len(_eligible))
+        _kth = numpy.partition(_eligible, _count - 1)[_count - 1]
+        _candidates = numpy.flatnonzero(_eligible <= _kth)
+        if min_cost is not None:
+            _candidates = _rows[_candidates]
+        _order = numpy.lexsort((_ids[_candidates], _created[_candidates],
+                                _primary[_candidates]))
+        return [int(_i) for _i in _candidates[_order[:count]]]
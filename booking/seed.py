@@ -0,0 +1,273 @@
+'''Synthetic marketplace data for benchmarks. Rows are written with
+   bulk_create in chunks, so seeding millions of rows runs in bounded
+   memory.'''
+import json
+import random
+from datetime import timedelta
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import AutoField
+from django.utils import timezone
+
+from booking.models import *
+from booking.pricing import get_strategy
+
+SEED_PREFIX = 'seed'
+
+
+class MarketplaceSeeder(object):
+    '''Generates agents, consumers, contractors with post ranges,
+       categories, Preferred rows, bookings, bids, the matching ledger,
+       alerts and NPS requests. Volumes scale with the number of bookings
+       unless given explicitly.'''
+
+    def __init__(self, bookings=1000, contractors=None, consumers=None,
+                 categories=8, bids_per_booking=3, batch_size=1000, seed=0,
+                 log=None, strategy=None):
+        self.bookings = bookings
+        self.contractors = contractors or max(bookings // 20, 10)
+        self.consumers = consumers or max(bookings // 4, 10)
+        self.categories = categories
+        self.bids_per_booking = bids_per_booking
+        self.batch_size = batch_size
+        self.random = random.Random(seed)
+        self.log = log or (lambda message: None)
+        # Bids hold what the pricing strategy says, as in place_bid.
+        self.strategy = strategy or get_strategy()
+        self.counts = {}
+
+    def run(self):
+        '''Seeds the database and returns a {model name: rows} dict.'''
+        self.tag = '%s-%d' % (SEED_PREFIX, self.random.randint(0, 10 ** 9))
+        self.seed_reference_data()
+        self.seed_consumers()
+        self.seed_contractors()
+        self.seed_bookings()
+        self.seed_ledger()
+        return self.counts
+
+    def count(self, model, rows):
+        self.counts[model.__name__] = self.counts.get(model.__name__, 0) + rows
+
+    def bulk_create(self, model, objs):
+        '''bulk_creates objs in batches no larger than the backend allows.'''
+        _fields = [_f for _f in model._meta.concrete_fields
+                   if not isinstance(_f, AutoField)]
+        _batch_size = min(self.batch_size, max(
+            connection.ops.bulk_batch_size(_fields, objs), 1))
+        model.objects.bulk_create(objs, batch_size=_batch_size)
+        self.count(model, len(objs))
+
+    def insert(self, model, objs):
+        '''bulk_creates objs and returns their pks in insertion order. Pks
+           are read back because not every backend returns them from a bulk
+           insert; this assumes no concurrent writers on the table.'''
+        _last = model.objects.order_by('-pk').values_list('pk', flat=True)[:1]
+        _last = _last[0] if _last else 0
+        self.bulk_create(model, objs)
+        return list(model.objects.filter(pk__gt=_last).order_by('pk')
+                    .values_list('pk', flat=True))
+
+    def make_users(self, kind, number):
+        return self.insert(User, [
+            User(username='%s-%s-%d' % (self.tag, kind, _i),
+                 email='%s-%d@example.com' % (kind, _i))
+            for _i in range(number)])
+
+    def seed_reference_data(self):
+        self.category_pks = self.insert(Category, [
+            Category(name='%s category %d' % (self.tag, _i))
+            for _i in range(self.categories)])
+        self.suburb_pks = self.insert(Suburb, [
+            Suburb(name='Suburb %d' % _i) for _i in range(20)])
+        self.subtype_pks = self.insert(SubType, [
+            SubType(name='%s subtype %d' % (self.tag, _i)) for _i in range(5)])
+
+        _access_level = AccessLevel.objects.create(name='%s agents' % self.tag)
+        _access_level.default_permissions.add(*[
+            Permission.objects.get_or_create(action=_action,
+                                             location=_location)[0]
+            for _action, _ in PERM_ACTIONS
+            for _location, _ in PERM_LOCATIONS])
+        self.agent_pks = self.insert(Agent, [
+            Agent(access_level=_access_level, user_id=_user_pk)
+            for _user_pk in self.make_users('agent', 10)])
+        self.log("Seeded reference data.")
+
+    def seed_consumers(self):
+        self.consumer_pks = []
+        for _start in range(0, self.consumers, self.batch_size):
+            _size = min(self.batch_size, self.consumers - _start)
+            _scores = []
+            for _ in range(_size):
+                _scores.append([self.random.randint(0, 10)
+                                if self.random.random() < 0.7 else None
+                                for _ in range(self.random.randint(0, 3))])
+            _consumer_pks = self.insert(Consumer, [
+                Consumer(name='Consumer %d' % (_start + _i),
+                         phone_number='04%08d' % (_start + _i),
+                         email_address='consumer%d@example.com' %
+                         (_start + _i),
+                         nps_sum=sum(_score for _score in _scores[_i]
+                                     if _score is not None),
+                         nps_count=len([_score for _score in _scores[_i]
+                                        if _score is not None]))
+                for _i in range(_size)])
+            _nps = []
+            for _pk, _consumer_scores in zip(_consumer_pks, _scores):
+                # Survey response ids are unique per consumer.
+                for _nps_id, _score in enumerate(_consumer_scores, 1):
+                    _nps.append(NPSRequest(
+                        consumer_id=_pk, nps_id=_nps_id,
+                        is_received=_score is not None,
+                        nps=_score or 0))
+            self.bulk_create(NPSRequest, _nps)
+            self.consumer_pks.extend(_consumer_pks)
+        self.log("Seeded %d consumers." % len(self.consumer_pks))
+
+    def random_post_ranges(self):
+        _ranges = []
+        for _ in range(self.random.randint(1, 3)):
+            _lower = self.random.randint(2000, 7900)
+            _ranges.append([_lower, _lower + self.random.randint(0, 99)])
+        return _ranges
+
+    def seed_contractors(self):
+        _user_pks = self.make_users('contractor', self.contractors)
+        _post_ranges = [self.random_post_ranges() for _ in _user_pks]
+        self.contractor_pks = self.insert(Contractor, [
+            Contractor(name='%s contractor %d' % (self.tag, _i),
+                       phone_number='04%08d' % _i, user_id=_user_pk,
+                       post_ranges_raw=json.dumps(_post_ranges[_i]))
+            for _i, _user_pk in enumerate(_user_pks)])
+
+        self.contractors_by_category = dict(
+            (_pk, []) for _pk in self.category_pks)
+        _memberships = []
+        _ranges = []
+        _preferred = []
+        _preferred_ranges = []
+        _through = Contractor.categories.through
+        for _contractor_pk, _post_range in zip(self.contractor_pks,
+                                               _post_ranges):
+            for _category_pk in self.random.sample(
+                    self.category_pks, self.random.randint(1, 3)):
+                _memberships.append(_through(contractor_id=_contractor_pk,
+                                             category_id=_category_pk))
+                self.contractors_by_category[_category_pk].append(
+                    _contractor_pk)
+                if self.random.random() < 0.1:
+                    _preferred.append(Preferred(
+                        contractor_id=_contractor_pk,
+                        category_id=_category_pk,
+                        post_ranges_raw=json.dumps(_post_range)))
+                    _preferred_ranges.append(_post_range)
+            _ranges.extend(PostRange(contractor_id=_contractor_pk,
+                                     lower=_pr[0], upper=_pr[1])
+                           for _pr in _post_range)
+        self.bulk_create(_through, _memberships)
+        for _preferred_pk, _post_range in zip(
+                self.insert(Preferred, _preferred), _preferred_ranges):
+            _ranges.extend(PostRange(preferred_id=_preferred_pk,
+                                     lower=_pr[0], upper=_pr[1])
+                           for _pr in _post_range)
+        self.bulk_create(PostRange, _ranges)
+
+        _alerts = [Alert(target=_pk, target_type=ALERT_TARGET_CONT,
+                         body='Seeded alert', is_read=self.random.random() < 0.8)
+                   for _pk in self.contractor_pks
+                   for _ in range(self.random.randint(0, 5))]
+        self.bulk_create(Alert, _alerts)
+        _unread = {}
+        for _alert in _alerts:
+            if not _alert.is_read:
+                _unread[_alert.target] = _unread.get(_alert.target, 0) + 1
+        _users = dict(zip(self.contractor_pks, _user_pks))
+        self.bulk_create(AlertCounter, [
+            AlertCounter(target=_pk, target_type=ALERT_TARGET_CONT,
+                         user_id=_users[_pk], unread=_count)
+            for _pk, _count in _unread.items()])
+        self.log("Seeded %d contractors." % len(self.contractor_pks))
+
+    def seed_bookings(self):
+        self.redeemed = dict((_pk, Decimal(0)) for _pk in self.contractor_pks)
+        _now = timezone.now()
+        for _start in range(0, self.bookings, self.batch_size):
+            _size = min(self.batch_size, self.bookings - _start)
+            _bookings = []
+            for _ in range(_size):
+                _base_cost = Decimal(self.random.randint(10, 60))
+                _bookings.append(Booking(
+                    consumer_id=self.random.choice(self.consumer_pks),
+                    address_1='%d Seed St' % self.random.randint(1, 999),
+                    suburb_id=self.random.choice(self.suburb_pks),
+                    agent_id=self.random.choice(self.agent_pks),
+                    post_code=self.random.randint(2000, 7999),
+                    preferred_schedule=_now + timedelta(
+                        hours=self.random.randint(-24 * 30, 24 * 30)),
+                    category_id=self.random.choice(self.category_pks),
+                    quoted_price=_base_cost * 3,
+                    base_cost=_base_cost,
+                    priority_level=self.random.randint(1, 5),
+                    completed=self.random.random() < 0.3,
+                    status=self.random.choice(
+                        [BOOKING_STATUS_ACTIVE] * 8 +
+                        [BOOKING_STATUS_RESCHEDULED,
+                         BOOKING_STATUS_CANCELLED])))
+                _bookings[-1].closes_at = _bookings[-1].preferred_schedule
+            with transaction.atomic():
+                _booking_pks = self.insert(Booking, _bookings)
+                self.seed_bids(zip(_booking_pks, _bookings))
+            self.log("Seeded %d/%d bookings." % (_start + _size,
+                                                 self.bookings))
+
+    def seed_bids(self, bookings):
+        _bids = []
+        _costs = []
+        for _booking_pk, _booking in bookings:
+            _candidates = self.contractors_by_category[_booking.category_id]
+            _number = min(len(_candidates), self.random.randint(
+                0, self.bids_per_booking * 2))
+            for _contractor_pk in self.random.sample(_candidates, _number):
+                _bids.append(Bid(
+                    booking_id=_booking_pk, contractor_id=_contractor_pk,
+                    base_cost=_booking.base_cost +
+                    self.random.randint(0, 20)))
+                _costs.append(self.strategy.hold(_booking.total_cost,
+                                                 _bids[-1].total_cost))
+        _transactions = []
+        for _bid_pk, _bid, _cost in zip(self.insert(Bid, _bids), _bids,
+                                        _costs):
+            _transactions.append(Transaction(
+                transaction_type=TRANS_TYPE_REDEEM, amount=_cost,
+                contractor_id=_bid.contractor_id,
+                source_type=TRANS_SOURCE_CONT, target_bid_id=_bid_pk))
+            self.redeemed[_bid.contractor_id] += _cost
+        self.bulk_create(Transaction, _transactions)
+
+    def seed_ledger(self):
+        '''Tops every contractor up to cover its bids, and stores the
+           resulting balance.'''
+        _topups = []
+        _balances = {}
+        for _contractor_pk, _redeemed in self.redeemed.items():
+            _amount = _redeemed + self.random.randint(0, 500)
+            _balances[_contractor_pk] = _amount - _redeemed
+            # Transaction.amount holds at most 9999.99.
+            while _amount > 0:
+                _topup = min(_amount, Decimal('9999.00'))
+                _topups.append(Transaction(
+                    transaction_type=TRANS_TYPE_BUY, amount=_topup,
+                    source_agent_id=self.random.choice(self.agent_pks),
+                    contractor_id=_contractor_pk,
+                    source_type=TRANS_SOURCE_AGENT,
+                    status=TRANS_STATUS_COMMITTED))
+                _amount -= _topup
+        self.bulk_create(Transaction, _topups)
+        with transaction.atomic():
+            for _contractor_pk, _balance in _balances.items():
+                Contractor.objects.filter(pk=_contractor_pk).update(
+                    balance=_balance)
+        self.log("Seeded the ledger.")
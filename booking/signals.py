@@ -0,0 +1,133 @@
+from django.db.models.signals import m2m_changed, post_delete, post_init,\
+    post_save, pre_delete
+from django.dispatch import receiver
+
+from booking.dashboard import invalidate_categories, invalidate_contractors
+from booking.models import AccessLevel, Agent, Alert, AlertCounter, Bid, \
+    Booking, Contractor, Permission, Preferred, Transaction
+
+
+def _agents_holding(permission_pks):
+    '''Pks of agents granted any of the permissions, directly or through
+       their access level.'''
+    _direct = Agent.objects.filter(permissions__in=permission_pks)
+    _implied = Agent.objects.filter(
+        access_level__default_permissions__in=permission_pks)
+    return set(_direct.values_list('pk', flat=True)) |\
+        set(_implied.values_list('pk', flat=True))
+
+
+@receiver(m2m_changed, sender=Agent.permissions.through)
+def agent_permissions_changed(sender, instance, action, reverse, pk_set,
+                              **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear', 'post_clear']:
+        return
+    if not reverse:
+        instance.__dict__.pop('_effective_permissions', None)
+        Agent.invalidate_permissions([instance.pk])
+    elif pk_set:
+        Agent.invalidate_permissions(pk_set)
+    elif action == 'pre_clear':
+        Agent.invalidate_permissions(_agents_holding([instance.pk]))
+
+
+@receiver(m2m_changed, sender=AccessLevel.default_permissions.through)
+def access_level_permissions_changed(sender, instance, action, reverse,
+                                     pk_set, **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear', 'post_clear']:
+        return
+    if not reverse:
+        _agents = Agent.objects.filter(access_level=instance)
+    elif pk_set:
+        _agents = Agent.objects.filter(access_level__in=pk_set)
+    elif action == 'pre_clear':
+        _agents = Agent.objects.filter(
+            access_level__default_permissions=instance)
+    else:
+        return
+    Agent.invalidate_permissions(_agents.values_list('pk', flat=True))
+
+
+@receiver(post_save, sender=Agent)
+@receiver(post_delete, sender=Agent)
+def agent_changed(sender, instance, **kwargs):
+    # The access level may have changed.
+    instance.__dict__.pop('_effective_permissions', None)
+    Agent.invalidate_permissions([instance.pk])
+
+
+# Alert counters copy their target's user.
+
+@receiver(post_init, sender=Agent)
+@receiver(post_init, sender=Contractor)
+def alert_target_loaded(sender, instance, **kwargs):
+    instance._previous_user_id = instance.__dict__.get('user_id')
+
+
+@receiver(post_save, sender=Agent)
+@receiver(post_save, sender=Contractor)
+def alert_target_saved(sender, instance, created, **kwargs):
+    if not created and instance.user_id != getattr(
+            instance, '_previous_user_id', None):
+        AlertCounter.objects.filter(
+            target=instance.pk,
+            target_type=Alert.target_type_of(instance)).update(
+            user_id=instance.user_id)
+    instance._previous_user_id = instance.user_id
+
+
+@receiver(post_save, sender=Permission)
+@receiver(pre_delete, sender=Permission)
+def permission_changed(sender, instance, **kwargs):
+    Agent.invalidate_permissions(_agents_holding([instance.pk]))
+
+
+# Contractor dashboards. Bulk updates bypass these and invalidate the
+# dashboards themselves.
+
+@receiver(post_save, sender=Bid)
+@receiver(post_delete, sender=Bid)
+@receiver(post_save, sender=Transaction)
+@receiver(post_delete, sender=Transaction)
+@receiver(post_save, sender=Contractor)
+@receiver(post_delete, sender=Contractor)
+def contractor_dashboard_changed(sender, instance, **kwargs):
+    invalidate_contractors([instance.pk if sender is Contractor
+                            else instance.contractor_id])
+
+
+@receiver(m2m_changed, sender=Contractor.categories.through)
+def contractor_categories_changed(sender, instance, action, reverse, pk_set,
+                                  **kwargs):
+    if action not in ['post_add', 'post_remove', 'pre_clear']:
+        return
+    if not reverse:
+        invalidate_contractors([instance.pk])
+    elif pk_set:
+        invalidate_contractors(pk_set)
+    elif action == 'pre_clear':
+        invalidate_contractors(instance.contractor_set.values_list(
+            'pk', flat=True))
+
+
+@receiver(post_init, sender=Booking)
+def booking_loaded(sender, instance, **kwargs):
+    # The category the row had when loaded, without a query on save.
+    instance._previous_category_id = instance.__dict__.get('category_id')
+
+
+@receiver(post_save, sender=Booking)
+@receiver(post_delete, sender=Booking)
+def booking_changed(sender, instance, **kwargs):
+    invalidate_categories([instance.category_id,
+                           getattr(instance, '_previous_category_id', None)])
+    instance._previous_category_id = instance.category_id
+    if kwargs.get('signal') is post_save and not kwargs.get('created'):
+        invalidate_contractors(Bid.objects.filter(booking=instance)
+                               .values_list('contractor_id', flat=True))
+
+
+@receiver(post_save, sender=Preferred)
+@receiver(post_delete, sender=Preferred)
+def preferred_changed(sender, instance, **kwargs):
+    invalidate_categories([instance.category_id])
@@ -1,3 +1,1582 @@
-from django.test import TestCase
+import csv
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from datetime import timedelta
+from decimal import Decimal
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.contrib.messages import get_messages
+from django.core import mail
+from django.core.cache import cache
+from django.core.mail.backends import locmem
+from django.core.management import CommandError, call_command
+from django.core.urlresolvers import reverse
+from django.db import IntegrityError, OperationalError, connection, \
+    transaction
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.http import QueryDict
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from booking import middleware, pricing, ranking
+from booking.auctions import AuctionCloser
+from booking.benchmarks import MarketplaceBenchmark
+from booking.dashboard import DASHBOARD_TRANSACTIONS, get_dashboard, \
+    snapshot_key
+from booking.exceptions import AuctionClosed, ContractorNotEligible
+from booking.exports import iter_rows
+from booking.importer import BookingImporter
+from booking.indexes import missing_partial_indexes
+from booking.managers import AlertsManager, BiddingManager, BidSummary, \
+    BookingManager, NPSManager, TransactionManager
+from booking.metrics import registry
+from booking.models import *
+from booking.outbox import OutboxWorker
+from booking.pagination import KeysetPaginator
+from booking.pricing import FirstPriceStrategy, ListPriceStrategy, \
+    ReservePriceStrategy, SecondPriceStrategy
+from booking.postranges import CompiledRanges, RangeCache
+from booking.ranking import BidMatrix
+
+
+class MarketplaceFixtures(object):
+    '''Builds the minimal set of rows needed to place bids on a booking.'''
+
+    def setUp(self):
+        cache.clear()
+        self.category = Category.objects.create(name='Cleaning')
+        self.suburb = Suburb.objects.create(name='Richmond')
+        self.consumer = Consumer.objects.create(
+            name='Jane', phone_number='0400000000',
+            email_address='jane@example.com')
+        _topups = Permission.objects.create(action=PERM_ACTION_CREATE,
+                                            location=PERM_LOCATION_TOPUPS)
+        _bookings = Permission.objects.create(action=PERM_ACTION_CREATE,
+                                              location=PERM_LOCATION_BOOKINGS)
+        self.access_level = AccessLevel.objects.create(name='Admin')
+        self.access_level.default_permissions.add(_topups, _bookings)
+        self.agent = Agent.objects.create(
+            access_level=self.access_level,
+            user=User.objects.create(username='agent'))
+        self.booking = self.make_booking()
+
+    def make_booking(self, **kwargs):
+        _fields = dict(
+            consumer=self.consumer, address_1='1 Main St',
+            suburb=self.suburb, agent=self.agent, post_code=3121,
+            preferred_schedule=timezone.now(), category=self.category,
+            quoted_price=Decimal('100.00'), base_cost=Decimal('20.00'),
+            cost_adjustment=Decimal('0.00'),
+            priority_level=1, status=BOOKING_STATUS_ACTIVE,
+            closes_at=timezone.now() + timedelta(hours=1))
+        _fields.update(kwargs)
+        return Booking.objects.create(**_fields)
+
+    def make_contractor(self, name, credits=None):
+        _contractor = Contractor.objects.create(
+            name=name, phone_number='0400000001',
+            user=User.objects.create(username=name))
+        _contractor.categories.add(self.category)
+        if credits is not None:
+            TransactionManager.buy_credits(
+                source_agent=self.agent, contractor=_contractor,
+                amount=Decimal(credits))
+        return _contractor
+
+    def place_bids(self, booking, costs):
+        _bids = []
+        for _i, _cost in enumerate(costs):
+            _contractor = self.make_contractor(
+                'bidder-%d-%d' % (booking.pk, _i), credits='100.00')
+            _bid, _ = BiddingManager.place_bid(
+                contractor=_contractor, booking=booking,
+                base_cost=Decimal(_cost))
+            _bids.append(_bid)
+        return _bids
+
+
+class ContractorBalanceTest(MarketplaceFixtures, TestCase):
+
+    def test_balance_follows_ledger(self):
+        _contractor = self.make_contractor('alice', credits='50.00')
+        self.assertEqual(_contractor.credits, Decimal('50.00'))
+
+        _bid, _ = BiddingManager.place_bid(
+            contractor=_contractor, booking=self.booking,
+            base_cost=Decimal('20.00'))
+        self.assertEqual(_contractor.credits, Decimal('30.00'))
+
+        BiddingManager.close_bid(bid=_bid, status=BID_STATUS_EXPIRED)
+        _contractor.refresh_from_db()
+        self.assertEqual(_contractor.credits, Decimal('50.00'))
+
+    def test_place_bid_rejects_insufficient_balance(self):
+        _contractor = self.make_contractor('bob', credits='10.00')
+        with self.assertRaises(ContractorNotEligible):
+            BiddingManager.place_bid(
+                contractor=_contractor, booking=self.booking,
+                base_cost=Decimal('20.00'))
+
+    def test_place_bid_view_reports_insufficient_balance(self):
+        _contractor = self.make_contractor('bob', credits='10.00')
+        self.client.force_login(_contractor.user)
+        _response = self.client.post(reverse('booking:place-bid', kwargs={
+            'pk': _contractor.pk, 'id': self.booking.pk}), {
+            'base_cost': '20.00', 'premium_adjustment': '0.00',
+            'status': BID_STATUS_ACTIVE})
+        self.assertRedirects(_response, _contractor.get_absolute_url(),
+                             fetch_redirect_response=False)
+        self.assertEqual([
+            "%s" % _message
+            for _message in get_messages(_response.wsgi_request)],
+            ['Contractor not eligible to place bid. Reason: Insufficient '
+             'credits.'])
+        self.assertFalse(Bid.objects.filter(contractor=_contractor).exists())
+
+    def test_reconcile_balances_reports_and_fixes_drift(self):
+        _contractor = self.make_contractor('carol', credits='50.00')
+        Contractor.objects.filter(pk=_contractor.pk).update(balance=5)
+
+        _out = StringIO()
+        call_command('reconcile_balances', fix=True, stdout=_out)
+        self.assertIn('1 contractor(s) drifted', _out.getvalue())
+        _contractor.refresh_from_db()
+        self.assertEqual(_contractor.balance, Decimal('50.00'))
+
+
+class ConsumerNPSTest(MarketplaceFixtures, TestCase):
+
+    def make_requests(self, count):
+        return [NPSRequest.objects.create(consumer=self.consumer, nps_id=_i)
+                for _i in range(count)]
+
+    def test_mark_received_maintains_running_totals(self):
+        _first, _second, _pending = self.make_requests(3)
+        self.assertTrue(_first.mark_received(Decimal('9.00')))
+        self.assertTrue(_second.mark_received(6))
+        self.assertFalse(_first.mark_received(Decimal('1.00')))
+
+        _consumer = Consumer.objects.get(pk=self.consumer.pk)
+        self.assertEqual(_consumer.nps, Decimal('15.00'))
+        self.assertEqual(_consumer.nps_count, 2)
+        self.assertEqual(NPSRequest.objects.get(pk=_first.pk).nps,
+                         Decimal('9.00'))
+        with self.assertNumQueries(1):
+            _totals = dict(Consumer.objects.with_nps().values_list(
+                'pk', 'nps_total'))
+        self.assertEqual(_totals[self.consumer.pk], Decimal('15.00'))
+
+    def test_nps_property_and_annotation_agree(self):
+        for _i, _scores in enumerate([[], [7, 8], [10, 9, 9],
+                                      [Decimal('7.125'), '2.375']]):
+            _consumer = Consumer.objects.create(
+                name='Scored %d' % _i, phone_number='0401',
+                email_address='scored@example.com')
+            for _nps_id, _score in enumerate(_scores):
+                NPSRequest.objects.create(
+                    consumer=_consumer, nps_id=_nps_id).mark_received(_score)
+        _consumers = list(Consumer.objects.with_nps().order_by('pk'))
+        self.assertEqual([_c.nps for _c in _consumers],
+                         [Decimal('0.00'), Decimal('0.00'), Decimal('15.00'),
+                          Decimal('28.00'), Decimal('9.50')])
+        for _consumer in _consumers:
+            self.assertEqual(_consumer.nps_total, _consumer.nps)
+
+        # The running total is the sum of the rounded rows, as backfill_nps
+        # computes it.
+        _scored = _consumers[-1]
+        self.assertEqual(
+            [_r.nps for _r in NPSRequest.objects.filter(
+                consumer=_scored).order_by('nps_id')],
+            [Decimal('7.12'), Decimal('2.38')])
+        call_command('backfill_nps', stdout=StringIO())
+        self.assertEqual(Consumer.objects.get(pk=_scored.pk).nps,
+                         Decimal('9.50'))
+
+    def test_responses_are_unique_per_consumer(self):
+        NPSRequest.objects.create(consumer=self.consumer, nps_id=7)
+        with self.assertRaises(IntegrityError):
+            with transaction.atomic():
+                NPSRequest.objects.create(consumer=self.consumer, nps_id=7)
+        self.assertTrue(NPSManager.record_response(
+            consumer=self.consumer, nps_id=7, nps=8))
+        self.assertFalse(NPSManager.record_response(
+            consumer=self.consumer, nps_id=7, nps=8))
+        self.assertEqual(NPSRequest.objects.filter(
+            consumer=self.consumer, nps_id=7).count(), 1)
+        self.assertEqual(Consumer.objects.get(pk=self.consumer.pk).nps,
+                         Decimal('8.00'))
+
+    @override_settings(ASKNICELY_WEBHOOK_TOKEN='secret')
+    def test_webhook_records_responses_once(self):
+        _url = reverse('booking:nps-response')
+        _response = {'email': self.consumer.email_address,
+                     'response_id': '41', 'answer': '9'}
+        self.assertEqual(self.client.post(_url + '?token=wrong',
+                                          _response).status_code, 404)
+        self.assertEqual(self.client.post(_url + '?token=secret',
+                                          _response).status_code, 201)
+        self.assertEqual(self.client.post(_url + '?token=secret',
+                                          _response).status_code, 200)
+        self.assertEqual(self.client.post(_url + '?token=secret', dict(
+            _response, response_id='42', answer='11')).status_code, 400)
+        self.assertEqual(self.client.post(_url + '?token=secret', dict(
+            _response, response_id='43', answer='6')).status_code, 201)
+
+        _consumer = Consumer.objects.get(pk=self.consumer.pk)
+        self.assertEqual((_consumer.nps_sum, _consumer.nps_count),
+                         (Decimal('15.00'), 2))
+        self.assertEqual(_consumer.nps, Decimal('15.00'))
+        self.assertEqual(NPSRequest.objects.filter(
+            consumer=_consumer, is_received=True).count(), 2)
+
+    def test_backfill_nps_repairs_totals(self):
+        for _request, _score in zip(self.make_requests(3), [4, 5, None]):
+            if _score is not None:
+                _request.mark_received(_score)
+        _other = Consumer.objects.create(name='Other', phone_number='0401',
+                                         email_address='other@example.com')
+        NPSRequest.objects.create(consumer=_other, nps_id=9,
+                                  is_received=True, nps=Decimal('8.00'))
+        Consumer.objects.filter(pk=self.consumer.pk).update(nps_sum=0,
+                                                            nps_count=0)
+
+        _out = StringIO()
+        call_command('backfill_nps', batch_size=1, stdout=_out)
+        self.assertIn('2/2 consumer(s) updated', _out.getvalue())
+        self.assertEqual(
+            list(Consumer.objects.order_by('pk').values_list(
+                'nps_sum', 'nps_count')),
+            [(Decimal('9.00'), 2), (Decimal('8.00'), 1)])
+
+
+class ConcurrentBiddingTest(MarketplaceFixtures, TransactionTestCase):
+
+    def test_parallel_bids_never_overspend(self):
+        if (connection.vendor == 'sqlite'
+                and connection.is_in_memory_db(
+                    connection.settings_dict['NAME'])
+                and not connection.features.can_share_in_memory_db):
+            self.skipTest('Test database cannot be shared across threads.')
+        _contractor = self.make_contractor('alice', credits='400.00')
+        _attempts = 80
+        _outcomes = []
+
+        def bid():
+            for _retry in range(1000):
+                try:
+                    BiddingManager.place_bid(
+                        contractor=Contractor.objects.get(pk=_contractor.pk),
+                        booking=self.booking, base_cost=Decimal('20.00'))
+                    _outcomes.append(True)
+                    break
+                except ContractorNotEligible:
+                    _outcomes.append(False)
+                    break
+                except OperationalError:
+                    # SQLite reports lock contention instead of waiting.
+                    time.sleep(random.random() * 0.01)
+            connection.close()
+
+        _threads = [threading.Thread(target=bid) for _ in range(_attempts)]
+        for _thread in _threads:
+            _thread.start()
+        for _thread in _threads:
+            _thread.join()
+
+        _contractor.refresh_from_db()
+        self.assertEqual(len(_outcomes), _attempts)
+        self.assertEqual(_outcomes.count(True), 20)
+        self.assertEqual(_contractor.balance, Decimal('0.00'))
+        self.assertEqual(Bid.objects.filter(contractor=_contractor).count(),
+                         20)
+        self.assertEqual(Transaction.objects.filter(
+            contractor=_contractor,
+            transaction_type=TRANS_TYPE_REDEEM).count(), 20)
+        self.assertEqual(Contractor.objects.with_ledger_balance().get(
+            pk=_contractor.pk).ledger_balance, _contractor.balance)
+
+
+class AuctionTest(MarketplaceFixtures, TestCase):
+
+    def test_exec_auction_prefers_preferred_then_highest_bid(self):
+        _low, _high, _mid = self.place_bids(
+            self.booking, ['10.00', '30.00', '20.00'])
+        _pref = Preferred(contractor=_low.contractor, category=self.category)
+        _pref.set_post_ranges([[3000, 3200]])
+
+        _winner, _second, _losers = BiddingManager.exec_auction(
+            booking=self.booking)
+        self.assertEqual(_winner.bid, _low)
+        self.assertEqual(_second.bid, _high)
+        self.assertEqual([_b.bid for _b in _losers], [_mid])
+
+        self.assertEqual(Bid.objects.get(pk=_low.pk).status,
+                         BID_STATUS_ACCEPTED)
+        self.assertEqual(Transaction.objects.get(target_bid=_low).status,
+                         TRANS_STATUS_COMMITTED)
+        for _bid in [_high, _mid]:
+            self.assertEqual(Bid.objects.get(pk=_bid.pk).status,
+                             BID_STATUS_EXPIRED)
+            self.assertEqual(Contractor.objects.get(
+                pk=_bid.contractor_id).balance, Decimal('100.00'))
+        self.assertEqual(Contractor.objects.get(
+            pk=_low.contractor_id).balance, Decimal('80.00'))
+
+    def test_exec_auction_alerts_every_bidder(self):
+        _low, _high, _mid = self.place_bids(
+            self.booking, ['10.00', '30.00', '20.00'])
+        BiddingManager.exec_auction(booking=self.booking)
+        _alerts = dict(Alert.objects.filter(
+            target_type=ALERT_TARGET_CONT).values_list('target', 'body'))
+        self.assertIn('You won', _alerts[_high.contractor_id])
+        self.assertIn('came second', _alerts[_mid.contractor_id])
+        self.assertIn('not successful', _alerts[_low.contractor_id])
+
+    def test_broadcast_writes_alerts_and_emails_in_bulk(self):
+        _contractors = [self.make_contractor('Broadcast %d' % _i)
+                        for _i in range(3)]
+        User.objects.filter(contractor__in=_contractors[:2]).update(
+            email='contractor@example.com')
+        _targets = list(Contractor.objects.filter(
+            pk__in=[_c.pk for _c in _contractors]).select_related('user'))
+        # The alert and email inserts and the unread counter lookup and
+        # insert, plus savepoints.
+        with self.assertNumQueries(8):
+            AlertsManager.broadcast(_targets + [self.agent], 'Maintenance',
+                                    send_email=True)
+        self.assertEqual(Alert.objects.filter(body='Maintenance').count(), 4)
+        self.assertEqual(OutboxMessage.objects.count(), 2)
+        with self.assertRaises(Exception):
+            AlertsManager.broadcast([self.consumer], 'Maintenance')
+
+    def test_exec_auction_query_count_is_constant(self):
+        _counts = []
+        for _size in [3, 12]:
+            _booking = self.make_booking()
+            self.place_bids(_booking, ['%d.00' % (_i + 1)
+                                       for _i in range(_size)])
+            with CaptureQueriesContext(connection) as _queries:
+                BiddingManager.exec_auction(booking=_booking)
+            _counts.append(len(_queries))
+        self.assertEqual(_counts[0], _counts[1])
+
+    def close(self, *bookings):
+        Booking.objects.filter(pk__in=[_b.pk for _b in bookings]).update(
+            closes_at=timezone.now() - timedelta(minutes=1))
+
+    def test_settle_auctions_command_settles_due_auctions(self):
+        _ready = self.make_booking()
+        self.place_bids(_ready, ['10.00', '20.00'])
+        _single = self.make_booking()
+        _only, = self.place_bids(_single, ['10.00'])
+        _later = self.make_booking()
+        self.place_bids(_later, ['10.00'])
+        self.close(self.booking, _ready, _single)
+
+        _out = StringIO()
+        call_command('settle_auctions', workers=1, stdout=_out)
+        self.assertIn('Batch 1: 3 claimed, 2 settled, 1 without a winner, '
+                      '0 failed', _out.getvalue())
+        self.assertIn('Settled 2 auction(s), 1 without a winner, 0 failed',
+                      _out.getvalue())
+        for _booking in [self.booking, _ready, _single]:
+            self.assertEqual(Booking.objects.get(
+                pk=_booking.pk).auction_status, AUCTION_STATUS_SETTLED)
+        self.assertFalse(_ready.bids.filter(
+            status=BID_STATUS_ACTIVE).exists())
+        self.assertEqual(Bid.objects.get(pk=_only.pk).status,
+                         BID_STATUS_ACCEPTED)
+        self.assertEqual(Contractor.objects.get(
+            pk=_only.contractor_id).balance, Decimal('80.00'))
+        self.assertEqual(Booking.objects.get(pk=_later.pk).auction_status,
+                         AUCTION_STATUS_OPEN)
+        self.assertTrue(_later.bids.filter(status=BID_STATUS_ACTIVE).exists())
+
+        # Auctions settle only once closed; on SQLite the command settles
+        # inline by default.
+        _out = StringIO()
+        call_command('settle_auctions', stdout=_out)
+        self.assertIn('Settled 0 auction(s)', _out.getvalue())
+        self.close(_later)
+        _out = StringIO()
+        call_command('settle_auctions', stdout=_out)
+        self.assertIn('Settled 1 auction(s), 0 without a winner',
+                      _out.getvalue())
+        self.assertEqual(Booking.objects.get(pk=_later.pk).auction_status,
+                         AUCTION_STATUS_SETTLED)
+
+    def test_closed_auctions_refuse_bids_and_settle_once(self):
+        _bid, = self.place_bids(self.booking, ['10.00'])
+        _winner, _second, _losers = BiddingManager.exec_auction(
+            booking=self.booking)
+        self.assertEqual((_winner.bid, _second, _losers), (_bid, None, []))
+        with self.assertRaises(AuctionClosed):
+            BiddingManager.exec_auction(booking=self.booking)
+        with self.assertRaises(AuctionClosed):
+            BiddingManager.place_bid(contractor=_bid.contractor,
+                                     booking=self.booking,
+                                     base_cost=Decimal('10.00'))
+
+        _past = self.make_booking()
+        self.close(_past)
+        self.assertNotIn(_past, Booking.objects.open())
+        self.assertIn(self.make_booking(), Booking.objects.open())
+        with self.assertRaises(AuctionClosed):
+            BiddingManager.place_bid(contractor=_bid.contractor,
+                                     booking=_past,
+                                     base_cost=Decimal('10.00'))
+        self.assertFalse(_past.bids.exists())
+
+    def test_auction_view_reports_unsold_auctions(self):
+        _response = self.client.get(reverse(
+            'booking:booking-auction', kwargs={'pk': self.booking.pk}))
+        self.assertRedirects(_response, self.booking.get_absolute_url(),
+                             fetch_redirect_response=False)
+        self.assertEqual([
+            "%s" % _message
+            for _message in get_messages(_response.wsgi_request)],
+            ['The auction closed without a winning bid'])
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk)
+                         .auction_status, AUCTION_STATUS_SETTLED)
+
+    def test_withdrawn_bookings_refund_their_bids(self):
+        _bids = self.place_bids(self.booking, ['10.00', '20.00'])
+        Booking.objects.filter(pk=self.booking.pk).update(
+            status=BOOKING_STATUS_CANCELLED)
+        self.close(self.booking)
+        self.assertEqual(AuctionCloser().run()[:3], (0, 1, 0))
+        for _bid in _bids:
+            self.assertEqual(Bid.objects.get(pk=_bid.pk).status,
+                             BID_STATUS_EXPIRED)
+            self.assertEqual(Contractor.objects.get(
+                pk=_bid.contractor_id).balance, Decimal('100.00'))
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk)
+                         .auction_status, AUCTION_STATUS_SETTLED)
+
+    def test_lapsed_claims_are_retried(self):
+        self.place_bids(self.booking, ['10.00', '20.00'])
+        self.close(self.booking)
+        _claimed = AuctionCloser(claim_seconds=300).claim()
+        self.assertEqual(_claimed, [self.booking])
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk)
+                         .auction_status, AUCTION_STATUS_CLOSING)
+        # A second closer skips the claimed auction until the claim lapses.
+        self.assertEqual(AuctionCloser().claim(), [])
+        Booking.objects.filter(pk=self.booking.pk).update(
+            auction_claimed_until=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(AuctionCloser().run()[:3], (1, 0, 0))
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk)
+                         .auction_status, AUCTION_STATUS_SETTLED)
+
+
+class PostRangeTest(MarketplaceFixtures, TestCase):
+
+    def test_serving_matches_inclusive_ranges(self):
+        _alice = self.make_contractor('alice')
+        _alice.set_post_ranges([[3000, 3099], [3121, 3121]])
+        _bob = self.make_contractor('bob')
+        _bob.set_post_ranges([[3100, 3200]])
+        _other = Category.objects.create(name='Gardening')
+
+        self.assertEqual(set(Contractor.objects.serving(3121)),
+                         set([_alice, _bob]))
+        self.assertEqual(list(Contractor.objects.serving(3099)), [_alice])
+        self.assertEqual(list(Contractor.objects.serving(3121, _other)), [])
+
+        _alice.set_post_ranges([[4000, 4100]])
+        self.assertEqual(list(Contractor.objects.serving(3121)), [_bob])
+        self.assertEqual(PostRange.objects.filter(contractor=_alice).count(),
+                         1)
+
+    def test_preferred_serving(self):
+        _pref = Preferred(contractor=self.make_contractor('alice'),
+                          category=self.category)
+        _pref.set_post_ranges([[3000, 3200]])
+        self.assertEqual(
+            list(Preferred.objects.serving(3121, self.category)), [_pref])
+        self.assertEqual(list(Preferred.objects.serving(3201)), [])
+
+    def test_compiled_ranges_merge_and_bisect(self):
+        _compiled = CompiledRanges([[3100, 3200], [3000, 3050],
+                                    [3051, 3060], [3150, 3300]])
+        self.assertEqual(_compiled.lowers, [3000, 3100])
+        self.assertEqual(_compiled.uppers, [3060, 3300])
+        self.assertIn(3000, _compiled)
+        self.assertIn(3300, _compiled)
+        self.assertNotIn(2999, _compiled)
+        self.assertNotIn(3061, _compiled)
+        self.assertNotIn(3301, _compiled)
+
+    def test_range_cache_counts_evicts_and_invalidates(self):
+        _cache = RangeCache(maxsize=1)
+        _alice = self.make_contractor('alice')
+        _alice.set_post_ranges([[3000, 3100]])
+        _bob = self.make_contractor('bob')
+
+        self.assertIn(3050, _cache.get(_alice))
+        self.assertIn(3050, _cache.get(_alice))
+        _cache.get(_bob)
+        _cache.get(_alice)
+        self.assertEqual(_cache.stats(), {'hits': 1, 'misses': 3,
+                                          'size': 1, 'maxsize': 1})
+
+        _alice.post_ranges_raw = '[[4000, 4100]]'
+        self.assertNotIn(3050, _cache.get(_alice))
+        _cache.invalidate(_alice)
+        self.assertEqual(_cache.stats()['size'], 0)
+
+
+class AgentPermissionTest(MarketplaceFixtures, TestCase):
+
+    def test_has_perms_is_cached(self):
+        _agent = Agent.objects.get(pk=self.agent.pk)
+        with self.assertNumQueries(1):
+            self.assertTrue(_agent.has_perms(PERM_ACTION_CREATE,
+                                             PERM_LOCATION_TOPUPS))
+            self.assertFalse(_agent.has_perms(PERM_ACTION_DELETE,
+                                              PERM_LOCATION_TOPUPS))
+        with self.assertNumQueries(0):
+            self.assertTrue(Agent(pk=self.agent.pk).has_perms(
+                PERM_ACTION_CREATE, PERM_LOCATION_BOOKINGS))
+
+    def test_m2m_changes_invalidate_cache(self):
+        _delete = Permission.objects.create(action=PERM_ACTION_DELETE,
+                                            location=PERM_LOCATION_BIDS)
+        _read = Permission.objects.create(action=PERM_ACTION_READ,
+                                          location=PERM_LOCATION_BIDS)
+        self.assertFalse(self.agent.has_perms(PERM_ACTION_DELETE,
+                                              PERM_LOCATION_BIDS))
+
+        self.agent.permissions.add(_delete)
+        self.assertTrue(self.agent.has_perms(PERM_ACTION_DELETE,
+                                             PERM_LOCATION_BIDS))
+
+        self.access_level.default_permissions.add(_read)
+        _agent = Agent.objects.get(pk=self.agent.pk)
+        self.assertTrue(_agent.has_perms(PERM_ACTION_READ,
+                                         PERM_LOCATION_BIDS))
+
+        _read.accesslevel_set.clear()
+        _agent = Agent.objects.get(pk=self.agent.pk)
+        self.assertFalse(_agent.has_perms(PERM_ACTION_READ,
+                                          PERM_LOCATION_BIDS))
+
+
+class AlertInboxTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(AlertInboxTest, self).setUp()
+        self.contractor = self.make_contractor('Inbox')
+        self.alerts = [Alert.create(target=self.contractor,
+                                    body='Alert %d' % _i) for _i in range(3)]
+        self.alerts.extend(AlertsManager.broadcast(
+            [self.contractor, self.agent], 'Broadcast'))
+
+    def test_unread_counter_is_maintained(self):
+        self.assertEqual(Alert.unread_count(self.contractor), 4)
+        self.assertEqual(Alert.unread_count(self.agent), 1)
+        _ids = [_a.pk for _a in Alert.get_alerts(self.contractor)[:2]]
+        with self.assertNumQueries(4):
+            self.assertEqual(Alert.mark_read(self.contractor, _ids), 2)
+        self.assertEqual(Alert.mark_read(self.contractor, _ids), 0)
+        # Other targets' alerts are left alone.
+        self.assertEqual(Alert.mark_read(
+            self.contractor, [Alert.get_alerts(self.agent).get().pk]), 0)
+        self.assertEqual(Alert.unread_count(self.contractor), 2)
+        self.assertEqual(Alert.unread_count(self.agent), 1)
+        with self.assertNumQueries(1):
+            self.assertEqual(Alert.unread_count_for_user(
+                self.contractor.user), 2)
+
+    def test_counters_follow_their_target_user(self):
+        _old_user = self.contractor.user
+        _contractor = Contractor.objects.get(pk=self.contractor.pk)
+        _contractor.user = User.objects.create(username='new-owner')
+        _contractor.save()
+        self.assertEqual(Alert.unread_count_for_user(_old_user), 0)
+        self.assertEqual(Alert.unread_count_for_user(_contractor.user), 4)
+        self.agent.user = _contractor.user
+        self.agent.save()
+        self.assertEqual(Alert.unread_count_for_user(_contractor.user), 5)
+
+    def test_inbox_pages_newest_first(self):
+        _first = Alert.inbox(self.contractor, page_size=3)
+        self.assertTrue(_first.has_next)
+        _second = Alert.inbox(self.contractor, cursor=_first.next_cursor,
+                              page_size=3)
+        self.assertFalse(_second.has_next)
+        _seen = [_a.pk for _a in list(_first) + list(_second)]
+        self.assertEqual(_seen, sorted(
+            Alert.get_alerts(self.contractor).values_list('pk', flat=True),
+            reverse=True))
+
+        Alert.mark_read(self.contractor, _seen[:1])
+        self.assertEqual(len(Alert.inbox(self.contractor, unread_only=True)),
+                         3)
+
+    def test_badge_costs_one_query(self):
+        self.client.force_login(self.contractor.user)
+        _response = self.client.get(reverse('booking:booking-list'))
+        self.assertContains(_response, '<span class="badge">4</span>')
+
+
+class KeysetPaginationTest(MarketplaceFixtures, TestCase):
+
+    def test_pages_cover_rows_with_tied_sort_keys(self):
+        for _ in range(6):
+            self.make_booking()
+        Booking.objects.update(created_on=timezone.now())
+        _paginator = KeysetPaginator(Booking.objects.all(),
+                                     ('-created_on', '-pk'), page_size=3)
+
+        _seen = []
+        _cursor = None
+        while True:
+            _page = _paginator.page(_cursor)
+            _seen.extend(_b.pk for _b in _page)
+            if not _page.has_next:
+                break
+            _cursor = QueryDict(_page.next_query)['cursor']
+        self.assertEqual(_seen, sorted(
+            Booking.objects.values_list('pk', flat=True), reverse=True))
+
+    def test_booking_list_filters_and_links_next_page(self):
+        _other = Category.objects.create(name='Gardening')
+        for _ in range(3):
+            self.make_booking(category=_other)
+
+        _response = self.client.get(reverse('booking:booking-list'), {
+            'category': _other.pk, 'page_size': 2})
+        self.assertEqual(len(_response.context['bookings']), 2)
+        _next_query = _response.context['page'].next_query
+        self.assertIn('category=%d' % _other.pk, _next_query)
+
+        _response = self.client.get(
+            reverse('booking:booking-list') + '?' + _next_query)
+        self.assertEqual(len(_response.context['bookings']), 1)
+        self.assertFalse(_response.context['page'].has_next)
+
+
+class ViewQueryCountTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(ViewQueryCountTest, self).setUp()
+        self.client.force_login(
+            User.objects.create(username='staff', is_staff=True))
+        self.add_rows()
+
+    def add_rows(self):
+        _booking = self.make_booking(link=self.booking)
+        _booking.subtypes.add(SubType.objects.create(
+            name='Subtype %d' % _booking.pk))
+        _bids = self.place_bids(_booking, ['10.00', '20.00', '30.00'])
+        self.contractor = _bids[0].contractor
+        self.contractor.set_post_ranges([[3000, 3200]])
+        self.contractor.save()
+        _other = self.make_booking()
+        BiddingManager.place_bid(contractor=self.contractor, booking=_other,
+                                 base_cost=Decimal('5.00'))
+        BiddingManager.exec_auction(booking=_booking)
+        _pref = Preferred(contractor=self.contractor, category=self.category)
+        _pref.set_post_ranges([[3000, 3200]])
+        self.consumer = Consumer.objects.create(
+            name='John %d' % _booking.pk, phone_number='0400000002',
+            email_address='john@example.com')
+        self.make_booking(consumer=self.consumer)
+        self.make_booking(consumer=self.consumer)
+        return _booking
+
+    def assertConstantQueries(self, num, url_factory):
+        # num includes the session, user and alert badge queries.
+        for _ in range(2):
+            _url = url_factory()
+            with self.assertNumQueries(num):
+                self.assertEqual(self.client.get(_url).status_code, 200)
+            self.add_rows()
+
+    def test_list_pages(self):
+        for _name in ['bid-list', 'booking-list', 'consumer-list',
+                      'contractor-list', 'transaction-list']:
+            self.assertConstantQueries(
+                {'contractor-list': 5}.get(_name, 4),
+                lambda: reverse('booking:' + _name))
+
+    def test_contractor_detail(self):
+        self.assertConstantQueries(9, lambda: reverse(
+            'booking:contractor-detail', kwargs={'id': self.contractor.pk}))
+
+    def test_booking_detail(self):
+        self.assertConstantQueries(6, lambda: reverse(
+            'booking:booking-detail', kwargs={'pk': Booking.objects.filter(
+                link__isnull=False).latest('pk').pk}))
+
+    def test_consumer_detail(self):
+        self.assertConstantQueries(5, lambda: reverse(
+            'booking:consumer-detail', kwargs={'id': self.consumer.pk}))
+
+    def test_bid_and_transaction_detail(self):
+        _bid = Bid.objects.latest('pk')
+        self.assertConstantQueries(4, lambda: reverse(
+            'booking:bid-detail', kwargs={'id': _bid.pk}))
+        _transaction = Transaction.objects.latest('pk')
+        self.assertConstantQueries(4, lambda: reverse(
+            'booking:transaction-detail', kwargs={'id': _transaction.pk}))
+
+
+class BenchmarkCommandTest(TestCase):
+
+    def test_seed_and_bench_marketplace(self):
+        call_command('seed_marketplace', bookings=60, contractors=12,
+                     consumers=15, stdout=StringIO())
+        self.assertEqual(Booking.objects.count(), 60)
+        self.assertEqual(Contractor.objects.count(), 12)
+        _out = StringIO()
+        call_command('reconcile_balances', stdout=_out)
+        self.assertIn('0 contractor(s) drifted', _out.getvalue())
+        _out = StringIO()
+        call_command('backfill_nps', stdout=_out)
+        self.assertIn('0/15 consumer(s) updated', _out.getvalue())
+
+        _bookings = Booking.objects.count()
+        _out = StringIO()
+        call_command('bench_marketplace', iterations=3, stdout=_out)
+        _report = json.loads(_out.getvalue())
+        self.assertEqual(sorted(_report['scenarios']),
+                         sorted(MarketplaceBenchmark.SCENARIOS))
+        for _result in _report['scenarios'].values():
+            self.assertIn('p99', _result['latency_ms'])
+        # Scenarios roll back, so the dataset is unchanged.
+        self.assertEqual(Booking.objects.count(), _bookings)
+
+    def test_bench_marketplace_needs_seed_data(self):
+        with self.assertRaisesRegexp(CommandError, 'no open booking'):
+            call_command('bench_marketplace', scenario=['bid_placement'],
+                         iterations=1, stdout=StringIO())
+
+
+class PartialIndexTest(TestCase):
+
+    def test_migrations_leave_every_partial_index(self):
+        # A migration that rebuilds a table on SQLite drops its partial
+        # indexes.
+        self.assertEqual(missing_partial_indexes(connection), [])
+
+
+class RequestMetricsTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(RequestMetricsTest, self).setUp()
+        registry.reset()
+        self.client.force_login(
+            User.objects.create(username='staff', is_staff=True))
+
+    @override_settings(BOOKING_METRICS_TOKEN='secret')
+    def test_request_metrics_are_recorded_per_view(self):
+        _logged = len(connection.queries_log)
+        self.assertEqual(self.client.get(
+            reverse('booking:booking-list')).status_code, 200)
+        self.assertEqual(len(connection.queries_log), _logged)
+        _body = self.client.get(reverse('booking:metrics'),
+                                HTTP_AUTHORIZATION='Bearer secret').content
+        self.assertIn('booking_requests_total{status="200",'
+                      'view="booking:booking-list"} 1', _body)
+        self.assertIn('booking_request_duration_seconds_count'
+                      '{view="booking:booking-list"} 1', _body)
+        self.assertIn('booking_request_queries_bucket'
+                      '{view="booking:booking-list",le="+Inf"} 1', _body)
+        self.assertNotIn('booking_request_queries_sum'
+                         '{view="booking:booking-list"} 0', _body)
+        self.assertIn('booking_request_template_seconds_count'
+                      '{view="booking:booking-list"} 1', _body)
+
+    def test_metrics_endpoint_needs_the_token(self):
+        _url = reverse('booking:metrics')
+        self.assertEqual(self.client.get(
+            _url, HTTP_AUTHORIZATION='Bearer secret').status_code, 404)
+        with self.settings(BOOKING_METRICS_TOKEN='secret'):
+            self.assertEqual(self.client.get(_url).status_code, 404)
+            self.assertEqual(self.client.get(
+                _url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 404)
+            self.assertEqual(self.client.get(
+                _url, HTTP_AUTHORIZATION='Bearer secret').status_code, 200)
+
+    def test_slow_requests_are_sampled(self):
+        _logged = []
+        _saved = (middleware.SLOW_REQUEST_MS,
+                  middleware.SLOW_REQUEST_SAMPLE_RATE, middleware.logger)
+        middleware.SLOW_REQUEST_MS = 0
+        middleware.SLOW_REQUEST_SAMPLE_RATE = 1
+        middleware.logger = type('Logger', (object,), {
+            'warning': lambda self, *args: _logged.append(args)})()
+        try:
+            self.client.get(reverse('booking:booking-list'))
+        finally:
+            (middleware.SLOW_REQUEST_MS, middleware.SLOW_REQUEST_SAMPLE_RATE,
+             middleware.logger) = _saved
+        self.assertIn('booking_slow_requests_total'
+                      '{view="booking:booking-list"} 1', registry.render())
+        self.assertIn('SELECT', _logged[0][-1])
+
+
+class AskNicelyStub(BaseHTTPRequestHandler):
+    '''Answers AskNicely triggers with the queued responses, recording the
+       posted form data.'''
+    responses = []
+    received = []
+
+    def do_POST(self):
+        _length = int(self.headers.getheader('content-length'))
+        self.received.append((self.headers.getheader('x-apikey'),
+                              QueryDict(self.rfile.read(_length))))
+        _body = json.dumps(self.responses.pop(0))
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        self.wfile.write(_body)
+
+    def log_message(self, *args):
+        pass
+
+
+class OutboxTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(OutboxTest, self).setUp()
+        self.server = HTTPServer(('127.0.0.1', 0), AskNicelyStub)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        AskNicelyStub.responses = []
+        AskNicelyStub.received = []
+        self.settings_override = override_settings(
+            ASKNICELY_URL='http://127.0.0.1:%d/trigger' %
+            self.server.server_address[1], ASKNICELY_API_KEY='test-key')
+        self.settings_override.enable()
+
+    def tearDown(self):
+        self.settings_override.disable()
+        self.server.shutdown()
+        self.server.server_close()
+        super(OutboxTest, self).tearDown()
+
+    def test_alert_emails_are_queued_and_sent_in_one_connection(self):
+        _contractors = [self.make_contractor('Mail %d' % _i)
+                        for _i in range(3)]
+        for _contractor in _contractors:
+            _contractor.user.email = '%s@example.com' % _contractor.pk
+            _contractor.user.save()
+            AlertsManager.send_alert(target=_contractor, body='You lost.',
+                                     _send_email=True)
+        self.assertEqual(Alert.objects.count(), 3)
+        self.assertEqual(len(mail.outbox), 0)
+
+        _opened = []
+        _open = locmem.EmailBackend.open
+        locmem.EmailBackend.open = lambda self: _opened.append(self)
+        try:
+            self.assertEqual(OutboxWorker().drain(), (3, 0, 0))
+        finally:
+            locmem.EmailBackend.open = _open
+        self.assertEqual(len(_opened), 1)
+        self.assertEqual(sorted(_m.to[0] for _m in mail.outbox),
+                         sorted('%s@example.com' % _c.pk
+                                for _c in _contractors))
+        self.assertFalse(OutboxMessage.objects.exclude(
+            status=OUTBOX_STATUS_SENT).exists())
+
+    def test_asknicely_calls_are_retried_with_backoff(self):
+        AlertsManager.send_asknicely(consumer=self.consumer)
+        AskNicelyStub.responses = [{'success': False, 'msg': 'busy'},
+                                   {'success': True}]
+        _worker = OutboxWorker(max_attempts=2, backoff_seconds=60)
+
+        self.assertEqual(_worker.drain(), (0, 1, 0))
+        _message = OutboxMessage.objects.get()
+        self.assertEqual(_message.attempts, 1)
+        self.assertIn('busy', _message.last_error)
+        self.assertGreater(_message.next_attempt_at,
+                           timezone.now() + timedelta(seconds=50))
+        self.assertEqual(_worker.drain(), (0, 0, 0))
+
+        OutboxMessage.objects.update(next_attempt_at=timezone.now())
+        _out = StringIO()
+        call_command('drain_outbox', stdout=_out)
+        self.assertIn('1 sent, 0 to retry, 0 failed', _out.getvalue())
+        _api_key, _data = AskNicelyStub.received[-1]
+        self.assertEqual(_api_key, 'test-key')
+        self.assertEqual(_data['email'], self.consumer.email_address)
+        self.assertEqual(OutboxMessage.objects.get().status,
+                         OUTBOX_STATUS_SENT)
+
+    def test_messages_fail_after_max_attempts(self):
+        AlertsManager.send_asknicely(consumer=self.consumer)
+        AskNicelyStub.responses = [{'success': False, 'msg': 'bad key'}]
+        self.assertEqual(OutboxWorker(max_attempts=1).drain(), (0, 0, 1))
+        self.assertEqual(OutboxMessage.objects.get().status,
+                         OUTBOX_STATUS_FAILED)
+
+
+class ImportRecordsTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(ImportRecordsTest, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        SubType.objects.create(name='Deep clean')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        super(ImportRecordsTest, self).tearDown()
+
+    def write(self, name, text):
+        _path = os.path.join(self.tmp, name)
+        with open(_path, 'w') as _file:
+            _file.write(text)
+        return _path
+
+    def test_import_consumers_csv_with_rejects(self):
+        _path = self.write('consumers.csv',
+                           'name,phone_number,email_address\n'
+                           'Ann,0400000010,ann@example.com\n'
+                           'Bob,0400000011,not-an-email\n'
+                           'Cat,0400000012,cat@example.com\n')
+        _out = StringIO()
+        call_command('import_records', 'consumer', _path, batch_size=2,
+                     stdout=_out)
+        self.assertIn('Imported 2 consumer row(s)', _out.getvalue())
+        self.assertTrue(Consumer.objects.filter(name='Cat').exists())
+        with open(_path + '.rejects.jsonl') as _rejects:
+            _reject = json.loads(_rejects.readline())
+        self.assertEqual(_reject['line'], 3)
+        self.assertIn('email_address', _reject['errors'])
+
+    def test_import_bookings_resolves_relations_in_bulk(self):
+        # Rows come in pairs sharing a natural key, only the second of each
+        # with subtypes.
+        _rows = [dict(consumer=self.consumer.pk,
+                      address_1='%d Import St' % (_i // 2),
+                      suburb='Richmond', post_code=3121,
+                      preferred_schedule='2026-01-01 10:00',
+                      category='Cleaning', quoted_price='90.00',
+                      base_cost='30.00', priority_level=1,
+                      status=BOOKING_STATUS_ACTIVE,
+                      subtypes=['Deep clean'] if _i % 2 else [])
+                 for _i in range(20)]
+        _rows[5]['category'] = 'Gardening'
+        _rows[6]['consumer'] = 999999
+        _path = self.write('bookings.jsonl',
+                           '\n'.join(json.dumps(_row) for _row in _rows))
+        _before = Booking.objects.count()
+        _out = StringIO()
+        with CaptureQueriesContext(connection) as _queries:
+            call_command('import_records', 'booking', _path,
+                         username=self.agent.user.username, stdout=_out,
+                         rejects=os.path.join(self.tmp, 'rejects'))
+        self.assertIn('Imported 18 booking row(s)',
+                      _out.getvalue())
+        self.assertEqual(Booking.objects.count(), _before + 18)
+        self.assertEqual(list(Booking.objects.filter(
+            address_1__endswith=' Import St').order_by('pk').annotate(
+            _subtypes=Count('subtypes')).values_list('_subtypes', flat=True)),
+            [_i % 2 for _i in range(20) if _i not in [5, 6]])
+        # Bookings and their subtypes are written in bulk.
+        self.assertLess(len(_queries), 15)
+
+    def test_import_bookings_rejects_chunks_raced_by_other_bookings(self):
+        _row = dict(consumer=self.consumer.pk, address_1='1 Import St',
+                    suburb='Richmond', post_code=3121,
+                    preferred_schedule='2026-01-01 10:00',
+                    category='Cleaning', quoted_price='90.00',
+                    base_cost='30.00', priority_level=1,
+                    status=BOOKING_STATUS_ACTIVE, subtypes=['Deep clean'])
+        _path = self.write('bookings.jsonl', json.dumps(_row))
+        _importer = BookingImporter(user=self.agent.user)
+        _bulk_create = Booking.objects.bulk_create
+
+        def racing_bulk_create(objs):
+            # Another writer's booking with the same natural key lands
+            # between the pk read and the import's insert.
+            self.make_booking(address_1='1 Import St',
+                              preferred_schedule=objs[0].preferred_schedule)
+            return _bulk_create(objs)
+        Booking.objects.bulk_create = racing_bulk_create
+        try:
+            with open(_path) as _file:
+                _imported, _rejected, _ = _importer.run(_file, 'json')
+        finally:
+            del Booking.objects.bulk_create
+        self.assertEqual((_imported, _rejected), (0, 1))
+        self.assertFalse(Booking.objects.filter(
+            subtypes__name='Deep clean').exists())
+
+    def test_import_contractors_checks_unique_names(self):
+        _path = self.write('contractors.csv',
+                           'name,phone_number,categories,post_ranges\n'
+                           'Sparky,0400000020,Cleaning,"[[3000, 3100]]"\n'
+                           'Sparky,0400000021,Cleaning,[]\n')
+        call_command('import_records', 'contractor', _path,
+                     username=self.agent.user.username, stdout=StringIO())
+        _contractor = Contractor.objects.get(name='Sparky')
+        self.assertEqual(_contractor.user, self.agent.user)
+        self.assertEqual(list(_contractor.categories.all()), [self.category])
+        self.assertTrue(_contractor.in_post_range(3050))
+        self.assertEqual(list(Contractor.objects.serving(3050)),
+                         [_contractor])
+
+
+class ExportTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(ExportTest, self).setUp()
+        self.bids = self.place_bids(self.booking, ['10.00', '20.00', '30.00'])
+        self.client.force_login(
+            User.objects.create(username='staff', is_staff=True))
+
+    def read(self, response):
+        return list(csv.reader(b''.join(response.streaming_content)
+                               .splitlines()))
+
+    def test_streams_transactions_in_chunks(self):
+        _contractor = self.bids[1].contractor
+        _url = reverse('booking:export-csv', kwargs={'kind': 'transactions'})
+        _response = self.client.get(_url)
+        self.assertEqual(_response['Content-Type'], 'text/csv')
+        _rows = self.read(_response)
+        self.assertEqual(_rows[0][:3], ['id', 'timestamp', 'contractor_id'])
+        self.assertEqual(len(_rows) - 1, Transaction.objects.count())
+
+        _rows = self.read(self.client.get(
+            _url, {'contractor': _contractor.pk}))
+        self.assertEqual(
+            sorted(int(_row[0]) for _row in _rows[1:]),
+            sorted(_contractor.transactions.values_list('pk', flat=True)))
+        self.assertEqual(self.client.get(
+            _url, {'start': 'yesterday'}).status_code, 400)
+
+        _tomorrow = (timezone.now() + timedelta(days=1)).date().isoformat()
+        self.assertEqual(len(self.read(self.client.get(
+            _url, {'start': _tomorrow}))), 1)
+
+    def test_chunks_cover_every_row_once(self):
+        _rows = list(iter_rows(Bid.objects.all(), 'created_on', ['pk'],
+                               chunk_size=2))
+        self.assertEqual([_row[0] for _row in _rows],
+                         list(Bid.objects.order_by('created_on', 'pk')
+                              .values_list('pk', flat=True)))
+
+    def test_export_command(self):
+        _path = os.path.join(tempfile.mkdtemp(), 'bids.csv')
+        try:
+            call_command('export_csv', 'bids', output=_path, chunk_size=1,
+                         contractor=self.bids[0].contractor_id)
+            with open(_path) as _file:
+                _rows = list(csv.reader(_file))
+        finally:
+            shutil.rmtree(os.path.dirname(_path))
+        self.assertEqual(len(_rows), 2)
+        self.assertEqual(_rows[1][0], "%d" % self.bids[0].pk)
+
+    def test_export_requires_staff(self):
+        self.client.logout()
+        self.assertEqual(self.client.get(reverse(
+            'booking:export-csv', kwargs={'kind': 'bids'})).status_code, 404)
+
+
+class ContractorDashboardTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(ContractorDashboardTest, self).setUp()
+        registry.reset()
+        self.contractor = self.make_contractor('Dash', credits='100.00')
+        self.contractor.set_post_ranges([[3000, 3999]])
+        self.contractor.save()
+
+    def assertRebuilds(self, rebuilds):
+        with CaptureQueriesContext(connection) as _queries:
+            _dashboard = get_dashboard(self.contractor.pk)
+        self.assertEqual(len(_queries) > 0, rebuilds)
+        return _dashboard
+
+    def test_snapshot_is_cached_until_invalidated(self):
+        self.assertRebuilds(True)
+        self.assertRebuilds(False)
+
+        _bid, _ = BiddingManager.place_bid(contractor=self.contractor,
+                                           booking=self.booking,
+                                           base_cost=Decimal('10.00'))
+        _dashboard = self.assertRebuilds(True)
+        self.assertEqual(_dashboard['active_bids'], [_bid])
+        self.assertEqual(_dashboard['credits'],
+                         Contractor.objects.get(pk=self.contractor.pk).credits)
+        self.assertLess(_dashboard['credits'], Decimal('100.00'))
+
+        # A new booking in one of the contractor's categories.
+        _booking = self.make_booking()
+        self.assertIn(_booking, list(self.assertRebuilds(True)['bookings']))
+        # A booking elsewhere does not matter.
+        self.make_booking(category=Category.objects.create(name='Other'))
+        self.assertRebuilds(False)
+
+        _other = self.make_contractor('Rival', credits='100.00')
+        BiddingManager.place_bid(contractor=_other, booking=self.booking,
+                                 base_cost=Decimal('20.00'))
+        self.assertRebuilds(False)
+        BiddingManager.exec_auction(booking=self.booking)
+        self.assertEqual(self.assertRebuilds(True)['losing_bids'], [_bid])
+
+        self.assertIn('booking_dashboard_cache_total{result="hit"} 3',
+                      registry.render())
+        self.assertIn('booking_dashboard_rebuild_seconds_count 4',
+                      registry.render())
+
+    def test_update_booking_retires_bidders_dashboards(self):
+        BiddingManager.place_bid(contractor=self.contractor,
+                                 booking=self.booking,
+                                 base_cost=Decimal('10.00'))
+        self.access_level.default_permissions.add(Permission.objects.create(
+            action=PERM_ACTION_UPDATE, location=PERM_LOCATION_BOOKINGS))
+        self.assertRebuilds(True)
+        self.assertRebuilds(False)
+        BookingManager.update_booking(agent=Agent.objects.get(pk=self.agent.pk),
+                                      booking=self.booking,
+                                      address_1='2 New St')
+        _dashboard = self.assertRebuilds(True)
+        self.assertEqual(_dashboard['active_bids'][0].booking.address_1,
+                         '2 New St')
+
+    def test_moving_a_booking_away_retires_its_old_category(self):
+        self.assertRebuilds(True)
+        _booking = Booking.objects.get(pk=self.booking.pk)
+        _booking.category = Category.objects.create(name='Other')
+        # The old category is known from loading: saving runs the UPDATE and
+        # the bidders' lookup, but no SELECT of the old row.
+        with CaptureQueriesContext(connection) as _queries:
+            _booking.save()
+        self.assertFalse([_query for _query in _queries if _query[
+            'sql'].startswith('SELECT "booking_booking"')])
+        self.assertNotIn(_booking, list(self.assertRebuilds(True)['bookings']))
+
+    def test_snapshot_holds_only_the_latest_transactions(self):
+        for _i in range(DASHBOARD_TRANSACTIONS):
+            TransactionManager.buy_credits(
+                source_agent=self.agent, contractor=self.contractor,
+                amount=Decimal('1.00'))
+        _transactions = self.assertRebuilds(True)['transactions']
+        self.assertEqual(len(_transactions), DASHBOARD_TRANSACTIONS)
+        self.assertEqual(_transactions, list(Transaction.objects.filter(
+            contractor=self.contractor).order_by('-timestamp', '-id')[
+            :DASHBOARD_TRANSACTIONS]))
+        self.assertTrue(get_dashboard(self.contractor.pk)[
+            'more_transactions'])
+        self.client.force_login(self.contractor.user)
+        _response = self.client.get(reverse('booking:contractor-detail',
+                                            kwargs={'id': self.contractor.pk}))
+        self.assertContains(_response, '?contractor=%d' % self.contractor.pk)
+
+    def test_other_users_get_no_snapshot(self):
+        self.client.force_login(User.objects.create(username='nosy'))
+        _response = self.client.get(reverse('booking:contractor-detail',
+                                            kwargs={'id': self.contractor.pk}))
+        self.assertEqual(_response.status_code, 404)
+        self.assertIsNone(cache.get(snapshot_key(self.contractor.pk)))
+
+
+class QualifiedFeedTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(QualifiedFeedTest, self).setUp()
+        self.contractor = self.make_contractor('Feed')
+        self.contractor.set_post_ranges([[3000, 3199], [3150, 3300],
+                                         [5000, 5000]])
+        self.contractor.save()
+        _other = Category.objects.create(name='Plumbing')
+        _now = timezone.now()
+        for _i, _post_code in enumerate([2999, 3000, 3200, 3301, 4000,
+                                         5000, 3121, 3250]):
+            self.make_booking(post_code=_post_code, priority_level=_i % 3,
+                              preferred_schedule=_now + timedelta(hours=_i))
+        self.make_booking(post_code=3121, category=_other)
+        self.make_booking(post_code=3121, completed=True)
+        self.make_booking(post_code=3121, status=BOOKING_STATUS_CANCELLED)
+
+    def test_matches_in_post_range_in_one_query(self):
+        _expected = sorted(
+            [_b for _b in Booking.objects.open().filter(
+                category=self.category)
+             if self.contractor.in_post_range(_b.post_code)],
+            key=lambda _b: (-_b.priority_level, _b.preferred_schedule, _b.pk))
+        with self.assertNumQueries(1):
+            _bookings = list(Booking.objects.qualified_for(
+                self.contractor).order_by(*Booking.FEED_ORDERING))
+        self.assertEqual(_bookings, _expected)
+        self.assertEqual(
+            sorted(_b.post_code for _b in _bookings),
+            [3000, 3121, 3121, 3200, 3250, 5000])
+
+        self.contractor.set_post_ranges([])
+        self.assertFalse(Booking.objects.qualified_for(self.contractor))
+
+    def test_feed_pages(self):
+        _seen = []
+        _cursor = None
+        while True:
+            _page = Booking.qualified_feed(contractor=self.contractor,
+                                           cursor=_cursor, page_size=4)
+            _seen.extend(_page)
+            _cursor = _page.next_cursor
+            if not _cursor:
+                break
+        self.assertEqual(_seen, list(Booking.objects.qualified_for(
+            self.contractor).order_by(*Booking.FEED_ORDERING)))
+
+        self.client.force_login(self.contractor.user)
+        _response = self.client.get(reverse(
+            'booking:contractor-feed', kwargs={'id': self.contractor.pk}),
+            {'page_size': 4})
+        self.assertEqual(list(_response.context['bookings']), _seen[:4])
+        self.assertTrue(_response.context['page'].has_next)
+        self.client.force_login(User.objects.create(username='someone'))
+        self.assertEqual(self.client.get(reverse(
+            'booking:contractor-feed',
+            kwargs={'id': self.contractor.pk})).status_code, 404)
+
+
+class BookingManagerTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(BookingManagerTest, self).setUp()
+        self.access_level.default_permissions.add(Permission.objects.create(
+            action=PERM_ACTION_UPDATE, location=PERM_LOCATION_BOOKINGS))
+        self.agent = Agent.objects.get(pk=self.agent.pk)
+        # Warm the permission cache so only the update is counted.
+        self.agent.has_perms(PERM_ACTION_UPDATE, PERM_LOCATION_BOOKINGS)
+        self.subtypes = [SubType.objects.create(name='Subtype %d' % _i)
+                         for _i in range(6)]
+
+    def subtype_pks(self, booking):
+        return sorted(booking.subtypes.values_list('pk', flat=True))
+
+    def test_create_booking_adds_subtypes_at_once(self):
+        for _count in [2, 5]:
+            # savepoint, insert, subtype select, subtype insert, release
+            with self.assertNumQueries(5):
+                _booking = BookingManager.create_booking(
+                    agent=self.agent, consumer=self.consumer,
+                    address_1='1 Main St', suburb=self.suburb,
+                    post_code=3121, preferred_schedule=timezone.now(),
+                    category=self.category, quoted_price=Decimal('100.00'),
+                    base_cost=Decimal('20.00'), priority_level=1,
+                    status=BOOKING_STATUS_ACTIVE,
+                    subtypes=self.subtypes[:_count])
+            self.assertEqual(self.subtype_pks(_booking),
+                             [_s.pk for _s in self.subtypes[:_count]])
+
+    def test_update_booking_diffs_subtypes_in_constant_queries(self):
+        self.booking.subtypes.add(*self.subtypes[:3])
+        # savepoint, subtype select, delete, insert, update, bidders select,
+        # release
+        with self.assertNumQueries(7):
+            self.assertEqual(BookingManager.update_booking(
+                agent=self.agent, booking=self.booking,
+                address_1='2 New St', subtypes=self.subtypes[2:]), 1)
+        self.assertEqual(self.subtype_pks(self.booking),
+                         [_s.pk for _s in self.subtypes[2:]])
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk).address_1,
+                         '2 New St')
+
+        # Pks are accepted, and leaving subtypes out keeps them.
+        BookingManager.update_booking(
+            agent=self.agent, booking=self.booking,
+            subtypes=[self.subtypes[0].pk])
+        BookingManager.update_booking(agent=self.agent, booking=self.booking,
+                                      priority_level=2)
+        self.assertEqual(self.subtype_pks(self.booking),
+                         [self.subtypes[0].pk])
+        BookingManager.update_booking(agent=self.agent, booking=self.booking,
+                                      subtypes=[])
+        self.assertEqual(self.subtype_pks(self.booking), [])
+
+    def test_rescheduling_moves_a_default_close_time(self):
+        _schedule = timezone.now() + timedelta(hours=2)
+        _booking = self.make_booking(preferred_schedule=_schedule,
+                                     closes_at=None)
+        self.assertEqual(_booking.closes_at, _schedule)
+        _rescheduled = timezone.now() + timedelta(days=2)
+        BookingManager.update_booking(agent=self.agent, booking=_booking,
+                                      preferred_schedule=_rescheduled)
+        self.assertEqual(Booking.objects.get(pk=_booking.pk).closes_at,
+                         _rescheduled)
+        self.assertFalse(Booking.objects.due(
+            timezone.now() + timedelta(days=1)).filter(
+            pk=_booking.pk).exists())
+
+        # A close time set apart from the schedule stays.
+        _closes_at = self.booking.closes_at
+        BookingManager.update_booking(agent=self.agent, booking=self.booking,
+                                      preferred_schedule=_rescheduled)
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk).closes_at,
+                         _closes_at)
+
+
+class AdminChangelistTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(AdminChangelistTest, self).setUp()
+        self.client.force_login(User.objects.create(
+            username='admin', is_staff=True, is_superuser=True))
+        self.permission = Permission.objects.create(
+            action=PERM_ACTION_READ, location=PERM_LOCATION_BIDS)
+
+    def add_rows(self, count):
+        _permission = self.permission
+        for _i in range(count):
+            _suffix = '%d-%d' % (count, _i)
+            _level = AccessLevel.objects.create(name='Level %s' % _suffix)
+            _level.default_permissions.add(_permission)
+            _agent = Agent.objects.create(
+                access_level=_level,
+                user=User.objects.create(username='agent-%s' % _suffix))
+            _agent.permissions.add(_permission)
+            _contractor = self.make_contractor('contractor-%s' % _suffix)
+            _contractor.categories.add(
+                Category.objects.create(name='Category %s' % _suffix))
+            self.make_booking(agent=_agent)
+
+    def changelist_queries(self):
+        _counts = {}
+        for _model in ['accesslevel', 'agent', 'contractor', 'booking']:
+            with CaptureQueriesContext(connection) as _queries:
+                self.assertEqual(self.client.get(reverse(
+                    'admin:booking_%s_changelist' % _model)).status_code, 200)
+            _counts[_model] = len(_queries)
+        return _counts
+
+    def test_changelists_run_constant_queries(self):
+        self.add_rows(2)
+        _before = self.changelist_queries()
+        self.add_rows(10)
+        self.assertEqual(self.changelist_queries(), _before)
+
+    def test_materialized_fields_are_read_only(self):
+        _contractor = self.make_contractor('Readonly', credits='50.00')
+        _alert = Alert.create(target=_contractor, body='Hello')
+        _bid, _transaction = BiddingManager.place_bid(
+            contractor=_contractor, booking=self.booking,
+            base_cost=Decimal('20.00'))
+        _preferred = Preferred.objects.create(contractor=_contractor,
+                                              category=self.category)
+        for _url, _fields in [
+                (reverse('admin:booking_contractor_change',
+                         args=[_contractor.pk]),
+                 ['balance', 'post_ranges_raw']),
+                (reverse('admin:booking_consumer_change',
+                         args=[self.consumer.pk]),
+                 ['nps_sum', 'nps_count']),
+                (reverse('admin:booking_alert_change', args=[_alert.pk]),
+                 ['target', 'target_type', 'is_read']),
+                (reverse('admin:booking_transaction_change',
+                         args=[_transaction.pk]),
+                 ['transaction_type', 'amount', 'contractor', 'status']),
+                (reverse('admin:booking_bid_change', args=[_bid.pk]),
+                 ['base_cost', 'premium_adjustment', 'status']),
+                (reverse('admin:booking_preferred_change',
+                         args=[_preferred.pk]),
+                 ['post_ranges_raw'])]:
+            _content = self.client.get(_url).content
+            for _field in _fields:
+                self.assertNotIn('name="%s"' % _field, _content)
+        for _name in ['alert', 'transaction', 'bid']:
+            self.assertEqual(self.client.get(reverse(
+                'admin:booking_%s_add' % _name)).status_code, 403)
+            self.assertEqual(self.client.get(reverse(
+                'admin:booking_%s_changelist' % _name)).status_code, 200)
+        _response = self.client.get(reverse('admin:booking_alert_changelist'))
+        self.assertNotIn('delete_selected', _response.content)
+        for _url in [reverse('admin:booking_transaction_delete',
+                             args=[_transaction.pk]),
+                     reverse('admin:booking_bid_delete', args=[_bid.pk]),
+                     reverse('admin:booking_alert_delete', args=[_alert.pk])]:
+            self.assertEqual(self.client.post(_url, {'post': 'yes'})
+                             .status_code, 403)
+        self.assertEqual(Contractor.objects.with_ledger_balance().get(
+            pk=_contractor.pk).ledger_balance, Decimal('30.00'))
+
+
+class BidRankingTest(TestCase):
+
+    def make_summaries(self, count, seed, preferred_rate=0.1):
+        _random = random.Random(seed)
+        _start = timezone.now()
+        _booking = Booking()
+        _summaries = []
+        # Few distinct costs and times, so that every tie-break is used.
+        for _pk in range(1, count + 1):
+            _bid = Bid(pk=_pk, base_cost=Decimal(_random.randint(10, 20)),
+                       premium_adjustment=Decimal(
+                           _random.choice(['0.00', '0.50'])),
+                       created_on=_start + timedelta(
+                           seconds=_random.randint(0, 5)))
+            _summaries.append(BidSummary(
+                _booking, _bid,
+                preferred=_random.random() < preferred_rate))
+        return _summaries
+
+    def expected_top(self, summaries):
+        _rest = list(summaries)
+        _winner = BiddingManager.get_winning_bid(_rest)
+        _rest.remove(_winner)
+        return [_winner, BiddingManager.get_winning_bid(_rest)]
+
+    def test_python_ranking_matches_get_winning_bid(self):
+        for _seed in range(20):
+            _summaries = self.make_summaries(60, _seed,
+                                             preferred_rate=_seed % 3 * 0.1)
+            _top = BidMatrix.from_summaries(_summaries).top(2, 'python')
+            self.assertEqual([_summaries[_i] for _i in _top],
+                             self.expected_top(_summaries))
+        _single = self.make_summaries(1, 0)
+        self.assertEqual(BidMatrix.from_summaries(_single).top(2), [0])
+        self.assertEqual(BidMatrix([], [], [], []).top(2), [])
+
+    def test_numpy_ranking_matches_python_ranking(self):
+        if ranking.numpy is None:
+            self.skipTest('NumPy is not installed.')
+        for _seed, _count in [(1, 60), (2, 20000)]:
+            _summaries = self.make_summaries(_count, _seed)
+            _matrix = BidMatrix.from_summaries(_summaries)
+            self.assertEqual(_matrix.top(10, 'numpy'),
+                             _matrix.top(10, 'python'))
+            self.assertEqual(_matrix.top(10, 'numpy', min_cost=1550),
+                             _matrix.top(10, 'python', min_cost=1550))
+            self.assertEqual(_matrix.top(2, 'numpy', min_cost=10 ** 6), [])
+            self.assertEqual([_summaries[_i] for _i in _matrix.top(2)],
+                             self.expected_top(_summaries))
+        self.assertEqual(BidMatrix([], [], [], []).top(2, 'numpy'), [])
+
+
+class PricingStrategyTest(MarketplaceFixtures, TestCase):
+
+    def setUp(self):
+        super(PricingStrategyTest, self).setUp()
+        # Bids hold what the configured strategy can charge.
+        self.saved_strategy = pricing.DEFAULT_STRATEGY
+        pricing.DEFAULT_STRATEGY = SecondPriceStrategy.name
+
+    def tearDown(self):
+        pricing.DEFAULT_STRATEGY = self.saved_strategy
+        super(PricingStrategyTest, self).tearDown()
+
+    def test_list_price_bills_as_before(self):
+        pricing.DEFAULT_STRATEGY = ListPriceStrategy.name
+        _high, _low = self.place_bids(self.booking, ['30.00', '25.00'])
+        self.assertEqual(Contractor.objects.get(
+            pk=_high.contractor_id).balance, Decimal('80.00'))
+        _winner, _second, _losers = BiddingManager.exec_auction(
+            booking=self.booking)
+        self.assertEqual((_winner.bid, _second.bid, _winner.price),
+                         (_high, _low, Decimal('20.00')))
+        self.assertFalse(Transaction.objects.filter(
+            source_type=TRANS_SOURCE_AUCTION).exists())
+        self.assertEqual(Contractor.objects.get(
+            pk=_high.contractor_id).balance, Decimal('80.00'))
+
+    def test_strategies_price_the_matrix(self):
+        # The preferred bid at 10.00 wins over 30.00 and 25.00.
+        _matrix = BidMatrix([1, 2, 3], [True, False, False],
+                            [1000, 3000, 2500], [0, 0, 0])
+        _first = FirstPriceStrategy().run(_matrix, 500)
+        self.assertEqual((_first.winner, _first.second, _first.price),
+                         (0, 1, 1000))
+        _second = SecondPriceStrategy().run(_matrix, 500)
+        self.assertEqual((_second.winner, _second.second, _second.price),
+                         (0, 1, 1000))
+        self.assertEqual(SecondPriceStrategy().run(
+            BidMatrix([1, 2], [False] * 2, [3000, 2500], [0, 0]),
+            2000).price, 2500)
+        self.assertEqual(SecondPriceStrategy().run(_matrix, 2000).price,
+                         2000)
+
+        # Only 30.00 and 25.00 meet a reserve of 1.2 x 20.00.
+        _reserve = ReservePriceStrategy('1.2').run(_matrix, 2000)
+        self.assertEqual((_reserve.winner, _reserve.second, _reserve.price),
+                         (1, 2, 2500))
+        _unopposed = ReservePriceStrategy('1.4').run(_matrix, 2000)
+        self.assertEqual((_unopposed.winner, _unopposed.price), (1, 2800))
+        self.assertFalse(ReservePriceStrategy('2').run(_matrix, 2000).sold)
+        self.assertFalse(FirstPriceStrategy().run(
+            BidMatrix([], [], [], []), 2000).sold)
+
+    def test_second_price_refunds_the_difference(self):
+        _high, _low = self.place_bids(self.booking, ['30.00', '25.00'])
+        self.assertEqual(Contractor.objects.get(
+            pk=_high.contractor_id).balance, Decimal('70.00'))
+
+        _winner, _second, _losers = BiddingManager.exec_auction(
+            booking=self.booking, strategy=SecondPriceStrategy())
+        self.assertEqual((_winner.bid, _second.bid, _losers), (_high, _low, []))
+        self.assertEqual(_winner.price, Decimal('25.00'))
+        _refund = Transaction.objects.get(target_bid=_high,
+                                          transaction_type=TRANS_TYPE_BUY)
+        self.assertEqual((_refund.amount, _refund.status,
+                          _refund.source_type),
+                         (Decimal('5.00'), TRANS_STATUS_COMMITTED,
+                          TRANS_SOURCE_AUCTION))
+        self.assertIn('auction of booking %s' % self.booking.pk,
+                      _refund.comment)
+        for _bid, _balance in [(_high, '75.00'), (_low, '100.00')]:
+            _contractor = Contractor.objects.with_ledger_balance().get(
+                pk=_bid.contractor_id)
+            self.assertEqual(_contractor.balance, Decimal(_balance))
+            self.assertEqual(_contractor.ledger_balance, _contractor.balance)
+
+    def test_unmet_reserve_refunds_every_bid(self):
+        _bids = self.place_bids(self.booking, ['30.00', '25.00'])
+        self.assertEqual(BiddingManager.exec_auction(
+            booking=self.booking, strategy=ReservePriceStrategy('2')),
+            (None, None, []))
+        for _bid in _bids:
+            self.assertEqual(Bid.objects.get(pk=_bid.pk).status,
+                             BID_STATUS_EXPIRED)
+            self.assertEqual(Contractor.objects.get(
+                pk=_bid.contractor_id).balance, Decimal('100.00'))
+        self.assertEqual(Booking.objects.get(pk=self.booking.pk)
+                         .auction_status, AUCTION_STATUS_SETTLED)
+
+    def test_replay_reports_revenue_per_strategy(self):
+        self.place_bids(self.booking, ['30.00', '25.00'])
+        BiddingManager.exec_auction(booking=self.booking)
+        # Unopposed, the open booking's bid pays the 20.00 list price.
+        _open = self.make_booking()
+        self.place_bids(_open, ['22.00'])
+
+        _out = StringIO()
+        call_command('replay_pricing', reserve_ratio='1.3', stdout=_out)
+        _report = json.loads(_out.getvalue())
+        self.assertEqual(_report['load']['bids'], 2)
+        self.assertEqual(_report['baseline'], 'list_price')
+        self.assertEqual(dict(
+            (_name, (_result['sold'], _result['revenue'],
+                     _result['revenue_vs_baseline']))
+            for _name, _result in _report['strategies'].items()), {
+                'list_price': (1, '20.00', '0.00'),
+                'first_price': (1, '30.00', '10.00'),
+                'second_price': (1, '25.00', '5.00'),
+                'reserve_price': (1, '26.00', '6.00'),
+            })
+
+        _out = StringIO()
+        call_command('replay_pricing', strategy=['second_price'],
+                     include_open=True, stdout=_out)
+        _strategies = json.loads(_out.getvalue())['strategies']
+        self.assertEqual(sorted(_strategies), ['list_price', 'second_price'])
+        _second = _strategies['second_price']
+        self.assertEqual((_second['auctions'], _second['revenue']),
+                         (2, '45.00'))
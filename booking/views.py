@@ -1,14 +1,26 @@
+from django.conf import settings
 from django.contrib import messages
-from django.http import Http404, HttpResponseRedirect
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+HttpResponseRedirect, StreamingHttpResponse)
 from django.shortcuts import get_object_or_404, render, redirect
 from django.utils import timezone
+from django.utils.crypto import constant_time_compare
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 import datetime
+from decimal import Decimal, InvalidOperation
 
 from .forms import (BidForm, BookingForm, ConsumerForm, ContractorForm,
 TransactionForm)
-from .managers import BiddingManager, BookingManager, TransactionManager
+from .dashboard import get_dashboard
+from .exceptions import AuctionClosed, ContractorNotEligible
+from .exports import EXPORTS, csv_lines, export_queryset
+from .managers import (BiddingManager, BookingManager, NPSManager,
+TransactionManager)
+from .metrics import registry
 from .models import (Agent, Bid, Booking, Category, Consumer, Contractor,
-Preferred, Suburb, Transaction)
+Suburb, Transaction)
+from .pagination import paginate_request
 
 # Create your views here.
 def create_bid(request):
@@ -31,13 +43,20 @@ def place_bid(request, pk, id, *args, **kwargs):
     if not request.user.is_authenticated:
         raise Http404
     contractor=Contractor.objects.get(pk=pk)
-    if not request.user.is_staff and not request.user==contractor.user:
+    if not request.user.is_staff and not request.user.pk==contractor.user_id:
         raise Http404
-    booking=Booking.objects.get(id=id)
+    booking=Booking.objects.select_related('consumer').get(id=id)
     form = BidForm(request.POST or None, initial={booking:booking})
     if form.is_valid():
         kwargs = form.cleaned_data
-        instance = BiddingManager.place_bid(contractor=contractor, booking=booking, **kwargs)
+        try:
+            instance = BiddingManager.place_bid(contractor=contractor, booking=booking, **kwargs)
+        except AuctionClosed:
+            messages.error(request,"Bidding on this booking has closed")
+            return HttpResponseRedirect(contractor.get_absolute_url())
+        except ContractorNotEligible as e:
+            messages.error(request, "%s" % e)
+            return HttpResponseRedirect(contractor.get_absolute_url())
         messages.success(request,"Successfully created")
         return HttpResponseRedirect(contractor.get_absolute_url())
     elif form.errors:
@@ -51,23 +70,36 @@ def place_bid(request, pk, id, *args, **kwargs):
 def bid_auction(request, pk):
     booking = Booking.objects.get(pk=pk)
     bid_list = ()
-    bid_list = BiddingManager.exec_auction(booking=booking)
+    try:
+        bid_list = BiddingManager.exec_auction(booking=booking)
+    except AuctionClosed:
+        messages.error(request,"The auction has already been settled")
+        return HttpResponseRedirect(booking.get_absolute_url())
+    if bid_list[0] is None:
+        messages.info(request, "The auction closed without a winning bid")
+        return HttpResponseRedirect(booking.get_absolute_url())
     context = {
         "bid_list":bid_list,
     }
     return render(request, 'booking_auction.html', context)
 
 def bid_detail(request, id, *args, **kwargs):
-    bid = Bid.objects.get(id=id)
+    bid = Bid.objects.select_related('booking__consumer', 'contractor')\
+        .get(id=id)
     context = {
         "bid": bid,
     }
     return render(request,'bid_detail.html', context)
 
 def bid_list(request):
-    bids = Bid.objects.all()
+    page = paginate_request(request,
+        Bid.objects.select_related('booking__consumer', 'contractor'),
+        ('-created_on', '-pk'),
+        filters={"status": "status", "contractor": "contractor_id",
+                 "category": "booking__category_id"})
     context = {
-        "bids": bids,
+        "bids": page,
+        "page": page,
     }
     return render(request,'bid_list.html', context)
 
@@ -108,19 +140,25 @@ def edit_booking(request, pk=None):
     return render(request,'booking_form.html', context)
 
 def booking_detail(request, pk, *args, **kwargs):
-    booking = Booking.objects.get(pk=pk)
-    bids = Bid.objects.filter(booking_id=pk)
+    booking = Booking.objects.select_related(
+        'consumer', 'suburb', 'agent__user', 'agent__access_level',
+        'category', 'link__consumer'
+    ).prefetch_related('subtypes').get(pk=pk)
+    bids = Bid.objects.filter(booking_id=pk).select_related('contractor')
     context = {
         "booking": booking,
         "bids": bids,
     }
-    print(context)
     return render(request,'booking_detail.html', context)
 
 def booking_list(request):
-    bookings = Booking.objects.all()
+    page = paginate_request(request,
+        Booking.objects.select_related('consumer', 'category'),
+        ('-created_on', '-pk'),
+        filters={"status": "status", "category": "category_id"})
     context = {
-        "bookings": bookings,
+        "bookings": page,
+        "page": page,
     }
     return render(request,'booking_list.html', context)
 
@@ -146,7 +184,8 @@ def create_consumer(request):
 
 def consumer_detail(request, id, *args, **kwargs):
     consumer = Consumer.objects.get(id=id)
-    bookings = Booking.objects.filter(consumer=consumer)
+    bookings = Booking.objects.filter(consumer=consumer)\
+        .select_related('category')
     context = {
         "consumer": consumer,
         "bookings": bookings,
@@ -154,9 +193,10 @@ def consumer_detail(request, id, *args, **kwargs):
     return render(request,'consumer_detail.html', context)
 
 def consumer_list(request):
-    consumers = Consumer.objects.all()
+    page = paginate_request(request, Consumer.objects.all(), ('pk',))
     context = {
-        "consumers": consumers,
+        "consumers": page,
+        "page": page,
     }
     return render(request,'consumer_list.html', context)
 
@@ -181,32 +221,50 @@ def create_contractor(request):
     return render(request,'contractor_form.html', context)
 
 def contractor_detail(request, id, *args, **kwargs):
-    contractor = Contractor.objects.get(id=id)
-    if not request.user.is_staff and not request.user==contractor.user:
+    # Checked before the dashboard is built and cached.
+    if not request.user.is_staff and not Contractor.objects.filter(
+            pk=id, user_id=request.user.pk).exists():
+        raise Http404
+    try:
+        dashboard = get_dashboard(int(id))
+    except Contractor.DoesNotExist:
         raise Http404
-    credits = contractor.credits
-    active_bids = Bid.objects.filter(contractor=contractor, status='bid_status_active')
-    winning_bids = Bid.objects.filter(contractor=contractor, status='bid_status_accepted')
-    losing_bids = Bid.objects.filter(contractor=contractor, status='bid_status_expired')
-    bookings = Booking.objects.filter(category_id__in=contractor.categories.values_list('id')).filter(completed=False).filter(status="booking_status_active")
-    preferred = Preferred.objects.filter(category_id__in=contractor.categories.values_list('id'))
-    transactions = Transaction.objects.filter(contractor=contractor)
+    contractor = dashboard["contractor"]
     context = {
         "contractor": contractor,
-        "credits": credits,
-        "active_bids": active_bids,
-        "winning_bids": winning_bids,
-        "losing_bids": losing_bids,
-        "bookings": bookings,
-        "preferred": preferred,
-        "transactions": transactions,
+        "credits": dashboard["credits"],
+        "active_bids": dashboard["active_bids"],
+        "winning_bids": dashboard["winning_bids"],
+        "losing_bids": dashboard["losing_bids"],
+        "bookings": dashboard["bookings"],
+        "preferred": dashboard["preferred"],
+        "transactions": dashboard["transactions"],
+        "more_transactions": dashboard["more_transactions"],
     }
     return render(request,'contractor_detail.html', context)
 
+def contractor_feed(request, id, *args, **kwargs):
+    contractor = get_object_or_404(Contractor, id=id)
+    if not request.user.is_staff and not request.user.pk==contractor.user_id:
+        raise Http404
+    page = paginate_request(request,
+        Booking.objects.qualified_for(contractor).select_related(
+            'consumer', 'category', 'suburb'),
+        Booking.FEED_ORDERING)
+    context = {
+        "contractor": contractor,
+        "bookings": page,
+        "page": page,
+    }
+    return render(request,'contractor_feed.html', context)
+
 def contractor_list(request):
-    contractors = Contractor.objects.all()
+    page = paginate_request(request,
+        Contractor.objects.prefetch_related('categories'), ('pk',),
+        filters={"category": "categories__id"})
     context = {
-        "contractors": contractors,
+        "contractors": page,
+        "page": page,
     }
     return render(request,'contractor_list.html', context)
 
@@ -232,15 +290,64 @@ def create_transaction(request, id=None, *args, **kwargs):
     return render(request,'transaction_form.html', context)
 
 def transaction_detail(request, id, *args, **kwargs):
-    transaction = Consumer.objects.get(id=id)
+    transaction = Transaction.objects.select_related('contractor').get(id=id)
     context = {
         "transaction": transaction,
     }
     return render(request,'transaction_detail.html', context)
 
 def transaction_list(request):
-    transactions = Transaction.objects.all()
+    page = paginate_request(request, Transaction.objects.all(),
+        ('-timestamp', '-pk'),
+        filters={"status": "status", "contractor": "contractor_id"})
     context = {
-        "transactions": transactions,
+        "transactions": page,
+        "page": page,
     }
     return render(request,'transaction_list.html', context)
+
+def metrics(request):
+    '''Prometheus metrics, for scrapers sending BOOKING_METRICS_TOKEN as an
+    "Authorization: Bearer" header.'''
+    token = getattr(settings, 'BOOKING_METRICS_TOKEN', None)
+    if not token or not constant_time_compare(
+            request.META.get('HTTP_AUTHORIZATION', ''), 'Bearer ' + token):
+        raise Http404
+    return HttpResponse(registry.render(),
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@csrf_exempt
+@require_POST
+def nps_response(request):
+    '''AskNicely response webhook. The URL configured in AskNicely carries
+    ASKNICELY_WEBHOOK_TOKEN as its token parameter; the posted response is
+    matched to the latest consumer with its email.'''
+    token = getattr(settings, 'ASKNICELY_WEBHOOK_TOKEN', None)
+    if not token or not constant_time_compare(
+            request.GET.get('token', ''), token):
+        raise Http404
+    consumer = Consumer.objects.filter(
+        email_address=request.POST.get('email', '')).order_by('-pk').first()
+    if not consumer:
+        raise Http404
+    try:
+        recorded = NPSManager.record_response(
+            consumer=consumer, nps_id=int(request.POST['response_id']),
+            nps=Decimal(request.POST['answer']))
+    except (KeyError, ValueError, InvalidOperation) as e:
+        return HttpResponseBadRequest("%s" % e)
+    return HttpResponse(status=201 if recorded else 200)
+
+def export_csv(request, kind):
+    if not request.user.is_staff or kind not in EXPORTS:
+        raise Http404
+    try:
+        queryset = export_queryset(kind, request.GET.get('start'),
+            request.GET.get('end'), **dict((name, request.GET.get(name))
+            for name in EXPORTS[kind]['filters']))
+    except ValueError as e:
+        return HttpResponseBadRequest("%s" % e)
+    response = StreamingHttpResponse(csv_lines(kind, queryset),
+                                     content_type='text/csv')
+    response['Content-Disposition'] = 'attachment; filename="%s.csv"' % kind
+    return response
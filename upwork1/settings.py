@@ -42,11 +42,10 @@ INSTALLED_APPS = [
     'accounts',
     #3rd party (philipp)
     'floppyforms',
-    'debug_toolbar',
 ]
 
 MIDDLEWARE_CLASSES = [
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
+    'booking.middleware.RequestMetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,11 +57,18 @@ MIDDLEWARE_CLASSES = [
 
 ]
 
+# The debug toolbar is a development aid only; production profiling goes
+# through booking.middleware.RequestMetricsMiddleware and /metrics/.
+if DEBUG:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE_CLASSES.insert(1,
+        'debug_toolbar.middleware.DebugToolbarMiddleware')
+
 ROOT_URLCONF = 'upwork1.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'booking.metrics.InstrumentedDjangoTemplates',
 # Template Folder added by Philipp
         'DIRS': [os.path.join(BASE_DIR, "templates")],
         'APP_DIRS': True,
@@ -72,6 +78,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'booking.context_processors.alerts',
             ],
         },
     },
@@ -87,9 +94,31 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        # On disk, so that threaded tests such as ConcurrentBiddingTest
+        # share the test database instead of being skipped.
+        'TEST': {
+            'NAME': os.path.join(BASE_DIR, 'test_db.sqlite3'),
+        },
+    }
+}
+
+
+# Cache
+# https://docs.djangoproject.com/en/1.9/topics/cache/
+# Local memory is per process; use a shared backend such as memcached in
+# production so that dashboard invalidations reach every worker.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
     }
 }
 
+# Seconds a contractor dashboard snapshot may be served from the cache.
+BOOKING_DASHBOARD_CACHE_TIMEOUT = 30
+# Latest transactions shown, and cached, on a contractor dashboard.
+BOOKING_DASHBOARD_TRANSACTIONS = 20
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.9/ref/settings/#auth-password-validators
@@ -137,3 +166,22 @@ STATICFILES_DIRS = [
 STATIC_ROOT = os.path.join(os.path.dirname(BASE_DIR), "static_cdn")
 
 INTERNAL_IPS = ['127.0.0.1']
+
+# Requests slower than this many milliseconds are counted, and a sample of
+# them have their queries logged to the booking.slow_requests logger.
+BOOKING_SLOW_REQUEST_MS = 500
+BOOKING_SLOW_REQUEST_SAMPLE_RATE = 0.1
+# Bearer token the metrics scraper sends to /metrics/; unset disables it.
+BOOKING_METRICS_TOKEN = os.environ.get('BOOKING_METRICS_TOKEN')
+
+# How auctions are priced: 'list_price', 'first_price', 'second_price' or
+# 'reserve_price', whose reserve is this multiple of a booking's list price.
+BOOKING_AUCTION_PRICING = 'list_price'
+BOOKING_AUCTION_RESERVE_RATIO = '1.0'
+
+# AskNicely survey triggers, sent by the drain_outbox command.
+ASKNICELY_URL = 'https://conos.asknice.ly/api/v1/person/trigger'
+ASKNICELY_API_KEY = os.environ.get(
+    'ASKNICELY_API_KEY', 'sqDNYMtYQwu6JeDHQnNl4FXvq6k2hP3auB0QNRAWoxC')
+# Token AskNicely passes to the nps-response webhook; unset disables it.
+ASKNICELY_WEBHOOK_TOKEN = os.environ.get('ASKNICELY_WEBHOOK_TOKEN')